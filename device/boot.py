@@ -1,4 +1,28 @@
+import os
+import board
+import digitalio
 import displayio
+import storage
 
 # Release any displays set up by the board so code.py can claim the LCD pins.
 displayio.release_displays()
+
+
+def boot_button_held():
+    pin = getattr(board, "BUTTON", None) or getattr(board, "BOOT0", None)
+    if pin is None:
+        return False
+    button = digitalio.DigitalInOut(pin)
+    button.switch_to_input(pull=digitalio.Pull.UP)
+    held = not button.value
+    button.deinit()
+    return held
+
+
+# A field trace (TRACE_FILE in settings.toml) is written by code.py, which
+# needs CIRCUITPY writable, and USB then sees it read-only. So it is only
+# remounted when the BOOT button is also held during reset; a normal reset
+# leaves the drive writable over USB (tools/deploy.py) and code.py skips
+# the trace.
+if os.getenv("TRACE_FILE") and boot_button_held():
+    storage.remount("/", readonly=False)
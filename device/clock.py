@@ -0,0 +1,188 @@
+# clock.py
+import time
+import rtc
+
+import timing
+
+# Reject server timestamps from exchanges slower than this: the midpoint
+# guess of when the server stamped the response gets too loose.
+MAX_RTT_S = 4.0
+# Server "ts" values are whole seconds (or ms), so allow for truncation.
+SERVER_RESOLUTION_S = 1.0
+# Drift is measured between two samples at least this far apart, and only
+# once their error bounds are small against the span (about a day for
+# server samples).
+DRIFT_MIN_SPAN_S = 60 * 60
+# Assumed monotonic clock error rate before / after drift was measured.
+DRIFT_UNKNOWN = 200e-6
+DRIFT_TOLERANCE = 20e-6
+DEFAULT_MAX_ERROR_S = 2.0
+DEFAULT_RTC_TOLERANCE_S = 2
+# Samples older than this are dropped: tick differences are only valid
+# up to timing.MAX_SPAN_S (~3.1 days), and the estimate is far too loose
+# by then anyway.
+MAX_SAMPLE_AGE_S = 2 * 24 * 60 * 60
+
+
+def _to_unix(ts):
+    """
+    Server timestamp (epoch s or ms, int/float/numeric str) -> int UTC
+    epoch seconds, or None.
+    """
+    if ts is None or isinstance(ts, bool):
+        return None
+    try:
+        ts = float(ts)
+    except (TypeError, ValueError):
+        return None
+    if ts > 1e11:  # milliseconds
+        ts /= 1000.0
+    if ts < 1.5e9:  # before 2017: not a real clock
+        return None
+    return int(ts)
+
+
+class ClockService:
+    """
+    Wall-clock estimate for the device built from timestamps the ingest
+    server already returns, with NTP only as a fallback.
+
+    The estimate is an anchor (tick, UTC epoch seconds, error bound) plus
+    the measured drift of the tick clock against the server.
+    Its error grows with the anchor's age; once it exceeds max_error_s,
+    needs_ntp() says so. Epoch seconds are kept as ints: a float can't hold
+    them to the second on CircuitPython.
+    """
+    def __init__(self, tz_offset_s=0, max_error_s=DEFAULT_MAX_ERROR_S,
+                 rtc_tolerance_s=DEFAULT_RTC_TOLERANCE_S, debug=True):
+        self.tz_offset_s = int(tz_offset_s)
+        self.max_error_s = float(max_error_s)
+        self.rtc_tolerance_s = int(rtc_tolerance_s)
+        self.debug = debug
+
+        self._anchor_ticks = None
+        self._anchor_unix = 0
+        self._anchor_err = 0.0
+        self._ref_ticks = None  # older sample the drift is measured against
+        self._ref_unix = 0
+        self._ref_err = 0.0
+        self.drift = 0.0        # server seconds per tick second, minus 1
+        self.drift_known = False
+        self.rtc_offset_s = None  # RTC minus estimate at the last check
+
+    def _log(self, msg):
+        if self.debug:
+            print(msg)
+
+    def _expire(self, now):
+        if self._ref_ticks is not None and timing.diff_s(now, self._ref_ticks) > MAX_SAMPLE_AGE_S:
+            self._ref_ticks = None
+        if self._anchor_ticks is not None and timing.diff_s(now, self._anchor_ticks) > MAX_SAMPLE_AGE_S:
+            self._log("Clock estimate expired")
+            self._anchor_ticks = None
+
+    def error(self, now):
+        """
+        Error bound in seconds of unix(now); infinite without a sample.
+        Called at least every few minutes (see code.py) so samples expire
+        before their ticks wrap.
+        """
+        self._expire(now)
+        if self._anchor_ticks is None:
+            return float("inf")
+        rate = DRIFT_TOLERANCE if self.drift_known else DRIFT_UNKNOWN
+        return self._anchor_err + abs(timing.diff_s(now, self._anchor_ticks)) * rate
+
+    def synced(self, now):
+        return self.error(now) <= self.max_error_s
+
+    def needs_ntp(self, now):
+        return not self.synced(now)
+
+    def unix(self, t):
+        """
+        UTC epoch seconds (int) at tick t, or None without a sample.
+        """
+        if self._anchor_ticks is None:
+            return None
+        dt = timing.diff_s(t, self._anchor_ticks)
+        return self._anchor_unix + int(round(dt + dt * self.drift))
+
+    def observe(self, server_ts, t_sent, t_recv):
+        """
+        Feeds the "ts" of a server response to a request sent at tick
+        t_sent and answered at tick t_recv. Returns True if it was used.
+        """
+        unix = _to_unix(server_ts)
+        rtt = timing.diff_s(t_recv, t_sent)
+        if unix is None or rtt < 0 or rtt > MAX_RTT_S:
+            return False
+        # The server stamped somewhere inside the round trip.
+        self._add_sample(unix, timing.add_s(t_sent, rtt / 2), rtt / 2 + SERVER_RESOLUTION_S)
+        return True
+
+    def set_from_ntp(self, unix, t, err=0.5):
+        self._add_sample(int(unix), t, err)
+
+    def _add_sample(self, unix, t, err):
+        self._expire(t)
+        if self._ref_ticks is None:
+            self._ref_ticks, self._ref_unix, self._ref_err = t, unix, err
+        else:
+            span = timing.diff_s(t, self._ref_ticks)
+            if span >= DRIFT_MIN_SPAN_S and (err + self._ref_err) / span < DRIFT_TOLERANCE:
+                d = ((unix - self._ref_unix) - span) / span
+                if self.drift_known:
+                    self.drift += (d - self.drift) * 0.25
+                else:
+                    self.drift = d
+                    self.drift_known = True
+                self._log("Clock drift %.1f ppm" % (self.drift * 1e6))
+                self._ref_ticks, self._ref_unix, self._ref_err = t, unix, err
+
+        # Re-anchor whenever the new sample beats the current estimate.
+        if err <= self.error(t):
+            self._anchor_ticks = t
+            self._anchor_unix = unix
+            self._anchor_err = err
+
+    def local_time(self, t):
+        """
+        time.struct_time in the configured timezone, or None.
+        """
+        unix = self.unix(t)
+        if unix is None:
+            return None
+        return time.localtime(unix + self.tz_offset_s)
+
+    def next_minute(self, now):
+        """
+        Tick at which the local minute next changes: by the estimate when
+        there is one, else by the RTC (whole seconds, so up to 1 s late).
+        Always after now, so a caller sleeping until it can't spin.
+        """
+        if self._anchor_ticks is None:
+            into = time.time() % 60
+        else:
+            # Whole seconds first: epoch seconds don't fit a float
+            dt = timing.diff_s(now, self._anchor_ticks)
+            into = ((self._anchor_unix + self.tz_offset_s) % 60 + dt + dt * self.drift) % 60
+        # Rounded up: truncating to whole ms would return now just before
+        # the minute turns
+        return timing.ticks_add(now, int((60 - into) * 1000) + 1)
+
+    def sync_rtc(self, now):
+        """
+        Rewrites the RTC (kept in local time) if it strayed more than
+        rtc_tolerance_s from the estimate. Returns True if it was set.
+        """
+        if not self.synced(now):
+            return False
+        local = self.unix(now) + self.tz_offset_s
+        self.rtc_offset_s = time.time() - local
+        if abs(self.rtc_offset_s) <= self.rtc_tolerance_s:
+            return False
+        self._log("Setting RTC (was off by %ds)" % self.rtc_offset_s)
+        rtc.RTC().datetime = time.localtime(local)
+        self.rtc_offset_s = 0
+        return True
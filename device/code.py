@@ -1,4 +1,5 @@
-import time, gc
+import gc
+import asyncio
 import board
 import busio
 #import tinys3
@@ -13,7 +14,14 @@ import utils
 import display
 import networking
 import telemetry
+import clock
+import retry
 import device_config
+import scheduler
+import timing
+import diagnostics
+import stall
+import fieldtrace
 
 config_device_id = os.getenv("DEVICE_ID")
 device_cfg = device_config.load_device_config(config_device_id)
@@ -29,6 +37,10 @@ enable_battery = device_cfg["enable_battery"]
 board_type = device_cfg["board_type"]
 display_invert = device_cfg["display_invert"]
 display_rotation = device_cfg["display_rotation"]
+sps30_sample_every_s = device_cfg["sps30_sample_every_s"]
+sps30_duty_cycle = device_cfg["sps30_duty_cycle"]
+sps30_warmup_s = device_cfg["sps30_warmup_s"]
+sps30_clean_every_s = device_cfg["sps30_clean_every_s"]
 
 if enable_pixel_wheel:
     import neopixel
@@ -53,16 +65,52 @@ print("\nHello from CircuitPython!")
 print("----------------------\n")
 print("Free RAM:", gc.mem_free())
 
+# Optional field trace of raw sensor/network input and stage timings, for
+# replay on a host (python -m tools.sim --replay). Needs a filesystem
+# that code can write: hold BOOT while resetting, see boot.py.
+TRACE_FILE = os.getenv("TRACE_FILE")
+trace = fieldtrace.TraceRecorder(
+    TRACE_FILE,
+    max_bytes=int(os.getenv("TRACE_MAX_BYTES") or fieldtrace.DEFAULT_MAX_BYTES),
+) if TRACE_FILE else None
+if trace is not None and not trace.enabled:
+    trace = None
+if trace is not None:
+    trace.note(f"device={config_device_id}")
+    sps30_uart.decoder.tap = trace.uart
+
 # ---------- Setup ----------
 if enable_pixel_wheel:
     pixel_wheel.power_up()
 
+SPS30_TRIP_AFTER = 4
+SPS30_REINIT_S = 5 * 60
+
+sps30_sched = sps30_uart.MeasurementScheduler(
+    sample_every_s=sps30_sample_every_s,
+    duty_cycle=sps30_duty_cycle,
+    warmup_s=sps30_warmup_s,
+    clean_every_s=sps30_clean_every_s,
+)
+
+# Read failures back off; repeated ones open the circuit and each probe
+# restarts the sensor instead of giving up on it. The restart runs as
+# split-phase commands from sps30_task, so it never blocks the loop.
+sps30_retry = retry.RetryPolicy(
+    "SPS30",
+    base_s=sps30_sample_every_s,
+    max_s=60.0,
+    trip_after=SPS30_TRIP_AFTER,
+    open_s=SPS30_REINIT_S,
+    max_open_s=60 * 60,
+    on_reinit=sps30_sched.restart,
+)
 if enable_sps30:
     try:
-        sps30_uart.wake_up()
+        sps30_uart.reinit()
     except Exception as exc:
-        print(f"SPS30 init failed; disabling SPS30: {exc}")
-        enable_sps30 = False
+        print(f"SPS30 init failed; will retry: {exc}")
+        sps30_retry.trip()
 
 disp = None
 dashboard_labels = None
@@ -70,11 +118,14 @@ wifi_icon = None
 battery_icon = None
 time_label = None
 
+DISPLAY_RETRY_EVERY_S = 2.0
+display_retry = retry.RetryPolicy("Display", base_s=DISPLAY_RETRY_EVERY_S, max_s=60.0)
+
 def init_display_if_needed(now=None):
-    global disp, dashboard_labels, wifi_icon, battery_icon, time_label, next_display_init
+    global disp, dashboard_labels, wifi_icon, battery_icon, time_label
     if not enable_display or disp is not None:
         return
-    if now is not None and now < next_display_init:
+    if now is not None and not display_retry.ready(now):
         return
     disp = display.init_display(
         board_type=board_type,
@@ -82,10 +133,11 @@ def init_display_if_needed(now=None):
         rotation=display_rotation,
     )
     if disp is None or not hasattr(disp, "width") or disp.width is None:
-        print("Display init failed; will retry.")
         disp = None
-        next_display_init = (now or time.monotonic()) + DISPLAY_RETRY_EVERY_S
+        delay = display_retry.failure(now)
+        print(f"Display init failed; will retry in {delay:.0f}s.")
         return
+    display_retry.success()
     group, dashboard_labels, wifi_icon, battery_icon = display.make_dashboard(
         display_width=disp.width,
         display_height=disp.height,
@@ -107,9 +159,21 @@ def init_display_if_needed(now=None):
 if enable_display:
     init_display_if_needed()
 
+# Battery builds light-sleep whenever every task is idle for this long,
+# and look at the WiFi link less often so such gaps exist.
+LIGHT_SLEEP_MIN_S = 1.0
+BATTERY_LINK_CHECK_S = 5.0
+
 # Network manager
-net = networking.NetworkManager(healthcheck_every_s=30.0, wifi_retry_s=5.0, debug=True) if enable_wifi else None
+net = networking.NetworkManager(
+    healthcheck_every_s=30.0,
+    wifi_retry_s=5.0,
+    link_check_s=BATTERY_LINK_CHECK_S if enable_battery else networking.LINK_CHECK_EVERY_S,
+    trace=trace,
+    debug=True,
+) if enable_wifi else None
 last_net_state = None  # IMPORTANT: prevents blink timer from resetting every loop
+wall_clock = clock.ClockService(tz_offset_s=net.timezone_offset_s() if net else 0)
 
 # --- Telemetry setup ---
 API_INGEST_URL = os.getenv("API_INGEST_URL")
@@ -121,11 +185,88 @@ tm = telemetry.TelemetryManager(
     ingest_url=API_INGEST_URL,
     device_id=device_id,
     device_secret=device_secret,
-    post_every_s=60.0,
-    stale_s=300.0
+    post_every_s=float(os.getenv("TELEMETRY_POST_EVERY_S") or 60.0),
+    stale_s=300.0,
+    batch_url=os.getenv("API_INGEST_BATCH_URL"),
+    encoding=os.getenv("TELEMETRY_ENCODING") or "json",
+    aggregate=bool(int(os.getenv("TELEMETRY_AGGREGATE") or 0)),
+    clock=wall_clock,
+    wall_clock_ts=bool(int(os.getenv("TELEMETRY_WALL_CLOCK") or 0)),
+)
+# Metric IDs, resolved once so updates skip the name lookup
+M_PM1 = telemetry.metric_id("pm1_ugm3")
+M_PM25 = telemetry.metric_id("pm25_ugm3")
+M_PM4 = telemetry.metric_id("pm4_ugm3")
+M_PM10 = telemetry.metric_id("pm10_ugm3")
+M_NC05 = telemetry.metric_id("nc05_pcm3")
+M_NC1 = telemetry.metric_id("nc1_pcm3")
+M_NC25 = telemetry.metric_id("nc25_pcm3")
+M_NC4 = telemetry.metric_id("nc4_pcm3")
+M_NC10 = telemetry.metric_id("nc10_pcm3")
+M_TPS = telemetry.metric_id("tps_um")
+M_AQI_US = telemetry.metric_id("aqi_us")
+M_CO2 = telemetry.metric_id("co2_ppm")
+M_VOC_PPM = telemetry.metric_id("voc_ppm")
+M_VOC_INDEX = telemetry.metric_id("voc_index")
+M_TEMP = telemetry.metric_id("temp_c")
+M_RH = telemetry.metric_id("rh_pct")
+# Per-stage loop latency (ms histograms + max), heap watermarks and
+# stall budgets, resolved to IDs like metrics
+STAGES = ("lag", "sps30", "sht4x", "sgp40", "scd40", "display", "net", "ingest", "ntp", "gc")
+# A stage over budget stops the watchdog being fed (see stall.py). Display
+# init sleeps up to 5s; a full WiFi connect is bounded at 15s.
+STAGE_BUDGETS_S = {
+    "sps30": 5.0,
+    "sht4x": 1.0,
+    "sgp40": 1.0,
+    "scd40": 1.0,
+    "display": 10.0,
+    "net": 30.0,
+    "ingest": 3.0,
+    "ntp": 15.0,
+    "gc": 2.0,
+}
+heap = diagnostics.HeapMonitor(STAGES)
+stalls = stall.StallDetector(
+    STAGES,
+    STAGE_BUDGETS_S,
+    timeout_s=float(os.getenv("WATCHDOG_TIMEOUT_S") or stall.DEFAULT_WATCHDOG_TIMEOUT_S),
 )
-# Scheduling (monotonic timers)
-PM_EVERY_S = 5.0
+latency = diagnostics.LatencyStats(STAGES, heap=heap, stall=stalls, trace=trace)
+S_LAG = latency.stage_id("lag")
+S_SPS30 = latency.stage_id("sps30")
+S_SHT4X = latency.stage_id("sht4x")
+S_SGP40 = latency.stage_id("sgp40")
+S_SCD40 = latency.stage_id("scd40")
+S_DISPLAY = latency.stage_id("display")
+S_NET = latency.stage_id("net")
+S_INGEST = latency.stage_id("ingest")
+S_NTP = latency.stage_id("ntp")
+S_GC = latency.stage_id("gc")
+if trace is not None:
+    # Replay charges each sensor reading its recorded read time; other
+    # stages only go into the trace's periodic summaries (and slow runs).
+    trace.detail_stages = (S_SHT4X, S_SGP40, S_SCD40)
+
+def diagnostics_gauges():
+    return {"free_ram": gc.mem_free(), "rssi": net.rssi() if net else None}
+
+# Diagnostics go to their own endpoint (optional), never into ingest rows
+API_DIAGNOSTICS_URL = os.getenv("API_DIAGNOSTICS_URL")
+diag = diagnostics.DiagnosticsReporter(
+    latency,
+    url=API_DIAGNOSTICS_URL,
+    device_id=device_id,
+    device_secret=device_secret,
+    signer=tm.signer,
+    every_s=float(os.getenv("DIAGNOSTICS_EVERY_S") or diagnostics.DEFAULT_REPORT_EVERY_S),
+    gauges=diagnostics_gauges,
+    sources={"heap": heap, "stall": stalls},
+) if API_DIAGNOSTICS_URL and net else None
+if diag is None:
+    stalls.reset()  # logged at boot; nowhere to report it
+DIAGNOSTICS_OFFLINE_RECHECK_S = 60.0
+# Scheduling (timing ticks; each task sleeps until it is next due)
 SHT4X_EVERY_S = 60.0
 SHT4X_FIRST_DELAY_S = 5.0
 SGP40_EVERY_S = 5.0
@@ -133,21 +274,13 @@ SGP40_FIRST_DELAY_S = 7.0
 SCD40_EVERY_S = 5.0
 SCD40_FIRST_DELAY_S = 10.0
 PIXEL_EVERY_S = 5.0
-LOOP_SLEEP_S = 0.05
-TIME_SYNC_EVERY_S = 6 * 60 * 60
-SPS30_FAILURE_RESET_S = 30 * 60
-SPS30_MAX_FAILURES = 4
-DISPLAY_RETRY_EVERY_S = 2.0
+BLINK_PERIOD_S = 0.5
+OFFLINE_RECHECK_S = 1.0
+CLOCK_CHECK_EVERY_S = 60.0
+TIME_SYNC_RETRY_S = 30.0
+time_retry = retry.RetryPolicy("Time sync", base_s=TIME_SYNC_RETRY_S, max_s=30 * 60)
 
-next_pm = 0.0
-next_sht4x = 0.0
-next_sgp40 = 0.0
-next_scd40 = 0.0
-next_pixel = 0.0
-next_time = 0.0
 time_synced = False
-next_time_sync = 0.0
-next_display_init = 0.0
 last_pm25 = None
 last_aqi_us = None
 last_co2_ppm = None
@@ -155,8 +288,6 @@ last_temp_c = None
 last_rh_pct = None
 last_tvoc = None
 last_voc_index = None
-sps30_failures = 0
-last_sps30_failure_ts = None
 
 # ---------- I2C sensors ----------
 def init_i2c(board_type):
@@ -182,169 +313,356 @@ i2c = init_i2c(board_type)
 sht4x = adafruit_sht4x.SHT4x(i2c) if enable_sht4x else None
 sgp40 = adafruit_sgp40.SGP40(i2c) if enable_sgp40 else None
 scd40 = adafruit_scd4x.SCD4X(i2c) if enable_scd40 else None
-if enable_sht4x:
-    next_sht4x = time.monotonic() + SHT4X_FIRST_DELAY_S
-if enable_sgp40:
-    next_sgp40 = time.monotonic() + SGP40_FIRST_DELAY_S
 if enable_scd40 and scd40:
     print("Starting periodic measurement for SCD40")
     scd40.start_periodic_measurement()
-    next_scd40 = time.monotonic() + SCD40_FIRST_DELAY_S
 
-# ---------- Main loop ----------
-while True:
-    now = time.monotonic()
-
-    # keep blink animation responsive
-    init_display_if_needed(now)
-    if enable_display and wifi_icon:
-        wifi_icon.tick(now, period=0.5)
-
-    # --- WiFi state machine (non-blocking) ---
-    if enable_wifi and net and enable_display and wifi_icon:
-        st = net.tick(now)
-
-        # Only set state when it changes (otherwise blink never blinks)
-        if st != last_net_state:
-            if st == networking.NetState.INIT:
-                wifi_icon.set_state(display.WifiIcon.INIT)   # blinking
-            elif st == networking.NetState.ERROR:
-                wifi_icon.set_state(display.WifiIcon.ERROR)  # red + X
-            else:
-                wifi_icon.set_state(display.WifiIcon.OK)     # solid white
-            last_net_state = st
-
-        #Update telemetry
-        if st == networking.NetState.OK and net.requests:
-            tm.tick(net.requests, now=now)
+# ---------- Tasks ----------
+sched = scheduler.DeadlineScheduler(
+    light_sleep_min_s=LIGHT_SLEEP_MIN_S if enable_battery else None,
+    stats=latency,
+    lag_stage=S_LAG,
+)
 
-        if net.is_connected() and now >= next_time_sync:
+def show_dashboard(*args, **kwargs):
+    # display.update_dashboard, timed
+    t0 = latency.start(S_DISPLAY)
+    try:
+        display.update_dashboard(dashboard_labels, *args, **kwargs)
+    finally:
+        latency.stop(S_DISPLAY, t0)
+
+def idle_collect(stage, now):
+    # Planned GC at an idle point (a sensor cycle just finished), so
+    # collections don't land mid-redraw or mid-frame.
+    t0 = latency.start(S_GC)
+    if heap.collect(stage, now) is not None:
+        latency.stop(S_GC, t0)
+
+async def periodic(first_delay_s, every_s, job, stage=None):
+    # Runs job(now) on an anchored cadence so slow runs don't accumulate.
+    # With a stage, each run is followed by an idle-point collection.
+    due = timing.add_s(timing.ticks_ms(), first_delay_s)
+    while True:
+        await sched.sleep_until(due)
+        now = timing.ticks_ms()
+        if stage is None:
+            job(now)
+        else:
             try:
-                net.sync_time()
-                time_synced = True
-                if enable_display and time_label:
-                    display.update_time_label(time_label)
-                next_time_sync = now + TIME_SYNC_EVERY_S
-            except Exception as e:
-                print(f"Time sync failed: {e}")
-                next_time_sync = now + 30.0
-
+                job(now)
+            except MemoryError:
+                heap.memory_error(stage)
+            idle_collect(stage, now)
+        due = timing.add_s(due, every_s)
+        now = timing.ticks_ms()
+        if timing.due(now, due):
+            due = timing.add_s(now, every_s)
+
+_NET_ICON = {
+    networking.NetState.INIT: display.WifiIcon.INIT,   # blinking
+    networking.NetState.ERROR: display.WifiIcon.ERROR, # red + X
+    networking.NetState.OK: display.WifiIcon.OK,       # solid white
+}
+
+async def network_task():
+    # WiFi state machine + HTTP stepping (non-blocking)
+    global last_net_state
+    while True:
+        now = latency.start(S_NET)
+        oom = False
+        try:
+            st = net.tick(now)
+        except MemoryError:
+            heap.memory_error(S_NET)
+            oom = True
+        finally:
+            latency.stop(S_NET, now)
+        if oom:
+            await sched.sleep(OFFLINE_RECHECK_S)
+            continue
+        last_net_state = st
+        # Only set state when it changes (otherwise blink never blinks)
+        if wifi_icon and wifi_icon.state != _NET_ICON[st]:
+            wifi_icon.set_state(_NET_ICON[st])
+        await sched.sleep_until(net.next_due(now))
+
+async def clock_task():
+    # Ingest responses keep the clock estimate fresh; NTP only when
+    # they haven't (e.g. at boot or after a long outage).
+    global time_synced
+    while True:
+        now = timing.ticks_ms()
         if not net.is_connected():
-            time_synced = False
-            next_time_sync = 0.0
-
-    # --- NeoPixel rotation (scheduled) ---
-    if enable_pixel_wheel and now >= next_pixel:
-        next_pixel = now + PIXEL_EVERY_S
-        color_index = pixel_wheel.change(pixel, color_index)
-
-    # --- SPS30 read + display update (scheduled) ---
-    if enable_sps30 and now >= next_pm:
-        next_pm = now + PM_EVERY_S
-
+            # The estimate keeps running offline until it expires
+            time_synced = wall_clock.synced(now)
+            await sched.sleep(OFFLINE_RECHECK_S)
+            continue
+        delay = CLOCK_CHECK_EVERY_S
         try:
-            pm1, pm25, pm4, pm10 = sps30_uart.read_pm()
-            aqi_us = utils.aqi_us_from_pm25(pm25)
-            print(f"PM2.5={pm25:.1f} AQI_US={aqi_us} PM1={pm1:.1f} PM4={pm4:.1f} PM10={pm10:.1f}")
-            last_pm25 = pm25
-            last_aqi_us = aqi_us
-            now = time.monotonic()
-            tm.update_metric("pm25_ugm3", float(pm25), ts=now)
-            tm.update_metric("aqi_us", int(aqi_us), ts=now)
-
-            if enable_display and dashboard_labels:
-                display.update_dashboard(dashboard_labels, pm25, aqi_us, co2_ppm=last_co2_ppm)
-            sps30_failures = 0
-            last_sps30_failure_ts = None
+            if wall_clock.needs_ntp(now):
+                t0 = latency.start(S_NTP)
+                try:
+                    net.sync_time(clock=wall_clock)
+                finally:
+                    latency.stop(S_NTP, t0)
+                rtc_set = True
+            else:
+                rtc_set = wall_clock.sync_rtc(now)
+            time_synced = True
+            time_retry.success()
+            if rtc_set and enable_display and time_label:
+                show_time(now)
+        except Exception as e:
+            delay = time_retry.failure(now)
+            print(f"Time sync failed: {e}; next try in {delay:.0f}s")
+        await sched.sleep(delay)
+
+async def telemetry_task():
+    # Capture every post interval, upload while healthy
+    while True:
+        now = latency.start(S_INGEST)
+        online = net and last_net_state == networking.NetState.OK and net.http
+        oom = False
+        try:
+            sent = tm.tick(net.http if online else None, now=now)
+        except MemoryError:
+            heap.memory_error(S_INGEST)
+            oom = True
+        finally:
+            latency.stop(S_INGEST, now)
+        if oom:
+            await sched.sleep(OFFLINE_RECHECK_S)
+            continue
+        if sent is not None:
+            idle_collect(S_INGEST, now)
+        if online:
+            # A successful ingest doubles as the healthcheck.
+            if sent:
+                net.note_server_ok(now)
+            elif sent is not None:
+                net.note_server_error(now)
+            await sched.sleep_until(tm.next_due(now))
+        else:
+            await sched.sleep_until(timing.earliest(tm.next_due(now, online=False),
+                                                    timing.add_s(now, OFFLINE_RECHECK_S)))
+
+def show_time(now):
+    # The clock label by the wall-clock estimate (the RTC until there is one)
+    display.update_time_label(time_label, wall_clock.local_time(now))
+
+async def display_task():
+    # Display init retries, WiFi icon blink and the clock label. The label
+    # only shows HH:MM, so it is redrawn on the minute and battery builds
+    # can light-sleep in between.
+    next_time = None
+    while True:
+        now = latency.start(S_DISPLAY)
+        try:
+            init_display_if_needed(now)
+            if disp is not None:
+                if wifi_icon:
+                    wifi_icon.tick(now, period=BLINK_PERIOD_S)
+                if time_label and (next_time is None or timing.due(now, next_time)):
+                    next_time = wall_clock.next_minute(now)
+                    show_time(now)
+        finally:
+            latency.stop(S_DISPLAY, now)
+        if disp is None:
+            await sched.sleep_until(display_retry.next_attempt_at(now))
+            continue
+        due = next_time if next_time is not None else wall_clock.next_minute(now)
+        if wifi_icon and wifi_icon.state == display.WifiIcon.INIT:
+            due = timing.earliest(due, timing.add_s(now, BLINK_PERIOD_S))
+        await sched.sleep_until(due)
+
+async def diagnostics_task():
+    # Low-cadence stage latency / heap / RSSI report (not telemetry)
+    while True:
+        now = timing.ticks_ms()
+        if last_net_state == networking.NetState.OK and net.http:
+            diag.tick(net.http, now=now)
+            await sched.sleep_until(diag.next_due(now))
+        else:
+            diag.tick(None, now=now)
+            await sched.sleep(DIAGNOSTICS_OFFLINE_RECHECK_S)
+
+async def watchdog_task():
+    # Feeds the hardware watchdog through idle stretches; stages that keep
+    # to their budget feed it too (see stall.py)
+    stalls.start()
+    while True:
+        stalls.feed()
+        await sched.sleep(stall.FEED_EVERY_S)
+
+def rotate_pixel(now):
+    global color_index
+    color_index = pixel_wheel.change(pixel, color_index)
+
+async def sps30_task():
+    # SPS30 read + display update (split-phase)
+    global last_pm25, last_aqi_us
+    while True:
+        now = timing.ticks_ms()
+        if not sps30_retry.ready(now):
+            await sched.sleep_until(sps30_retry.next_attempt_at(now))
+            continue
+        try:
+            t0 = latency.start(S_SPS30)
+            try:
+                m = sps30_sched.tick(now)
+            finally:
+                latency.stop(S_SPS30, t0)
+            if m is not None:
+                pm25 = m.pm25
+                aqi_us = utils.aqi_us_from_pm25(pm25)
+                print(f"PM2.5={pm25:.1f} AQI_US={aqi_us} PM1={m.pm1:.1f} PM4={m.pm4:.1f} PM10={m.pm10:.1f}")
+                print(f"NC0.5={m.nc05:.1f} NC1={m.nc1:.1f} NC2.5={m.nc25:.1f} NC4={m.nc4:.1f} NC10={m.nc10:.1f} TPS={m.typical_size:.2f}um")
+                last_pm25 = pm25
+                last_aqi_us = aqi_us
+                now = timing.ticks_ms()
+                tm.update_metric(M_PM1, float(m.pm1), ts=now)
+                tm.update_metric(M_PM25, float(pm25), ts=now)
+                tm.update_metric(M_PM4, float(m.pm4), ts=now)
+                tm.update_metric(M_PM10, float(m.pm10), ts=now)
+                tm.update_metric(M_NC05, float(m.nc05), ts=now)
+                tm.update_metric(M_NC1, float(m.nc1), ts=now)
+                tm.update_metric(M_NC25, float(m.nc25), ts=now)
+                tm.update_metric(M_NC4, float(m.nc4), ts=now)
+                tm.update_metric(M_NC10, float(m.nc10), ts=now)
+                tm.update_metric(M_TPS, float(m.typical_size), ts=now)
+                tm.update_metric(M_AQI_US, int(aqi_us), ts=now)
+
+                if enable_display and dashboard_labels:
+                    show_dashboard(
+                        pm25, aqi_us, co2_ppm=last_co2_ppm, pm1=m.pm1, pm10=m.pm10
+                    )
+                sps30_retry.success()
+                idle_collect(S_SPS30, now)
         except Exception as exc:
-            if last_sps30_failure_ts is not None and (now - last_sps30_failure_ts) >= SPS30_FAILURE_RESET_S:
-                sps30_failures = 0
-            sps30_failures += 1
-            last_sps30_failure_ts = now
-            print(f"SPS30 read failed ({sps30_failures}): {exc}")
+            if isinstance(exc, MemoryError):
+                heap.memory_error(S_SPS30)
+            delay = sps30_retry.failure(now)
+            print(f"SPS30 read failed ({sps30_retry.failures}): {exc}; next try in {delay:.0f}s")
             last_pm25 = None
             last_aqi_us = None
             if enable_display and dashboard_labels:
-                display.update_dashboard(dashboard_labels, pm25=None, aqi=None, co2_ppm=last_co2_ppm)
-            if sps30_failures >= SPS30_MAX_FAILURES:
-                print("Disabling SPS30 after repeated failures.")
-                enable_sps30 = False
-
-    # --- SHT4x read + serial log (scheduled) ---
-    if enable_sht4x and sht4x and now >= next_sht4x:
-        next_sht4x = now + SHT4X_EVERY_S
+                show_dashboard(pm25=None, aqi=None, co2_ppm=last_co2_ppm)
+            continue
+        await sched.sleep_until(sps30_sched.next_due(now))
+
+def read_sht4x(now):
+    # SHT4x read + serial log
+    global last_temp_c, last_rh_pct
+    t0 = latency.start(S_SHT4X)
+    try:
         temp_c = sht4x.temperature
         rh_pct = sht4x.relative_humidity
-        print(f"Temp={temp_c:.2f}C RH={rh_pct:.1f}%")
-        last_temp_c = temp_c
-        last_rh_pct = rh_pct
-        tm.update_metric("temp_c", float(temp_c), ts=now)
-        tm.update_metric("rh_pct", float(rh_pct), ts=now)
-        if enable_display and dashboard_labels:
-            display.update_dashboard(
-                dashboard_labels,
-                pm25=last_pm25,
-                aqi=last_aqi_us,
-                co2_ppm=last_co2_ppm,
-                temp_c=temp_c,
-                rh_pct=rh_pct,
-            )
-
-    # --- SGP40 read + serial log (scheduled) ---
-    if enable_sgp40 and sgp40 and now >= next_sgp40:
-        next_sgp40 = now + SGP40_EVERY_S
-        comp_temp = last_temp_c if last_temp_c is not None else 25.0
-        comp_rh = last_rh_pct if last_rh_pct is not None else 50.0
+    finally:
+        latency.stop(S_SHT4X, t0)
+    if trace is not None:
+        trace.reading(fieldtrace.SHT4X, (temp_c, rh_pct))
+    print(f"Temp={temp_c:.2f}C RH={rh_pct:.1f}%")
+    last_temp_c = temp_c
+    last_rh_pct = rh_pct
+    tm.update_metric(M_TEMP, float(temp_c), ts=now)
+    tm.update_metric(M_RH, float(rh_pct), ts=now)
+    if enable_display and dashboard_labels:
+        show_dashboard(
+            pm25=last_pm25,
+            aqi=last_aqi_us,
+            co2_ppm=last_co2_ppm,
+            temp_c=temp_c,
+            rh_pct=rh_pct,
+        )
+
+def read_sgp40(now):
+    # SGP40 read + serial log
+    global last_tvoc, last_voc_index
+    comp_temp = last_temp_c if last_temp_c is not None else 25.0
+    comp_rh = last_rh_pct if last_rh_pct is not None else 50.0
+    t0 = latency.start(S_SGP40)
+    try:
         voc_index = sgp40.measure_index(temperature=comp_temp, relative_humidity=comp_rh)
-        tvoc_ppm = voc_index_to_tvoc_ethanol_ppm(voc_index)
-        print(f"TVOC={tvoc_ppm:.3f}ppm VOC_INDEX={voc_index}")
-        last_tvoc = tvoc_ppm
-        last_voc_index = voc_index
-        tm.update_metric("voc_ppm", float(tvoc_ppm), ts=now)
-        tm.update_metric("voc_index", int(voc_index), ts=now)
-        if enable_display and dashboard_labels:
-            display.update_dashboard(
-                dashboard_labels,
-                pm25=last_pm25,
-                aqi=last_aqi_us,
-                co2_ppm=last_co2_ppm,
-                temp_c=last_temp_c,
-                rh_pct=last_rh_pct,
-                tvoc=tvoc_ppm,
-                voc_index=voc_index,
-            )
-
-    # --- SCD40 read + serial log (scheduled) ---
-    if enable_scd40 and scd40 and now >= next_scd40:
-        next_scd40 = now + SCD40_EVERY_S
-        if scd40.data_ready:
+    finally:
+        latency.stop(S_SGP40, t0)
+    if trace is not None:
+        trace.reading(fieldtrace.SGP40, (voc_index,))
+    tvoc_ppm = voc_index_to_tvoc_ethanol_ppm(voc_index)
+    print(f"TVOC={tvoc_ppm:.3f}ppm VOC_INDEX={voc_index}")
+    last_tvoc = tvoc_ppm
+    last_voc_index = voc_index
+    tm.update_metric(M_VOC_PPM, float(tvoc_ppm), ts=now)
+    tm.update_metric(M_VOC_INDEX, int(voc_index), ts=now)
+    if enable_display and dashboard_labels:
+        show_dashboard(
+            pm25=last_pm25,
+            aqi=last_aqi_us,
+            co2_ppm=last_co2_ppm,
+            temp_c=last_temp_c,
+            rh_pct=last_rh_pct,
+            tvoc=tvoc_ppm,
+            voc_index=voc_index,
+        )
+
+def read_scd40(now):
+    # SCD40 read + serial log
+    global last_co2_ppm, last_temp_c, last_rh_pct
+    t0 = latency.start(S_SCD40)
+    try:
+        ready = scd40.data_ready
+        if ready:
             co2 = scd40.CO2
             scd_temp_c = scd40.temperature
             scd_rh_pct = scd40.relative_humidity
-            print(f"SCD40 CO2={co2}ppm Temp={scd_temp_c:.2f}C RH={scd_rh_pct:.1f}%")
-            last_co2_ppm = co2
-            tm.update_metric("co2_ppm", int(co2), ts=now)
-            if not enable_sht4x:
-                last_temp_c = scd_temp_c
-                last_rh_pct = scd_rh_pct
-                tm.update_metric("temp_c", float(scd_temp_c), ts=now)
-                tm.update_metric("rh_pct", float(scd_rh_pct), ts=now)
-            if enable_display and dashboard_labels:
-                display.update_dashboard(
-                    dashboard_labels,
-                    pm25=last_pm25,
-                    aqi=last_aqi_us,
-                    co2_ppm=co2,
-                    temp_c=last_temp_c,
-                    rh_pct=last_rh_pct,
-                    tvoc=last_tvoc,
-                    voc_index=last_voc_index,
-                )
-        else:
-            print(f"SCD40 is not data_ready!")
-
-    if enable_display and time_label and now >= next_time:
-        next_time = now + 1.0
-        display.update_time_label(time_label)
+    finally:
+        latency.stop(S_SCD40, t0)
+    if not ready:
+        print(f"SCD40 is not data_ready!")
+        return
+    if trace is not None:
+        trace.reading(fieldtrace.SCD40, (co2, scd_temp_c, scd_rh_pct))
+    print(f"SCD40 CO2={co2}ppm Temp={scd_temp_c:.2f}C RH={scd_rh_pct:.1f}%")
+    last_co2_ppm = co2
+    tm.update_metric(M_CO2, int(co2), ts=now)
+    if not enable_sht4x:
+        last_temp_c = scd_temp_c
+        last_rh_pct = scd_rh_pct
+        tm.update_metric(M_TEMP, float(scd_temp_c), ts=now)
+        tm.update_metric(M_RH, float(scd_rh_pct), ts=now)
+    if enable_display and dashboard_labels:
+        show_dashboard(
+            pm25=last_pm25,
+            aqi=last_aqi_us,
+            co2_ppm=co2,
+            temp_c=last_temp_c,
+            rh_pct=last_rh_pct,
+            tvoc=last_tvoc,
+            voc_index=last_voc_index,
+        )
 
-    time.sleep(LOOP_SLEEP_S)
+# ---------- Main loop ----------
+async def main():
+    tasks = [sched.spawn(watchdog_task()), sched.spawn(telemetry_task())]
+    if net:
+        tasks.append(sched.spawn(network_task()))
+        tasks.append(sched.spawn(clock_task()))
+    if diag:
+        tasks.append(sched.spawn(diagnostics_task()))
+    if enable_display:
+        tasks.append(sched.spawn(display_task()))
+    if enable_pixel_wheel:
+        tasks.append(sched.spawn(periodic(0.0, PIXEL_EVERY_S, rotate_pixel)))
+    if enable_sps30:
+        tasks.append(sched.spawn(sps30_task()))
+    if enable_sht4x and sht4x:
+        tasks.append(sched.spawn(periodic(SHT4X_FIRST_DELAY_S, SHT4X_EVERY_S, read_sht4x, S_SHT4X)))
+    if enable_sgp40 and sgp40:
+        tasks.append(sched.spawn(periodic(SGP40_FIRST_DELAY_S, SGP40_EVERY_S, read_sgp40, S_SGP40)))
+    if enable_scd40 and scd40:
+        tasks.append(sched.spawn(periodic(SCD40_FIRST_DELAY_S, SCD40_EVERY_S, read_scd40, S_SCD40)))
+    if trace is not None:
+        tasks.append(sched.spawn(periodic(fieldtrace.FLUSH_EVERY_S, fieldtrace.FLUSH_EVERY_S, trace.flush)))
+    await asyncio.gather(*tasks)
+
+asyncio.run(main())
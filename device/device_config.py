@@ -10,6 +10,12 @@ DEFAULT_CONFIG = {
     "enable_sgp40": True,
     "enable_scd40": True,
     "enable_battery": True,
+    # SPS30 cadence. Duty cycling sleeps the sensor between samples and
+    # wakes it sps30_warmup_s early; only worthwhile for long intervals.
+    "sps30_sample_every_s": 5.0,
+    "sps30_duty_cycle": False,
+    "sps30_warmup_s": 30.0,
+    "sps30_clean_every_s": 7 * 24 * 60 * 60,
 }
 
 DEVICE_CONFIGS = {
@@ -26,6 +32,8 @@ DEVICE_CONFIGS = {
         "enable_sgp40": True,
         "enable_scd40": False,
         "enable_battery": False,
+        "sps30_sample_every_s": 5.0,
+        "sps30_duty_cycle": False,
     },
    "murali-living-room": {
         "board_type": "waveshare_s3_lcd_28",
@@ -39,6 +47,8 @@ DEVICE_CONFIGS = {
         "enable_sgp40": False,
         "enable_scd40": True,
         "enable_battery": False,
+        "sps30_sample_every_s": 5.0,
+        "sps30_duty_cycle": False,
     },
 }
 
@@ -0,0 +1,374 @@
+# diagnostics.py
+import gc
+import json
+import array
+
+import timing
+from retry import RetryPolicy
+from http_client import STEP_EVERY_S
+from telemetry import IngestClient
+
+# Upper bounds (ms) of the latency histogram buckets; one more bucket
+# counts everything slower.
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+N_BUCKETS = len(BUCKETS_MS) + 1
+DEFAULT_REPORT_EVERY_S = 15 * 60
+# Failed uploads retry sooner than the report cadence
+REPORT_RETRY_S = 60.0
+# Idle-point collections are spaced at least this far apart
+GC_EVERY_S = 10.0
+# Largest-free-block probes (trial allocations) run at most this often and
+# look no further than PROBE_MAX_BYTES, which covers a TLS handshake.
+PROBE_EVERY_S = 60.0
+PROBE_MIN_BYTES = 256
+PROBE_MAX_BYTES = 64 * 1024
+# Warn when the largest free block falls below this
+LOW_BLOCK_BYTES = 16 * 1024
+
+
+def _int_array(n, fill=0):
+    a = array.array("i", bytes(4 * n))
+    if fill:
+        for i in range(n):
+            a[i] = fill
+    return a
+
+
+def _recent(now, t, window_s):
+    # A tick that aged past the wrap reads as negative: treat it as old.
+    return t is not None and 0 <= timing.diff_s(now, t) < window_s
+
+
+def largest_free_block(limit=PROBE_MAX_BYTES):
+    """
+    Size of the largest bytearray that can be allocated right now (to
+    PROBE_MIN_BYTES), found by trial allocation; capped at limit.
+    CircuitPython has no API for it, and fragmentation, not total free
+    heap, is what makes a large allocation fail.
+    """
+    try:
+        buf = bytearray(limit)
+        del buf
+        return limit
+    except MemoryError:
+        pass
+    lo, hi = 0, limit
+    while hi - lo > PROBE_MIN_BYTES:
+        mid = (lo + hi) // 2
+        try:
+            buf = bytearray(mid)
+            del buf
+            lo = mid
+        except MemoryError:
+            hi = mid
+    return lo
+
+
+class LatencyStats:
+    """
+    Fixed-bucket latency histograms and max values per main-loop stage,
+    held in arrays allocated once so recording never allocates.
+
+    Stages are named once at construction; callers resolve them to IDs
+    with stage_id() and then time work with:
+        t0 = stats.start(S_STAGE)
+        ...
+        stats.stop(S_STAGE, t0)
+    """
+    def __init__(self, stages, heap=None, stall=None, trace=None):
+        self.stages = tuple(stages)
+        self.heap = heap        # HeapMonitor sampled after each stop()
+        self.stall = stall      # stall.StallDetector told about each stop()
+        self.trace = trace      # fieldtrace.TraceRecorder logging each stop()
+        self._ids = {name: i for i, name in enumerate(self.stages)}
+        n = len(self.stages)
+        self.counts = array.array("i", bytes(4 * n * N_BUCKETS))
+        self.max_ms = array.array("i", bytes(4 * n))
+        self.total_ms = array.array("i", bytes(4 * n))
+
+    def stage_id(self, name):
+        return self._ids[name]
+
+    def add(self, stage, ms):
+        if ms < 0:
+            ms = 0
+        b = 0
+        while b < N_BUCKETS - 1 and ms > BUCKETS_MS[b]:
+            b += 1
+        self.counts[stage * N_BUCKETS + b] += 1
+        if ms > self.max_ms[stage]:
+            self.max_ms[stage] = ms
+        self.total_ms[stage] += ms
+
+    def start(self, stage):
+        """
+        Returns the start tick for stop().
+        """
+        return timing.ticks_ms()
+
+    def stop(self, stage, t0, now=None):
+        """
+        Records the time since tick t0 against stage; returns it in ms.
+        """
+        if now is None:
+            now = timing.ticks_ms()
+        ms = timing.ticks_diff(now, t0)
+        self.add(stage, ms)
+        if self.heap is not None:
+            self.heap.sample(stage)
+        if self.stall is not None:
+            self.stall.exit(stage, ms)
+        if self.trace is not None:
+            self.trace.stage(stage, ms, now)
+        return ms
+
+    def count(self, stage):
+        base = stage * N_BUCKETS
+        n = 0
+        for b in range(N_BUCKETS):
+            n += self.counts[base + b]
+        return n
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        for i in range(len(self.stages)):
+            self.max_ms[i] = 0
+            self.total_ms[i] = 0
+
+    def as_dict(self):
+        """
+        {stage: {"n", "max_ms", "avg_ms", "hist"}} for stages that ran.
+        """
+        out = {}
+        for s, name in enumerate(self.stages):
+            n = self.count(s)
+            if not n:
+                continue
+            base = s * N_BUCKETS
+            out[name] = {
+                "n": n,
+                "max_ms": self.max_ms[s],
+                "avg_ms": self.total_ms[s] // n,
+                "hist": list(self.counts[base:base + N_BUCKETS]),
+            }
+        return out
+
+
+class HeapMonitor:
+    """
+    Free-heap and largest-free-block low watermarks per main-loop stage
+    (same stage IDs as LatencyStats), plus planned garbage collection.
+
+    sample(stage) is cheap (gc.mem_free()) and runs after every timed
+    stage. collect(stage) is meant for idle points, e.g. right after a
+    sensor cycle: it runs gc.collect() there (at most every gc_every_s)
+    so collections rarely land in the middle of a display refresh or a
+    UART frame, and now and then probes the largest free block.
+    memory_error(stage) counts MemoryErrors the caller survived, so they
+    are reported before one takes a device down.
+    """
+    def __init__(self, stages, gc_every_s=GC_EVERY_S, probe_every_s=PROBE_EVERY_S, debug=True):
+        self.stages = tuple(stages)
+        self.gc_every_s = float(gc_every_s)
+        self.probe_every_s = float(probe_every_s)
+        self.debug = debug
+        n = len(self.stages)
+        self.free_min = _int_array(n, -1)       # -1 = not sampled yet
+        self.largest_min = _int_array(n, -1)
+        self.mem_errors = _int_array(n)
+        self.largest = -1                       # last probe
+        self.free_after_gc_min = -1             # trend of the live heap
+        self.gc_n = 0
+        self.gc_max_ms = 0
+        self.gc_total_ms = 0
+        self._last_gc = None                    # ticks; None = never
+        self._last_probe = None
+
+    def _log(self, msg):
+        if self.debug:
+            print(msg)
+
+    def sample(self, stage):
+        free = gc.mem_free()
+        low = self.free_min[stage]
+        if low < 0 or free < low:
+            self.free_min[stage] = free
+        return free
+
+    def collect(self, stage, now=None):
+        """
+        Collects if none ran in the last gc_every_s; returns the pause in
+        ms, or None if it was skipped.
+        """
+        if now is None:
+            now = timing.ticks_ms()
+        if _recent(now, self._last_gc, self.gc_every_s):
+            return None
+        t0 = timing.ticks_ms()
+        gc.collect()
+        end = timing.ticks_ms()
+        ms = timing.ticks_diff(end, t0)
+        self._last_gc = end
+        self.gc_n += 1
+        self.gc_total_ms += ms
+        if ms > self.gc_max_ms:
+            self.gc_max_ms = ms
+
+        free = gc.mem_free()
+        if self.free_after_gc_min < 0 or free < self.free_after_gc_min:
+            self.free_after_gc_min = free
+        if not _recent(end, self._last_probe, self.probe_every_s):
+            self._last_probe = end
+            self.largest = largest = largest_free_block()
+            low = self.largest_min[stage]
+            if low < 0 or largest < low:
+                self.largest_min[stage] = largest
+            if largest < LOW_BLOCK_BYTES:
+                self._log("Heap fragmented: largest free block %d bytes (%d free)" % (largest, free))
+        return ms
+
+    def memory_error(self, stage):
+        self.mem_errors[stage] += 1
+        self._log("MemoryError in %s (%d so far)" % (self.stages[stage], self.mem_errors[stage]))
+        gc.collect()
+
+    def reset(self):
+        for i in range(len(self.stages)):
+            self.free_min[i] = -1
+            self.largest_min[i] = -1
+            self.mem_errors[i] = 0
+        self.free_after_gc_min = -1
+        self.gc_n = 0
+        self.gc_max_ms = 0
+        self.gc_total_ms = 0
+
+    def as_dict(self):
+        stages = {}
+        for s, name in enumerate(self.stages):
+            if self.free_min[s] < 0 and not self.mem_errors[s]:
+                continue
+            d = {"free_min": self.free_min[s]}
+            if self.largest_min[s] >= 0:
+                d["largest_min"] = self.largest_min[s]
+            if self.mem_errors[s]:
+                d["mem_errors"] = self.mem_errors[s]
+            stages[name] = d
+        return {
+            "free": gc.mem_free(),
+            "free_after_gc_min": self.free_after_gc_min,
+            "largest_block": self.largest,
+            "gc_n": self.gc_n,
+            "gc_max_ms": self.gc_max_ms,
+            "gc_avg_ms": self.gc_total_ms // self.gc_n if self.gc_n else 0,
+            "stages": stages,
+        }
+
+
+class DiagnosticsReporter:
+    """
+    Posts a low-cadence diagnostics payload (stage latencies, loop lag,
+    heap watermarks, free RAM, RSSI) to its own endpoint. It is signed like ingest bodies
+    but is not telemetry: it never goes through MetricStore/ALLOWED_FIELDS.
+    Histograms are reset after each successful upload, so every payload
+    covers the interval since the previous one.
+
+    gauges() (optional) returns a dict of point-in-time values sampled
+    when a report is built, e.g. {"free_ram": ..., "rssi": ...}. sources
+    maps payload keys to objects with as_dict() (None = leave out) and
+    reset(), called once their data has been delivered, e.g.
+    {"heap": HeapMonitor, "stall": StallDetector}.
+    """
+    def __init__(self, stats, url, device_id, device_secret, signer=None,
+                 every_s=DEFAULT_REPORT_EVERY_S, gauges=None, sources=None, debug=True):
+        self.stats = stats
+        self.sources = sources or {}
+        self.gauges = gauges
+        self.every_s = float(every_s)
+        self.debug = debug
+        self._client = IngestClient(
+            http=None,
+            ingest_url=url,
+            device_id=device_id,
+            device_secret=device_secret,
+            signer=signer,
+        )
+        self.retry = RetryPolicy("Diagnostics", base_s=REPORT_RETRY_S, max_s=self.every_s, debug=debug)
+        now = timing.ticks_ms()
+        self._next_report = timing.add_s(now, self.every_s)  # ticks; None = now
+        self._last_tick = now
+        self._interval_s = 0.0  # covered by the current histograms
+        self._body = None
+
+    def _log(self, msg):
+        if self.debug:
+            print(msg)
+
+    def _payload(self):
+        payload = {
+            "interval_s": int(self._interval_s),
+            "buckets_ms": list(BUCKETS_MS),
+            "stages": self.stats.as_dict(),
+        }
+        for key, source in self.sources.items():
+            data = source.as_dict()
+            if data is not None:
+                payload[key] = data
+        if self.gauges is not None:
+            payload.update(self.gauges())
+        return payload
+
+    def tick(self, http, now=None):
+        """
+        Starts a report when one is due and http is idle; finishes it on
+        later ticks. Returns None unless an upload finished this tick,
+        else whether it succeeded. Call at least every few minutes, also
+        while offline.
+        """
+        if now is None:
+            now = timing.ticks_ms()
+        self._interval_s += timing.diff_s(now, self._last_tick)
+        self._last_tick = now
+        if self._next_report is not None and timing.due(now, self._next_report):
+            self._next_report = None   # passed; don't let it age into a wrap
+        self.retry.expire(now)
+
+        client = self._client
+        if client.busy():
+            result = client.poll()
+            if result is None:
+                return None
+            self._body = None
+            ok = result[0]
+            if ok:
+                self.retry.success()
+                self.stats.reset()
+                for source in self.sources.values():
+                    source.reset()
+                self._interval_s = 0.0
+                self._next_report = timing.add_s(now, self.every_s)
+                self._log("Diagnostics sent")
+            else:
+                delay = self.retry.failure(now)
+                self._log("Diagnostics failed; retry in %ds" % delay)
+            return ok
+
+        if http is None or self._next_report is not None or not self.retry.ready(now):
+            return None
+        if http.state != http.IDLE:
+            return None
+        client.http = http
+        self._body = json.dumps(self._payload()).encode("utf-8")
+        client.start(self._body, now=now)
+        return None
+
+    def next_due(self, now=None):
+        if now is None:
+            now = timing.ticks_ms()
+        if self._client.busy():
+            return timing.add_s(now, STEP_EVERY_S)
+        # At least one step out: tick() may have found the client busy.
+        due = timing.latest(self.retry.next_attempt_at(now), timing.add_s(now, STEP_EVERY_S))
+        if self._next_report is not None:
+            due = timing.latest(due, self._next_report)
+        return due
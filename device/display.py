@@ -5,6 +5,7 @@ import displayio
 import fourwire
 import terminalio
 import utils
+import timing
 import pwmio
 import digitalio
 from adafruit_display_text import label
@@ -269,7 +270,7 @@ class WifiIcon:
 
         self.state = WifiIcon.INIT
         self._blink_on = True
-        self._last_blink = time.monotonic()
+        self._last_blink = timing.ticks_ms()
 
         self.set_state(WifiIcon.INIT)
 
@@ -281,7 +282,7 @@ class WifiIcon:
             self.x_tg.hidden = True
             self.wifi_tg.hidden = False
             self._blink_on = True
-            self._last_blink = time.monotonic()
+            self._last_blink = timing.ticks_ms()
 
         elif state == WifiIcon.ERROR:
             self.pal[1] = 0xFF0000
@@ -297,8 +298,8 @@ class WifiIcon:
         if self.state != WifiIcon.INIT:
             return
         if now is None:
-            now = time.monotonic()
-        if now - self._last_blink >= period:
+            now = timing.ticks_ms()
+        if timing.diff_s(now, self._last_blink) >= period:
             self._last_blink = now
             self._blink_on = not self._blink_on
             self.wifi_tg.hidden = not self._blink_on
@@ -553,13 +554,19 @@ def make_dashboard(
         labels[f"{key}_label"] = label_item
         labels[f"{key}_value"] = value_item
 
+    if enabled_sps30:
+        # Secondary PM channels share the bottom line with the time label.
+        pm_detail = _make_label(" ", 0xFFFFFF, 1, (0.0, 1.0), (4, display_height - 4))
+        group.append(pm_detail)
+        labels["pm_detail"] = pm_detail
+
     for item in (aqi_title, aqi_value, aqi_desc):
         group.append(item)
 
     return group, labels, wifi_icon, battery_icon
 
 
-def update_dashboard(labels, pm25=None, aqi=None, co2_ppm=None, temp_c=None, rh_pct=None, tvoc=None, voc_index=None):
+def update_dashboard(labels, pm25=None, aqi=None, co2_ppm=None, temp_c=None, rh_pct=None, tvoc=None, voc_index=None, pm1=None, pm10=None):
     color = None
     if aqi is not None:
         color, desc = utils.get_classification_from_aqi(int(aqi))
@@ -592,6 +599,12 @@ def update_dashboard(labels, pm25=None, aqi=None, co2_ppm=None, temp_c=None, rh_
                 labels["pm25_value"].color = color
                 labels["pm25_unit"].color = color
 
+    if "pm_detail" in labels:
+        if pm25 is None:
+            labels["pm_detail"].text = " "
+        elif pm1 is not None and pm10 is not None:
+            labels["pm_detail"].text = f"PM1 {pm1:.0f}  PM10 {pm10:.0f}"
+
     if co2_ppm is not None and "co2_label" in labels:
         co2_color, _ = utils.get_classification_from_co2(int(round(co2_ppm)))
         labels["co2_label"].color = co2_color
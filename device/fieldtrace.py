@@ -0,0 +1,400 @@
+# fieldtrace.py
+import struct
+
+import timing
+
+# Capture of what the device saw in the field (raw SPS30 UART bytes, I2C
+# readings, network results, stage timings), written compactly to flash
+# so tools/sim can replay it on a host. Stage timings are mostly kept as
+# per-flush summaries: one record per loop wake would fill the file in
+# about an hour.
+#
+# File: one segment per boot, appended. A segment is a header
+#   "AQTR", version (u8), ticks at start (u32 LE)
+# followed by records
+#   kind (u8), ms since the previous record (varint), length (varint), payload
+MAGIC = b"AQTR"
+VERSION = 1
+_HEADER = "<4sBI"
+HEADER_LEN = struct.calcsize(_HEADER)
+
+# Record kinds
+UART = 1        # bytes the SPS30 decoder read from its UART
+READING = 2     # sensor (u8), values (f32 each)
+HTTP = 3        # status (i16, -1 = failed), path length (u8), path, body or error text
+WIFI = 4        # event (u8), error text
+STAGE = 5       # stage (u8), duration ms (varint)
+NTP = 6         # unix time (u32)
+NOTE = 7        # text
+STAGES = 8      # per stage timed since the last summary: stage (u8), then
+                # count, total ms, max ms (varints)
+
+# READING sensors
+SHT4X = 0       # temperature C, RH %
+SGP40 = 1       # VOC index
+SCD40 = 2       # CO2 ppm, temperature C, RH %
+
+# WIFI events
+WIFI_FAILED = 0
+WIFI_CONNECTED = 1
+WIFI_LOST = 2
+
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_BUF_SIZE = 2048
+# How often the owner should flush(): writes the stage summary, and the
+# buffer to flash (a full buffer is written sooner). Also bounds what a
+# reset loses.
+FLUSH_EVERY_S = 120.0
+# Stage timings at least this long get a STAGE record of their own
+DETAIL_MS = 100
+# Longest HTTP body / error text kept per record
+MAX_TEXT = 255
+# Stage IDs the summary has room for
+MAX_STAGES = 32
+
+_VARINT_MAX = 5
+
+_READING_FMT = ("<B", "<Bf", "<Bff", "<Bfff")
+
+
+def _varint_len(value):
+    n = 1
+    while value >= 0x80:
+        value >>= 7
+        n += 1
+    return n
+
+
+def _put_varint(buf, at, value):
+    while value >= 0x80:
+        buf[at] = (value & 0x7F) | 0x80
+        value >>= 7
+        at += 1
+    buf[at] = value
+    return at + 1
+
+
+class TraceRecorder:
+    """
+    Appends trace records to a RAM buffer that flush() writes to path.
+    Records are encoded straight into the buffer; only flush() touches the
+    filesystem, so call it from an idle point. Stops (with a NOTE) once
+    the file reaches max_bytes. The filesystem must be writable by code,
+    see boot.py.
+
+    Stage timings are summed per stage and written as a STAGES record on
+    each flush(). Stages in detail_stages, and any timing of at least
+    detail_ms, also get a STAGE record each.
+    """
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, buf_size=DEFAULT_BUF_SIZE,
+                 detail_stages=(), detail_ms=DETAIL_MS, debug=True):
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self.detail_stages = detail_stages
+        self.detail_ms = detail_ms
+        self.debug = debug
+        self._stage_n = [0] * MAX_STAGES
+        self._stage_total = [0] * MAX_STAGES
+        self._stage_max = [0] * MAX_STAGES
+        self._buf = bytearray(buf_size)
+        self._mv = memoryview(self._buf)
+        self._n = 0
+        self._f = None
+        self.written = 0
+        self.dropped = 0        # records lost to a full trace or a write error
+        self.enabled = False
+        self._last = timing.ticks_ms()
+        try:
+            self._f = open(path, "ab")
+            self._f.seek(0, 2)
+            self.written = self._f.tell()
+        except OSError as e:
+            self._log(f"Trace disabled: can't write {path} ({e}); see boot.py")
+            return
+        if self.written + HEADER_LEN >= self.max_bytes:
+            self._log(f"Trace {path} is full ({self.written} bytes)")
+            self.close()
+            return
+        self.enabled = True
+        struct.pack_into(_HEADER, self._buf, 0, MAGIC, VERSION, self._last)
+        self._n = HEADER_LEN
+        self._log(f"Tracing to {path} ({self.written} bytes so far)")
+
+    def _log(self, msg):
+        if self.debug:
+            print(msg)
+
+    def _room(self, n):
+        if self._n + n > len(self._buf):
+            self._drain()
+
+    def _put(self, data):
+        self._room(len(data))
+        if len(data) > len(self._buf):
+            self._write(data)
+            return
+        n = self._n
+        self._buf[n:n + len(data)] = data
+        self._n = n + len(data)
+
+    def _head(self, kind, length, now):
+        if now is None:
+            now = timing.ticks_ms()
+        dt = timing.ticks_diff(now, self._last)
+        if dt < 0:
+            dt = 0  # caller's tick predates the last record
+        else:
+            self._last = now
+        self._room(1 + 2 * _VARINT_MAX)
+        buf = self._buf
+        n = self._n
+        buf[n] = kind
+        n = _put_varint(buf, n + 1, dt)
+        self._n = _put_varint(buf, n, length)
+
+    def _record(self, kind, length, now):
+        """
+        Writes a record header for length payload bytes; returns False
+        (nothing written) if the trace is off or full.
+        """
+        if not self.enabled:
+            self.dropped += 1
+            return False
+        # Keep room for the closing NOTE
+        if self.written + self._n + length + 2 * (1 + 2 * _VARINT_MAX) + MAX_TEXT > self.max_bytes:
+            self._stop("trace full", now)
+            self.dropped += 1
+            return False
+        self._head(kind, length, now)
+        return True
+
+    def _stop(self, why, now=None):
+        note = why.encode("utf-8")
+        self._head(NOTE, len(note), now)
+        self._put(note)
+        self._drain()
+        self.enabled = False
+        self._log(f"Trace stopped: {why}")
+
+    def _write(self, data):
+        if self._f is None:
+            return
+        try:
+            self._f.write(data)
+            self._f.flush()
+            self.written += len(data)
+        except OSError as e:
+            self._log(f"Trace write failed: {e}; tracing off")
+            self.enabled = False
+            self.close()
+
+    def _drain(self):
+        n = self._n
+        if n:
+            self._n = 0
+            self._write(self._mv[:n])
+
+    def flush(self, now=None):
+        """
+        Writes the stage summary, then buffered records, to the file
+        (periodic()).
+        """
+        self._summary(now)
+        self._drain()
+
+    def _summary(self, now):
+        counts = self._stage_n
+        totals = self._stage_total
+        maxes = self._stage_max
+        size = 0
+        for stage in range(MAX_STAGES):
+            if counts[stage]:
+                size += 1 + _varint_len(counts[stage]) + _varint_len(totals[stage]) + _varint_len(maxes[stage])
+        if not size or not self._record(STAGES, size, now):
+            return
+        self._room(size)
+        buf = self._buf
+        n = self._n
+        for stage in range(MAX_STAGES):
+            if counts[stage]:
+                buf[n] = stage
+                n = _put_varint(buf, n + 1, counts[stage])
+                n = _put_varint(buf, n, totals[stage])
+                n = _put_varint(buf, n, maxes[stage])
+                counts[stage] = totals[stage] = maxes[stage] = 0
+        self._n = n
+
+    def close(self):
+        f = self._f
+        self._f = None
+        if f is not None:
+            try:
+                f.close()
+            except OSError:
+                pass
+
+    # ---- records ----
+
+    def uart(self, data, now=None):
+        """
+        Bytes the SPS30 FrameDecoder just read (its tap).
+        """
+        if self._record(UART, len(data), now):
+            self._put(data)
+
+    def reading(self, sensor, values, now=None):
+        size = 1 + 4 * len(values)
+        if self._record(READING, size, now):
+            self._room(size)
+            struct.pack_into(_READING_FMT[len(values)], self._buf, self._n, sensor, *values)
+            self._n += size
+
+    def http(self, client, now=None):
+        """
+        Result of a finished http_client.HttpClient request (its tap).
+        """
+        path = client.path.encode("utf-8")[:MAX_TEXT]
+        if client.state == client.DONE:
+            status = client.status
+            text = client.body()[:MAX_TEXT]
+        else:
+            status = -1
+            text = str(client.error).encode("utf-8")[:MAX_TEXT]
+        if self._record(HTTP, 3 + len(path) + len(text), now):
+            self._room(3)
+            struct.pack_into("<hB", self._buf, self._n, status, len(path))
+            self._n += 3
+            self._put(path)
+            self._put(text)
+
+    def wifi(self, event, error=None, now=None):
+        text = str(error).encode("utf-8")[:MAX_TEXT] if error is not None else b""
+        if self._record(WIFI, 1 + len(text), now):
+            self._room(1)
+            self._buf[self._n] = event
+            self._n += 1
+            self._put(text)
+
+    def stage(self, stage, ms, now=None):
+        """
+        A stage timing (diagnostics.LatencyStats' trace hook).
+        """
+        if ms < 0:
+            ms = 0
+        if stage < MAX_STAGES:
+            self._stage_n[stage] += 1
+            self._stage_total[stage] += ms
+            if ms > self._stage_max[stage]:
+                self._stage_max[stage] = ms
+        if stage not in self.detail_stages and ms < self.detail_ms:
+            return
+        if self._record(STAGE, 1 + _varint_len(ms), now):
+            self._room(1 + _VARINT_MAX)
+            self._buf[self._n] = stage
+            self._n = _put_varint(self._buf, self._n + 1, ms)
+
+    def ntp(self, unix, now=None):
+        if self._record(NTP, 4, now):
+            self._room(4)
+            struct.pack_into("<I", self._buf, self._n, int(unix))
+            self._n += 4
+
+    def note(self, text, now=None):
+        data = text.encode("utf-8")[:MAX_TEXT]
+        if self._record(NOTE, len(data), now):
+            self._put(data)
+
+
+# ---- reading traces back (host side, tools/sim) ----
+
+def _read_varint(data, at):
+    value = shift = 0
+    while True:
+        b = data[at]
+        at += 1
+        value |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return value, at
+        shift += 7
+
+
+def segments(data):
+    """
+    Splits a trace file's bytes into boots: a list of
+    (start_ticks, [(kind, t_ms, payload), ...]) with t_ms counted from the
+    segment start. A record cut off at the end (reset mid-flush) ends its
+    segment.
+    """
+    out = []
+    at = 0
+    end = len(data)
+    while at + HEADER_LEN <= end:
+        magic, version, ticks = struct.unpack_from(_HEADER, data, at)
+        if magic != MAGIC:
+            # Garbage after a torn write: resync on the next header
+            nxt = data.find(MAGIC, at + 1)
+            if nxt < 0:
+                break
+            at = nxt
+            continue
+        if version != VERSION:
+            raise ValueError("Unsupported trace version %d" % version)
+        at += HEADER_LEN
+        records = []
+        t = 0
+        while at < end and data[at:at + 4] != MAGIC:
+            try:
+                kind = data[at]
+                dt, p = _read_varint(data, at + 1)
+                length, p = _read_varint(data, p)
+            except IndexError:
+                at = end
+                break
+            if p + length > end:
+                at = end
+                break
+            t += dt
+            records.append((kind, t, bytes(data[p:p + length])))
+            at = p + length
+        out.append((ticks, records))
+    return out
+
+
+def decode_reading(payload):
+    n = (len(payload) - 1) // 4
+    values = struct.unpack_from("<%df" % n, payload, 1)
+    return payload[0], values
+
+
+def decode_http(payload):
+    status, path_len = struct.unpack_from("<hB", payload, 0)
+    path = payload[3:3 + path_len].decode("utf-8")
+    return status, path, payload[3 + path_len:]
+
+
+def decode_wifi(payload):
+    return payload[0], payload[1:].decode("utf-8")
+
+
+def decode_stage(payload):
+    ms, _ = _read_varint(payload, 1)
+    return payload[0], ms
+
+
+def decode_ntp(payload):
+    return struct.unpack("<I", payload)[0]
+
+
+def decode_stages(payload):
+    """
+    [(stage, count, total_ms, max_ms), ...] from a STAGES record.
+    """
+    out = []
+    at = 0
+    while at < len(payload):
+        stage = payload[at]
+        count, at = _read_varint(payload, at + 1)
+        total, at = _read_varint(payload, at)
+        top, at = _read_varint(payload, at)
+        out.append((stage, count, total, top))
+    return out
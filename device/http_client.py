@@ -0,0 +1,353 @@
+# http_client.py
+import json
+
+import timing
+
+# errno values CircuitPython/CPython use for "nothing to do yet" on a
+# non-blocking socket: EAGAIN, ETIMEDOUT (CircuitPython), ETIMEDOUT (lwIP)
+_WOULD_BLOCK = (11, 110, 116)
+
+CONNECT_TIMEOUT_S = 3.0
+SEND_CHUNK = 1024
+RECV_BUF_SIZE = 2048
+# How often the owner should step() a busy client
+STEP_EVERY_S = 0.02
+
+
+def _would_block(exc):
+    code = getattr(exc, "errno", None)
+    if code is None and exc.args:
+        code = exc.args[0]
+    return code in _WOULD_BLOCK
+
+
+def split_url(url):
+    """
+    Returns (tls, host, port, path) for an http(s) URL.
+    """
+    proto, _, rest = url.partition("://")
+    host, _, path = rest.partition("/")
+    tls = proto == "https"
+    port = 443 if tls else 80
+    if ":" in host:
+        host, port_str = host.split(":", 1)
+        port = int(port_str)
+    return tls, host, port, "/" + path
+
+
+class HttpClient:
+    """
+    Minimal HTTP/1.1 client that runs one request at a time as a step-wise
+    state machine over a socket pool, so a slow server response never
+    stalls the main loop. Each step() does at most one DNS lookup, one
+    connect, one send of up to SEND_CHUNK bytes or one recv.
+
+    Sends and receives never block; setting up a connection does. The
+    socketpool has no non-blocking connect, so the DNS lookup and the TCP
+    connect plus TLS handshake each block their step(), the latter for up
+    to CONNECT_TIMEOUT_S. That is an accepted limitation: it only happens
+    when no kept-alive socket to the host is open (the first request, or
+    after the server or WiFi dropped it), and resolved addresses are
+    cached so a reconnect skips the lookup.
+
+    Usage:
+        http.start(owner, "POST", url, body=..., headers=...)
+        ...each loop: http.step(now)
+        if http.finished(owner): use http.status / http.json(); http.release()
+
+    tap, if set, is called with the client once step() finishes a request
+    (see fieldtrace).
+    """
+    IDLE = 0
+    CONNECT = 1
+    SEND = 2
+    RECV = 3
+    DONE = 4
+    FAILED = 5
+
+    def __init__(self, pool, ssl_context=None, recv_size=RECV_BUF_SIZE, debug=False):
+        self.pool = pool
+        self.ssl_context = ssl_context
+        self.debug = debug
+
+        self._rx = bytearray(recv_size)
+        self._rx_mv = memoryview(self._rx)
+        self._rx_n = 0
+
+        self._sock = None
+        self._sock_key = None   # (host, port, tls) the open socket talks to
+        self._addr = None       # resolved address for _addr_key
+        self._addr_key = None
+
+        self.state = HttpClient.IDLE
+        self.owner = None
+        self.path = None
+        self.status = None
+        self.error = None
+        self.tap = None
+        self._deadline = 0       # ticks
+        self._key = None
+        self._out = None        # request head, then body
+        self._body = None
+        self._sent = 0
+        self._reused = False
+        self._hdr_end = 0
+        self._content_length = None
+        self._chunked = False
+        self._keep_alive = True
+
+    def _log(self, msg):
+        if self.debug:
+            print(msg)
+
+    def busy(self):
+        return self.state not in (HttpClient.IDLE, HttpClient.DONE, HttpClient.FAILED)
+
+    def finished(self, owner):
+        return self.owner is owner and self.state in (HttpClient.DONE, HttpClient.FAILED)
+
+    def release(self):
+        self.state = HttpClient.IDLE
+        self.owner = None
+        self._body = None
+        self._out = None
+
+    def start(self, owner, method, url, body=None, headers=None, timeout=6.0, now=None):
+        """
+        Begins a request. body (bytes/bytearray/memoryview) must stay
+        unchanged until the request has finished.
+        """
+        if self.state != HttpClient.IDLE:
+            raise RuntimeError("HTTP client busy")
+        if now is None:
+            now = timing.ticks_ms()
+        tls, host, port, path = split_url(url)
+
+        head = "%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n" % (
+            method, path, host, len(body) if body is not None else 0)
+        if headers:
+            for name, value in headers.items():
+                head += "%s: %s\r\n" % (name, value)
+        head += "\r\n"
+
+        self.owner = owner
+        self.path = path
+        self.status = None
+        self.error = None
+        self._deadline = timing.add_s(now, timeout)
+        self._key = (host, port, tls)
+        self._out = head.encode("utf-8")
+        self._body = body
+        self._sent = 0
+        self._reused = False
+        self.state = HttpClient.CONNECT
+
+    def abort(self, reason="aborted"):
+        if self.busy():
+            self._fail(reason)
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except Exception:
+                pass
+        self._sock = None
+        self._sock_key = None
+
+    def _fail(self, reason):
+        self._log(f"HTTP failed: {reason}")
+        self.close()
+        self.error = reason
+        self.state = HttpClient.FAILED
+
+    def _connect(self):
+        """
+        One blocking connect step; returns True once the socket is open.
+        The first step for a new host only resolves it.
+        """
+        if self._sock is not None and self._sock_key == self._key:
+            self._reused = True
+            return True
+        self.close()
+        host, port, tls = self._key
+        if self._addr_key != self._key:
+            self._log(f"HTTP resolving {host}")
+            self._addr = self.pool.getaddrinfo(host, port)[0][-1]
+            self._addr_key = self._key
+            return False
+        self._log(f"HTTP connecting to {host}:{port}")
+        sock = self.pool.socket(self.pool.AF_INET, self.pool.SOCK_STREAM)
+        if tls:
+            sock = self.ssl_context.wrap_socket(sock, server_hostname=host)
+        sock.settimeout(CONNECT_TIMEOUT_S)
+        try:
+            sock.connect(self._addr)
+        except Exception:
+            sock.close()
+            self._addr_key = None   # resolve again next time
+            raise
+        sock.settimeout(0)
+        self._sock = sock
+        self._sock_key = self._key
+        self._reused = False
+        return True
+
+    def _retry_fresh(self):
+        # A kept-alive socket the server had already closed: reconnect once.
+        self._log("HTTP kept-alive socket stale; reconnecting")
+        self.close()
+        self._sent = 0
+        self._reused = False
+        self.state = HttpClient.CONNECT
+
+    def _send_step(self):
+        head = self._out
+        body = self._body
+        head_len = len(head)
+        total = head_len + (len(body) if body is not None else 0)
+        pos = self._sent
+        if pos < head_len:
+            chunk = memoryview(head)[pos:pos + SEND_CHUNK]
+        else:
+            chunk = memoryview(body)[pos - head_len:pos - head_len + SEND_CHUNK]
+        n = self._sock.send(chunk)
+        if n:
+            self._sent = pos + n
+        if self._sent >= total:
+            self._rx_n = 0
+            self._hdr_end = 0
+            self._content_length = None
+            self._chunked = False
+            self._keep_alive = True
+            self.state = HttpClient.RECV
+
+    def _parse_head(self):
+        head = bytes(self._rx_mv[:self._hdr_end]).decode("utf-8")
+        lines = head.split("\r\n")
+        self.status = int(lines[0].split(" ")[1])
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            name = name.strip().lower()
+            value = value.strip()
+            if name == "content-length":
+                self._content_length = int(value)
+            elif name == "transfer-encoding":
+                self._chunked = "chunked" in value.lower()
+            elif name == "connection":
+                self._keep_alive = value.lower() != "close"
+
+    def _find_head_end(self, start, end):
+        rx = self._rx
+        i = max(3, start)
+        while i < end:
+            if rx[i] == 0x0A and rx[i - 1] == 0x0D and rx[i - 2] == 0x0A and rx[i - 3] == 0x0D:
+                return i + 1
+            i += 1
+        return 0
+
+    def _response_complete(self, closed):
+        if closed:
+            return True
+        received = self._rx_n - self._hdr_end
+        if self._content_length is not None:
+            return received >= self._content_length
+        if self._chunked:
+            rx = self._rx
+            n = self._rx_n
+            return received >= 5 and bytes(rx[n - 5:n]) == b"0\r\n\r\n"
+        return False
+
+    def _recv_step(self):
+        n = self._rx_n
+        if n >= len(self._rx):
+            raise RuntimeError("HTTP response too large")
+        got = self._sock.recv_into(self._rx_mv[n:])
+        closed = not got
+        if closed and n == 0 and self._reused:
+            self._retry_fresh()
+            return
+        if got:
+            self._rx_n = n + got
+        if not self._hdr_end:
+            self._hdr_end = self._find_head_end(n, self._rx_n)
+            if not self._hdr_end:
+                if closed:
+                    raise RuntimeError("Connection closed before response headers")
+                return
+            self._parse_head()
+        if self._response_complete(closed):
+            if closed or not self._keep_alive or (self._content_length is None and not self._chunked):
+                self.close()
+            self.state = HttpClient.DONE
+
+    def step(self, now=None):
+        """
+        Advances the current request by one bounded unit of work.
+        Returns True once the request has finished (DONE or FAILED).
+        """
+        state = self.state
+        if state in (HttpClient.IDLE, HttpClient.DONE, HttpClient.FAILED):
+            return state != HttpClient.IDLE
+        if now is None:
+            now = timing.ticks_ms()
+        if timing.due(now, self._deadline):
+            self._fail("timeout")
+            return self._finished()
+        try:
+            if state == HttpClient.CONNECT:
+                if self._connect():
+                    self.state = HttpClient.SEND
+            elif state == HttpClient.SEND:
+                try:
+                    self._send_step()
+                except OSError as exc:
+                    if _would_block(exc):
+                        return False
+                    if self._reused and self._sent == 0:
+                        self._retry_fresh()
+                        return False
+                    raise
+            elif state == HttpClient.RECV:
+                try:
+                    self._recv_step()
+                except OSError as exc:
+                    if _would_block(exc):
+                        return False
+                    if self._reused and self._rx_n == 0:
+                        self._retry_fresh()
+                        return False
+                    raise
+        except Exception as exc:
+            self._fail(str(exc) or repr(exc))
+        return self._finished()
+
+    def _finished(self):
+        if self.state in (HttpClient.DONE, HttpClient.FAILED):
+            if self.tap is not None:
+                self.tap(self)
+            return True
+        return False
+
+    def body(self):
+        """
+        Response body of the finished request (chunked encoding removed).
+        """
+        raw = bytes(self._rx_mv[self._hdr_end:self._rx_n])
+        if not self._chunked:
+            return raw
+        out = bytearray()
+        pos = 0
+        while True:
+            eol = raw.find(b"\r\n", pos)
+            if eol < 0:
+                break
+            size = int(raw[pos:eol].split(b";")[0], 16)
+            if not size:
+                break
+            out.extend(raw[eol + 2:eol + 2 + size])
+            pos = eol + 2 + size + 2
+        return bytes(out)
+
+    def json(self):
+        return json.loads(self.body())
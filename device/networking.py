@@ -5,9 +5,40 @@ import rtc
 import wifi
 import socketpool
 import ssl
-import adafruit_requests
+import ipaddress
 import adafruit_ntp
 
+import timing
+import fieldtrace
+
+try:
+    import microcontroller
+    _nvm = microcontroller.nvm
+except (ImportError, AttributeError):
+    _nvm = None
+
+from http_client import HttpClient, STEP_EVERY_S
+from retry import RetryPolicy
+
+
+# Last good access point, kept in NVM so a reconnect after a brownout can
+# skip the channel scan: magic, SSID checksum, channel, 6-byte BSSID.
+WIFI_NVM_OFFSET = 0
+WIFI_NVM_MAGIC = 0xA7
+WIFI_NVM_LEN = 9
+WIFI_FAST_TIMEOUT_S = 4
+WIFI_CONNECT_TIMEOUT_S = 15
+WIFI_RETRY_MAX_S = 120.0
+# After this many failed connects in a row, power-cycle the radio and back off
+WIFI_TRIP_AFTER = 8
+WIFI_OPEN_S = 60.0
+# While idle, how often tick() still looks at the link state
+LINK_CHECK_EVERY_S = 1.0
+
+
+def _ssid_check(ssid):
+    return sum(ssid.encode("utf-8")) & 0xFF
+
 
 class NetState:
     INIT = 0   # connected but not healthy yet (or still trying) -> blink
@@ -16,48 +47,161 @@ class NetState:
 
 
 class NetworkManager:
-    def __init__(self, healthcheck_every_s=10.0, wifi_retry_s=5.0, debug=True):
+    def __init__(self, healthcheck_every_s=10.0, wifi_retry_s=5.0, link_check_s=LINK_CHECK_EVERY_S, trace=None,
+                 debug=True):
         self.healthcheck_every_s = float(healthcheck_every_s)
         self.wifi_retry_s = float(wifi_retry_s)
+        self.link_check_s = float(link_check_s)
+        self.trace = trace      # fieldtrace.TraceRecorder for connects and HTTP results
         self.debug = debug
 
-        self.requests = None
+        self.http = None
         self._socketpool = None
+        self._ssl_context = None
+        self._client = None
         self.health_ok = False
+        self._health_pending = False
 
-        self._next_wifi_attempt = 0.0
-        self._next_healthcheck = 0.0
+        self._wifi_retry = RetryPolicy(
+            "WiFi",
+            base_s=self.wifi_retry_s,
+            max_s=WIFI_RETRY_MAX_S,
+            trip_after=WIFI_TRIP_AFTER,
+            open_s=WIFI_OPEN_S,
+            max_open_s=10 * 60,
+            on_reinit=self._reset_radio,
+            debug=debug,
+        )
+        self._next_healthcheck = None  # ticks; None = now
         self._had_wifi_failure = False
+        self._static_applied = False
 
     def _log(self, msg):
         if self.debug:
             print(msg)
 
-    def _get_session(self):
-        pool = self._get_socketpool()
-        return adafruit_requests.Session(pool, ssl.create_default_context())
+    def _get_client(self):
+        # One HttpClient (and SSL context) for the manager's lifetime: it keeps
+        # the ingest/health connection alive between requests, and a socket
+        # that died with the WiFi link is replaced on first use.
+        if self._client is None:
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            self._client = HttpClient(self._get_socketpool(), self._ssl_context, debug=self.debug)
+            if self.trace is not None:
+                self._client.tap = self.trace.http
+        return self._client
 
     def _get_socketpool(self):
         if self._socketpool is None:
             self._socketpool = socketpool.SocketPool(wifi.radio)
         return self._socketpool
 
+    def _reset_radio(self):
+        self._log("Power-cycling WiFi radio")
+        wifi.radio.enabled = False
+        wifi.radio.enabled = True
+
+    def _load_ap_hint(self, ssid):
+        """
+        Returns (bssid_bytes, channel) of the last AP we joined for this
+        SSID, or None.
+        """
+        if _nvm is None:
+            return None
+        try:
+            rec = _nvm[WIFI_NVM_OFFSET:WIFI_NVM_OFFSET + WIFI_NVM_LEN]
+        except Exception:
+            return None
+        if rec[0] != WIFI_NVM_MAGIC or rec[1] != _ssid_check(ssid) or not 1 <= rec[2] <= 14:
+            return None
+        return bytes(rec[3:9]), rec[2]
+
+    def _save_ap_hint(self, ssid):
+        if _nvm is None:
+            return
+        try:
+            ap = wifi.radio.ap_info
+            rec = bytes((WIFI_NVM_MAGIC, _ssid_check(ssid), ap.channel)) + bytes(ap.bssid)
+            # Only write on change: NVM lives in flash
+            if len(rec) == WIFI_NVM_LEN and _nvm[WIFI_NVM_OFFSET:WIFI_NVM_OFFSET + WIFI_NVM_LEN] != rec:
+                _nvm[WIFI_NVM_OFFSET:WIFI_NVM_OFFSET + WIFI_NVM_LEN] = rec
+                self._log(f"Saved AP hint: channel {ap.channel}")
+        except Exception as e:
+            self._log(f"Could not save AP hint: {e}")
+
+    def _forget_ap_hint(self):
+        if _nvm is None:
+            return
+        try:
+            _nvm[WIFI_NVM_OFFSET] = 0
+        except Exception:
+            pass
+
+    def _apply_static_ipv4(self):
+        """
+        Optional static IPv4 from settings.toml (skips DHCP):
+        WIFI_STATIC_IP, WIFI_NETMASK, WIFI_GATEWAY, WIFI_DNS.
+        """
+        if self._static_applied:
+            return
+        addr = os.getenv("WIFI_STATIC_IP")
+        if not addr:
+            return
+        gateway = os.getenv("WIFI_GATEWAY")
+        if not gateway:
+            raise RuntimeError("WIFI_STATIC_IP needs WIFI_GATEWAY in settings.toml")
+        netmask = os.getenv("WIFI_NETMASK") or "255.255.255.0"
+        dns = os.getenv("WIFI_DNS") or gateway
+        wifi.radio.set_ipv4_address(
+            ipv4=ipaddress.IPv4Address(addr),
+            netmask=ipaddress.IPv4Address(netmask),
+            gateway=ipaddress.IPv4Address(gateway),
+            ipv4_dns=ipaddress.IPv4Address(dns),
+        )
+        self._static_applied = True
+        self._log(f"Using static IPv4 {addr} gw {gateway}")
+
     def _connect_wifi_once(self):
         ssid = os.getenv("CIRCUITPY_WIFI_SSID")
         pwd = os.getenv("CIRCUITPY_WIFI_PASSWORD")
         self._log(f"Attempting WiFi connect to SSID='{ssid}'")
         if not ssid or not pwd:
             raise RuntimeError("Missing CIRCUITPY_WIFI_SSID / CIRCUITPY_WIFI_PASSWORD in settings.toml")
-        wifi.radio.connect(ssid, pwd)
+        self._apply_static_ipv4()
+
+        # Fast path: straight to the last AP we joined, no scan
+        hint = self._load_ap_hint(ssid)
+        if hint is not None:
+            bssid, channel = hint
+            try:
+                wifi.radio.connect(ssid, pwd, channel=channel, bssid=bssid, timeout=WIFI_FAST_TIMEOUT_S)
+                self._log(f"WiFi fast reconnect on channel {channel}")
+                return
+            except Exception as e:
+                self._log(f"WiFi fast reconnect failed: {e}; scanning")
+                self._forget_ap_hint()
+
+        wifi.radio.connect(ssid, pwd, timeout=WIFI_CONNECT_TIMEOUT_S)
+        self._save_ap_hint(ssid)
 
     def _ensure_session_if_connected(self, now):
-        # Key fix: if CircuitPython auto-connects, wifi is connected but requests is None
-        if wifi.radio.connected and self.requests is None:
-            self._log("WiFi already connected; creating requests session")
-            self.requests = self._get_session()
-            self._next_healthcheck = now  # run ASAP
+        # Key fix: if CircuitPython auto-connects, wifi is connected but http is None
+        if wifi.radio.connected and self.http is None:
+            self._log("WiFi already connected; creating HTTP client")
+            if self.trace is not None:
+                self.trace.wifi(fieldtrace.WIFI_CONNECTED, now=now)
+            self._save_ap_hint(os.getenv("CIRCUITPY_WIFI_SSID") or "")
+            self.http = self._get_client()
+            self._wifi_retry.success()
+            self._next_healthcheck = None  # run ASAP
 
-    def _healthcheck_ok(self):
+    def _start_healthcheck(self, now):
+        """
+        Starts the healthcheck GET; its result is picked up by
+        _finish_healthcheck() on a later tick. Returns False if it could
+        not be started.
+        """
         url = os.getenv("API_HEALTHCHECK_URL")
         self._log(f"Attempting healthcheck at: {url}")
 
@@ -66,53 +210,129 @@ class NetworkManager:
             return False
 
         try:
-            r = self.requests.get(url, timeout=3)
-            self._log(f"Healthcheck status: {r.status_code}")
-            ok = 200 <= r.status_code < 300
-            r.close()
-            return ok
+            self.http.start(self, "GET", url, timeout=3, now=now)
+            self._health_pending = True
+            return True
         except Exception as e:
             self._log(f"Healthcheck exception: {e}")
             return False
 
+    def _finish_healthcheck(self):
+        http = self.http
+        self._health_pending = False
+        if http.state == http.FAILED:
+            self._log(f"Healthcheck exception: {http.error}")
+            ok = False
+        else:
+            self._log(f"Healthcheck status: {http.status}")
+            ok = 200 <= http.status < 300
+        http.release()
+        return ok
+
+    def note_server_ok(self, now=None):
+        """
+        Any successful exchange with the API server (e.g. an ingest POST)
+        counts as a passing healthcheck and pushes the next GET back.
+        """
+        if now is None:
+            now = timing.ticks_ms()
+        self.health_ok = True
+        self._next_healthcheck = timing.add_s(now, self.healthcheck_every_s)
+
+    def note_server_error(self, now=None):
+        # A failed exchange: confirm with a healthcheck on the next tick.
+        self._next_healthcheck = None
+
     def tick(self, now=None):
         if now is None:
-            now = time.monotonic()
+            now = timing.ticks_ms()
 
         # If already connected, ensure we can do HTTP
         self._ensure_session_if_connected(now)
 
         # If disconnected, clear state
         if not wifi.radio.connected:
-            self.requests = None
+            if self.http is not None:
+                if self.trace is not None:
+                    self.trace.wifi(fieldtrace.WIFI_LOST, now=now)
+                self.http.abort("WiFi disconnected")
+                self.http.release()
+            self.http = None
             self.health_ok = False
+            self._health_pending = False
 
-            # Rate-limited connect attempts
-            if now >= self._next_wifi_attempt:
+            # Connect attempts back off; see RetryPolicy
+            if self._wifi_retry.ready(now):
                 try:
                     self._connect_wifi_once()
-                    self.requests = self._get_session()
+                    if self.trace is not None:
+                        self.trace.wifi(fieldtrace.WIFI_CONNECTED)
+                    self.http = self._get_client()
                     self._had_wifi_failure = False
-                    self._next_healthcheck = now  # check soon
+                    self._wifi_retry.success()
+                    self._next_healthcheck = None  # check soon
                 except Exception as e:
-                    self._log(f"WiFi connect failed: {e}")
+                    if self.trace is not None:
+                        self.trace.wifi(fieldtrace.WIFI_FAILED, e)
+                    # The connect blocks for seconds; back off from when it gave up
+                    delay = self._wifi_retry.failure(timing.ticks_ms())
+                    self._log(f"WiFi connect failed: {e}; next try in {delay:.0f}s")
                     self._had_wifi_failure = True
-                    self._next_wifi_attempt = now + self.wifi_retry_s
                     return NetState.ERROR
 
             # Before the first failure, show INIT (blink). After a failure, ERROR.
             return NetState.ERROR if self._had_wifi_failure else NetState.INIT
 
-        # Connected: do healthcheck occasionally
-        if self.requests and now >= self._next_healthcheck:
-            self._next_healthcheck = now + self.healthcheck_every_s
-            self.health_ok = self._healthcheck_ok()
+        # Connected: advance whatever request is in flight by one step
+        http = self.http
+        http.step(now)
+
+        if self._health_pending:
+            if http.finished(self):
+                self.health_ok = self._finish_healthcheck()
+            elif http.owner is not self:
+                self._health_pending = False
+        # Healthcheck only if nothing else has reached the server lately
+        elif self._healthcheck_due(now) and http.state == http.IDLE:
+            self._next_healthcheck = timing.add_s(now, self.healthcheck_every_s)
+            if not self._start_healthcheck(now):
+                self.health_ok = False
 
         return NetState.OK if self.health_ok else NetState.INIT
 
+    def next_due(self, now=None):
+        """
+        Tick at which tick() next has something to do.
+        """
+        if now is None:
+            now = timing.ticks_ms()
+        link_check = timing.add_s(now, self.link_check_s)
+        if not wifi.radio.connected:
+            return timing.earliest(self._wifi_retry.next_attempt_at(now), link_check)
+        http = self.http
+        if http is None or http.state != http.IDLE:
+            return timing.add_s(now, STEP_EVERY_S)
+        if self._healthcheck_due(now):
+            return now
+        return timing.earliest(self._next_healthcheck, link_check)
+
+    def _healthcheck_due(self, now):
+        return self._next_healthcheck is None or timing.due(now, self._next_healthcheck)
+
     def is_connected(self):
         return wifi.radio.connected
 
+    def rssi(self):
+        """
+        Signal strength of the current AP in dBm, or None.
+        """
+        if not self.is_connected():
+            return None
+        try:
+            return wifi.radio.ap_info.rssi
+        except Exception:
+            return None
+
     def _utc_offset_hours(self, offset_str):
         # offset_str is like "+05:30" or "-07:00" or "5.5"
         if not offset_str:
@@ -134,12 +354,24 @@ class NetworkManager:
             return 5.5
         return self._utc_offset_hours(offset)
 
-    def sync_time(self, timezone=None):
+    def timezone_offset_s(self):
+        return int(self._timezone_offset_hours() * 3600)
+
+    def sync_time(self, timezone=None, clock=None):
+        """
+        Sets the RTC (local time) from NTP. With a clock.ClockService, the
+        result also re-anchors its estimate.
+        """
         if not self.is_connected():
             raise RuntimeError("WiFi not connected")
 
         tz_offset = self._timezone_offset_hours()
         self._log(f"Syncing time from NTP: time.google.com (tz_offset={tz_offset})")
-        ntp = adafruit_ntp.NTP(self._get_socketpool(), server="time.google.com", tz_offset=tz_offset)
-        rtc.RTC().datetime = ntp.datetime
+        ntp = adafruit_ntp.NTP(self._get_socketpool(), server="time.google.com", tz_offset=0)
+        unix = time.mktime(ntp.datetime)
+        if self.trace is not None:
+            self.trace.ntp(unix)
+        if clock is not None:
+            clock.set_from_ntp(unix, timing.ticks_ms())
+        rtc.RTC().datetime = time.localtime(unix + int(tz_offset * 3600))
         return rtc.RTC().datetime
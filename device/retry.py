@@ -0,0 +1,124 @@
+# retry.py
+import random
+
+import timing
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter plus a circuit breaker, shared by every
+    subsystem that talks to flaky hardware or the network.
+
+    CLOSED: the caller may try whenever ready(); each failure() pushes the
+    next attempt out by base_s * factor**(n-1), capped at max_s, +/- jitter.
+    After trip_after consecutive failures (0 = never) the circuit OPENs and
+    nothing is tried for open_s, doubling per failed probe up to max_open_s.
+    When that expires it goes HALF_OPEN: on_reinit() (if given) re-creates
+    the device/session and one probe attempt is allowed. Its success()
+    closes the circuit; failure() opens it again.
+    """
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self, name, base_s=1.0, max_s=60.0, factor=2.0, jitter=0.2,
+                 trip_after=0, open_s=300.0, max_open_s=3600.0, on_reinit=None, debug=True):
+        self.name = name
+        self.base_s = float(base_s)
+        self.max_s = float(max_s)
+        self.factor = float(factor)
+        self.jitter = float(jitter)
+        self.trip_after = int(trip_after)
+        self.open_s = float(open_s)
+        self.max_open_s = float(max_open_s)
+        self.on_reinit = on_reinit
+        self.debug = debug
+
+        self.state = RetryPolicy.CLOSED
+        self.failures = 0       # consecutive
+        self._opens = 0         # consecutive trips without a success
+        self.next_attempt = None  # ticks; None = now
+
+    def _log(self, msg):
+        if self.debug:
+            print(msg)
+
+    def _jittered(self, delay):
+        if self.jitter:
+            delay *= 1.0 + self.jitter * (2.0 * random.random() - 1.0)
+        return delay
+
+    def ready(self, now=None):
+        """
+        True if an attempt may be made now. Moving from OPEN to HALF_OPEN
+        runs on_reinit(); if that raises, it counts as the failed probe.
+        """
+        if now is None:
+            now = timing.ticks_ms()
+        if self.next_attempt is not None:
+            if not timing.due(now, self.next_attempt):
+                return False
+            self.next_attempt = None
+        if self.state == RetryPolicy.OPEN:
+            self.state = RetryPolicy.HALF_OPEN
+            self._log(f"{self.name}: probing")
+            if self.on_reinit is not None:
+                try:
+                    self.on_reinit()
+                except Exception as e:
+                    self._log(f"{self.name}: re-init failed: {e}")
+                    self.failure(now)
+                    return False
+        return True
+
+    def expire(self, now):
+        """
+        Forgets next_attempt once it has passed. Callers that may not ask
+        ready() for days (e.g. while offline) call this instead, so the
+        deadline doesn't age into a ticks wrap and look future again.
+        """
+        if self.next_attempt is not None and timing.due(now, self.next_attempt):
+            self.next_attempt = None
+
+    def next_attempt_at(self, now):
+        """
+        Ticks at which ready() may next return True.
+        """
+        return now if self.next_attempt is None else self.next_attempt
+
+    def is_open(self):
+        return self.state != RetryPolicy.CLOSED
+
+    def success(self):
+        if self.state != RetryPolicy.CLOSED:
+            self._log(f"{self.name}: recovered")
+        self.state = RetryPolicy.CLOSED
+        self.failures = 0
+        self._opens = 0
+        self.next_attempt = None
+
+    def trip(self, now=None):
+        """
+        Opens the circuit right away (e.g. the device failed to initialize).
+        """
+        if now is None:
+            now = timing.ticks_ms()
+        delay = min(self.open_s * self.factor ** self._opens, self.max_open_s)
+        self._opens += 1
+        self.state = RetryPolicy.OPEN
+        self.next_attempt = timing.add_s(now, self._jittered(delay))
+        self._log(f"{self.name}: circuit open, retry in {delay:.0f}s")
+        return delay
+
+    def failure(self, now=None):
+        """
+        Records a failed attempt; returns the delay before the next one.
+        """
+        if now is None:
+            now = timing.ticks_ms()
+        self.failures += 1
+        if self.state == RetryPolicy.HALF_OPEN or (self.trip_after and self.failures >= self.trip_after):
+            return self.trip(now)
+        delay = min(self.base_s * self.factor ** (self.failures - 1), self.max_s)
+        self.next_attempt = timing.add_s(now, self._jittered(delay))
+        return delay
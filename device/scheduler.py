@@ -0,0 +1,138 @@
+# scheduler.py
+import asyncio
+
+import timing
+
+try:
+    import alarm
+except ImportError:
+    alarm = None
+
+# Wake this much before the earliest deadline to cover light-sleep exit
+LIGHT_SLEEP_MARGIN_S = 0.01
+
+
+def _before(a, b):
+    # Heap order on [deadline ticks, seq, ...]; wrap-safe because every
+    # deadline in the heap is near now.
+    d = timing.ticks_diff(a[0], b[0])
+    return d < 0 or (d == 0 and a[1] < b[1])
+
+
+def _heap_push(heap, item):
+    heap.append(item)
+    i = len(heap) - 1
+    while i:
+        parent = (i - 1) >> 1
+        if not _before(item, heap[parent]):
+            break
+        heap[i] = heap[parent]
+        i = parent
+    heap[i] = item
+
+
+def _heap_pop(heap):
+    last = heap.pop()
+    if not heap:
+        return last
+    top = heap[0]
+    n = len(heap)
+    i = 0
+    while True:
+        child = 2 * i + 1
+        if child >= n:
+            break
+        if child + 1 < n and _before(heap[child + 1], heap[child]):
+            child += 1
+        if not _before(heap[child], last):
+            break
+        heap[i] = heap[child]
+        i = child
+    heap[i] = last
+    return top
+
+
+class DeadlineScheduler:
+    """
+    Keeps a min-heap of the deadlines the main-loop tasks are sleeping
+    until. asyncio already wakes exactly at the earliest one; on top of that,
+    once every task spawned here is asleep and the earliest deadline is at
+    least light_sleep_min_s away, the CPU light-sleeps until then (via
+    `alarm`, when light_sleep_min_s is set and the port supports it).
+
+    Tasks must sleep through sleep_until() for the "everyone is asleep"
+    check to hold. Deadlines are only tracked while light sleep is on;
+    each wake drops finished entries off the top of the heap, so it holds
+    about one entry per task. With a diagnostics.LatencyStats, how late
+    each task wakes past its deadline (loop lag) is recorded against
+    lag_stage.
+    """
+    def __init__(self, light_sleep_min_s=None, stats=None, lag_stage=0, debug=False):
+        self.light_sleep_min_s = light_sleep_min_s if alarm is not None else None
+        self.stats = stats
+        self.lag_stage = lag_stage
+        self.debug = debug
+        self._heap = []         # [deadline, seq, waiting]
+        self._seq = 0
+        self.tasks = 0
+        self.sleeping = 0
+        self.light_sleeps = 0
+        self.light_sleep_s = 0.0
+
+    def spawn(self, coro):
+        self.tasks += 1
+        return asyncio.create_task(coro)
+
+    def earliest(self):
+        """
+        Earliest deadline a task is sleeping until, or None (also when
+        light sleep is off and deadlines aren't tracked).
+        """
+        self._prune()
+        heap = self._heap
+        return heap[0][0] if heap else None
+
+    def _prune(self):
+        heap = self._heap
+        while heap and not heap[0][2]:
+            _heap_pop(heap)
+
+    async def sleep_until(self, t):
+        """
+        Sleeps until tick t (see timing).
+        """
+        entry = None
+        if self.light_sleep_min_s is not None:
+            self._seq += 1
+            entry = [t, self._seq, True]
+            _heap_push(self._heap, entry)
+        self.sleeping += 1
+        try:
+            if entry is not None and self.sleeping == self.tasks:
+                self._light_sleep()
+            delay = timing.diff_s(t, timing.ticks_ms())
+            await asyncio.sleep(delay if delay > 0 else 0)
+            if self.stats is not None:
+                self.stats.stop(self.lag_stage, t)
+        finally:
+            if entry is not None:
+                entry[2] = False
+                self._prune()
+            self.sleeping -= 1
+
+    async def sleep(self, delay):
+        await self.sleep_until(timing.add_s(timing.ticks_ms(), delay))
+
+    def _light_sleep(self):
+        # Every task is parked until at least earliest(), so nothing runs late
+        # if we block until then.
+        now = timing.ticks_ms()
+        gap = timing.diff_s(self.earliest(), now) - LIGHT_SLEEP_MARGIN_S
+        if gap < self.light_sleep_min_s:
+            return
+        if self.debug:
+            print("Light sleep %.1fs" % gap)
+        wake = timing.monotonic_at(timing.add_s(now, gap))
+        alarm.light_sleep_until_alarms(alarm.time.TimeAlarm(monotonic_time=wake))
+        self.light_sleeps += 1
+        self.light_sleep_s += timing.diff_s(timing.ticks_ms(), now)
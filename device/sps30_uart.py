@@ -1,6 +1,7 @@
 import time, gc, os
 import board, digitalio
 import busio, struct
+import timing
 
 START_STOP = 0x7E
 ESC = 0x7D
@@ -19,44 +20,124 @@ def stuff_bytes(data: bytes) -> bytes:
             out.append(b)
     return bytes(out)
 
-def unstuff_bytes(data: bytes) -> bytes:
-    out = bytearray()
-    i = 0
-    while i < len(data):
-        b = data[i]
-        if b == ESC:
-            i += 1
-            out.append(UNSTUFF[data[i]])
-        else:
-            out.append(b)
-        i += 1
-    return bytes(out)
-
 # Use board.TX/board.RX if available on TinyS3; otherwise swap to the correct D-pins for your board.
 uart = busio.UART(board.TX, board.RX, baudrate=115200, bits=8, parity=None, stop=1, timeout=0.2)
 
 def send_cmd(cmd: int, data: bytes = b""):
+    # Drop stale bytes (e.g. a reply that came after its command timed out),
+    # both still in the UART and half-decoded, so the next frame is this
+    # command's reply
+    uart.reset_input_buffer()
+    decoder.reset()
     adr = 0x00
     payload = bytes([adr, cmd, len(data)]) + data
     frame = bytes([START_STOP]) + stuff_bytes(payload + bytes([checksum(payload)])) + bytes([START_STOP])
     uart.write(frame)
 
+# Largest MISO frame is ADR CMD STATE LEN + 255 data bytes + CHK, and byte
+# stuffing can double that on the wire.
+MAX_FRAME_LEN = 4 + 255 + 1
+RX_BUF_SIZE = 2 * MAX_FRAME_LEN + 2
+
+class FrameDecoder:
+    """
+    Incremental SHDLC frame decoder.
+    Drains whatever the UART has buffered in one readinto() call and unstuffs
+    in place, so a complete frame comes back as a memoryview into the same
+    preallocated buffer (valid until the next poll()/reset()).
+    tap, if set, is called with every chunk read (see fieldtrace).
+    """
+    def __init__(self, uart, size=RX_BUF_SIZE):
+        self.uart = uart
+        self.tap = None
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._out = 0        # unstuffed bytes of the current frame, at _buf[0:_out]
+        self._pos = 0        # next raw byte to decode
+        self._end = 0        # end of raw bytes read from the UART
+        self._in_frame = False
+        self._esc = False
+
+    def reset(self):
+        self._out = 0
+        self._pos = 0
+        self._end = 0
+        self._in_frame = False
+        self._esc = False
+
+    def _fill(self):
+        waiting = self.uart.in_waiting
+        if not waiting:
+            return 0
+        room = len(self._buf) - self._end
+        if room <= 0:
+            # Overflow without a closing delimiter: drop the partial frame.
+            self.reset()
+            room = len(self._buf)
+        n = self.uart.readinto(self._mv[self._end:self._end + min(waiting, room)])
+        if n:
+            if self.tap is not None:
+                self.tap(self._mv[self._end:self._end + n])
+            self._end += n
+            return n
+        return 0
+
+    def poll(self):
+        """
+        Returns a memoryview of the next complete, unstuffed frame
+        (ADR CMD STATE LEN DATA... CHK) or None if none is available yet.
+        """
+        if self._pos >= self._end:
+            # Everything read so far has been decoded; keep appending right
+            # after the unstuffed bytes.
+            self._pos = self._end = self._out
+            self._fill()
+
+        buf = self._buf
+        out = self._out
+        i = self._pos
+        end = self._end
+        in_frame = self._in_frame
+        esc = self._esc
+        while i < end:
+            b = buf[i]
+            i += 1
+            if b == START_STOP:
+                if in_frame and out:
+                    self._pos = i
+                    self._out = 0
+                    self._in_frame = False
+                    self._esc = False
+                    return self._mv[:out]
+                in_frame = True
+                esc = False
+                out = 0
+            elif in_frame:
+                if esc:
+                    b = UNSTUFF.get(b, b)
+                    esc = False
+                elif b == ESC:
+                    esc = True
+                    continue
+                buf[out] = b
+                out += 1
+        self._pos = i
+        self._out = out
+        self._in_frame = in_frame
+        self._esc = esc
+        if not in_frame:
+            self._out = self._pos = self._end = 0
+        return None
+
+
+decoder = FrameDecoder(uart)
+
 def read_frame(timeout=1.0):
-    t0 = time.monotonic()
-    buf = bytearray()
-    in_frame = False
-    while time.monotonic() - t0 < timeout:
-        b = uart.read(1)
-        if not b:
-            continue
-        b = b[0]
-        if b == START_STOP:
-            if in_frame and buf:
-                return unstuff_bytes(bytes(buf))
-            in_frame = True
-            buf = bytearray()
-        elif in_frame:
-            buf.append(b)
+    t0 = timing.ticks_ms()
+    while timing.diff_s(timing.ticks_ms(), t0) < timeout:
+        frame = decoder.poll()
+        if frame is not None:
+            return frame
     return None
 
 def parse_miso(raw: bytes, expect_cmd=None):
@@ -68,7 +149,7 @@ def parse_miso(raw: bytes, expect_cmd=None):
     data = raw[4:4+length]
     chk  = raw[4+length] if (4+length) < len(raw) else None
 
-    payload = raw[:-1]
+    payload = raw[:len(raw)-1]
     if chk is None or checksum(payload) != chk:
         raise RuntimeError("Bad checksum (noise / wrong baud / wrong pins)")
 
@@ -105,16 +186,296 @@ def wake_up():
 
     time.sleep(1.2)
 
-def read_pm():
+def cancel():
+    """
+    Drops any pending command and buffered bytes.
+    """
+    global _pending_cmd
+    _pending_cmd = None
+    uart.reset_input_buffer()
+    decoder.reset()
+
+def reinit():
+    """
+    Drops any pending command and buffered bytes, then wakes, resets and
+    restarts the sensor (blocking, a few seconds; for boot only, the main
+    loop uses MeasurementScheduler.restart()).
+    """
+    cancel()
+    wake_up()
+
+# ---- Split-phase command API ----
+# request() sends a command and returns immediately; poll() is then called on
+# later loop ticks until the reply arrives or the command's deadline passes.
+CMD_TIMEOUT_S = 1.0
+# How often to check for a pending command's response
+RESPONSE_POLL_S = 0.02
+
+_pending_cmd = None
+_pending_deadline = 0  # ticks
+
+def request(cmd: int, data: bytes = b"", timeout=CMD_TIMEOUT_S, now=None):
+    global _pending_cmd, _pending_deadline
+    if now is None:
+        now = timing.ticks_ms()
+    send_cmd(cmd, data)
+    _pending_cmd = cmd
+    _pending_deadline = timing.add_s(now, timeout)
 
-    send_cmd(0x03)  # Read measured values  [oai_citation:9‡SparkFun](https://cdn.sparkfun.com/assets/4/e/e/f/8/Sensirion_PM_Sensors_Datasheet_SPS30.pdf)
-    data = parse_miso(read_frame(1.0), expect_cmd=0x03)
+def busy():
+    return _pending_cmd is not None
 
-    pm1  = struct.unpack(">f", data[0:4])[0]
-    pm25 = struct.unpack(">f", data[4:8])[0]
-    pm4  = struct.unpack(">f", data[8:12])[0]
-    pm10 = struct.unpack(">f", data[12:16])[0]
+def poll(now=None):
+    """
+    Returns the response data of the pending command once it has arrived,
+    or None while still waiting. Raises RuntimeError on timeout or on a
+    bad/errored response; either way the command is no longer pending.
+    """
+    global _pending_cmd
+    cmd = _pending_cmd
+    if cmd is None:
+        raise RuntimeError("No SPS30 command pending")
+    frame = decoder.poll()
+    if frame is None:
+        if now is None:
+            now = timing.ticks_ms()
+        if not timing.due(now, _pending_deadline):
+            return None
+        _pending_cmd = None
+        raise RuntimeError(f"SPS30 timeout waiting for response to 0x{cmd:02X}")
+    _pending_cmd = None
+    return parse_miso(frame, expect_cmd=cmd)
 
-    return pm1, pm25, pm4, pm10
+class Measurement:
+    """
+    One float-format SPS30 reading: mass concentrations (ug/m3), number
+    concentrations (#/cm3) and typical particle size (um).
+    Reused across reads; decode() overwrites every field in a single unpack.
+    """
+    def __init__(self):
+        self.pm1 = self.pm25 = self.pm4 = self.pm10 = 0.0
+        self.nc05 = self.nc1 = self.nc25 = self.nc4 = self.nc10 = 0.0
+        self.typical_size = 0.0
 
+    def decode(self, data):
+        (self.pm1, self.pm25, self.pm4, self.pm10,
+         self.nc05, self.nc1, self.nc25, self.nc4, self.nc10,
+         self.typical_size) = struct.unpack_from(">10f", data)
+        return self
 
+
+measurement = Measurement()
+
+def request_pm(now=None):
+    request(0x03, now=now)  # Read measured values  [oai_citation:9‡SparkFun](https://cdn.sparkfun.com/assets/4/e/e/f/8/Sensirion_PM_Sensors_Datasheet_SPS30.pdf)
+
+def poll_pm(now=None):
+    """
+    Returns the shared `measurement` record once the reading has arrived,
+    else None. The record is overwritten by the next successful read.
+    """
+    data = poll(now)
+    if data is None:
+        return None
+    return measurement.decode(data)
+
+# ---- Measurement scheduling ----
+FAN_CLEAN_S = 12.0    # fan cleaning runs ~10 s; readings are meaningless meanwhile
+MIN_SLEEP_S = 10.0    # shorter gaps than this are not worth a sleep/wake cycle
+
+# (cmd, data, ignore_errors)
+_WAKE_SEQ = (
+    (0x11, b"", True),             # Wake-up; rejected if the sensor was not asleep
+    (0x01, b"", True),             # Stop measurement; rejected if already idle
+    (0x00, bytes([0x01, 0x03]), False),  # Start measurement, float output
+)
+_SLEEP_SEQ = (
+    (0x01, b"", False),            # Stop measurement
+    (0x10, b"", False),            # Sleep
+)
+_CLEAN_SEQ = (
+    (0x56, b"", False),            # Start fan cleaning
+)
+
+class MeasurementScheduler:
+    """
+    Drives the SPS30 from the main loop through request()/poll().
+    Continuous mode keeps the fan running and reads every sample_every_s.
+    Duty-cycle mode stops and sleeps the sensor after each reading and wakes
+    it warmup_s before the next one is due. Fan cleaning is started every
+    clean_every_s while measuring.
+    Expects wake_up() to have started measurement already, or restart()
+    to be called first.
+    """
+    MEASURING = 0
+    CLEANING = 1
+    SLEEPING = 2
+    WAKING = 3
+    BUSY = 4   # running a command sequence
+
+    def __init__(self, sample_every_s=5.0, duty_cycle=False, warmup_s=30.0,
+                 clean_every_s=7 * 24 * 60 * 60, now=None):
+        if now is None:
+            now = timing.ticks_ms()
+        self.sample_every_s = float(sample_every_s)
+        self.warmup_s = float(warmup_s)
+        self.clean_every_s = float(clean_every_s)
+        self.duty_cycle = bool(duty_cycle)
+        if self.duty_cycle and self.sample_every_s < self.warmup_s + MIN_SLEEP_S:
+            print("SPS30 sample interval too short for duty cycling; measuring continuously.")
+            self.duty_cycle = False
+
+        # Deadlines are ticks (see timing). The week-long fan-cleaning
+        # interval is longer than ticks can span, so it counts down instead.
+        self.state = MeasurementScheduler.MEASURING
+        self._next_sample = now
+        # None once warm: a passed deadline would look future again after
+        # a ticks wrap, stopping reads for days
+        self._warm_until = timing.add_s(now, self.warmup_s) if self.duty_cycle else None
+        self._clean_until = now
+        self._clean_left_s = self.clean_every_s
+        self._last_tick = now
+        self._seq = None
+        self._seq_i = 0
+        self._seq_then = None
+        self._seq_fail = None
+
+    def restart(self, now=None):
+        """
+        Recovers a sensor in an unknown state without blocking: drops any
+        pending command and buffered bytes and sends the wake pulse; the
+        following tick()s run the wake sequence (wake, stop, start) and
+        the warm-up before the next reading. A failed start raises from
+        tick() as usual.
+        """
+        if now is None:
+            now = timing.ticks_ms()
+        cancel()
+        uart.write(b"\xFF")  # low pulse enables the UART interface in sleep
+        self._seq = None
+        self._next_sample = now
+        self.state = MeasurementScheduler.WAKING
+
+    def _start_seq(self, seq, then_state, fail_state, now):
+        self.state = MeasurementScheduler.BUSY
+        self._seq = seq
+        self._seq_i = 0
+        self._seq_then = then_state
+        self._seq_fail = fail_state
+        cmd, data, _ = seq[0]
+        request(cmd, data, now=now)
+
+    def _enter(self, state, now):
+        self.state = state
+        if state == MeasurementScheduler.MEASURING and self._seq is _WAKE_SEQ:
+            self._warm_until = timing.add_s(now, self.warmup_s)
+        elif state == MeasurementScheduler.CLEANING:
+            self._clean_until = timing.add_s(now, FAN_CLEAN_S)
+        elif state == MeasurementScheduler.SLEEPING and timing.due(now, self._next_sample):
+            self._next_sample = timing.add_s(now, self.sample_every_s)
+        self._seq = None
+
+    def _warm(self, now):
+        if self._warm_until is not None:
+            if not timing.due(now, self._warm_until):
+                return False
+            self._warm_until = None
+        return True
+
+    def _seq_step(self, now):
+        self._seq_i += 1
+        if self._seq_i >= len(self._seq):
+            self._enter(self._seq_then, now)
+            return
+        cmd, data, _ = self._seq[self._seq_i]
+        request(cmd, data, now=now)
+
+    def tick(self, now=None):
+        """
+        Returns the shared `measurement` record when a new reading arrives,
+        else None. Raises RuntimeError when a command fails; the scheduler
+        has already moved itself to a state it can recover from.
+        """
+        if now is None:
+            now = timing.ticks_ms()
+        self._clean_left_s -= timing.diff_s(now, self._last_tick)
+        self._last_tick = now
+
+        if busy():
+            seq = self._seq
+            try:
+                data = poll(now)
+            except RuntimeError:
+                if seq is None:
+                    # Failed measurement read
+                    if self.duty_cycle:
+                        self._start_seq(_SLEEP_SEQ, MeasurementScheduler.SLEEPING,
+                                        MeasurementScheduler.SLEEPING, now)
+                    raise
+                if not seq[self._seq_i][2]:
+                    self._enter(self._seq_fail, now)
+                    raise
+                data = b""
+            if data is None:
+                return None
+            if seq is not None:
+                self._seq_step(now)
+                return None
+            m = measurement.decode(data)
+            if self.duty_cycle:
+                self._start_seq(_SLEEP_SEQ, MeasurementScheduler.SLEEPING,
+                                MeasurementScheduler.SLEEPING, now)
+            return m
+
+        state = self.state
+        if state == MeasurementScheduler.MEASURING:
+            if self._clean_left_s <= 0:
+                self._clean_left_s = self.clean_every_s
+                self._start_seq(_CLEAN_SEQ, MeasurementScheduler.CLEANING,
+                                MeasurementScheduler.MEASURING, now)
+            elif timing.due(now, self._next_sample) and self._warm(now):
+                # Keep the cadence anchored so wake/warm-up latency doesn't accumulate.
+                self._next_sample = timing.add_s(self._next_sample, self.sample_every_s)
+                if timing.due(now, self._next_sample):
+                    self._next_sample = timing.add_s(now, self.sample_every_s)
+                request_pm(now=now)
+        elif state == MeasurementScheduler.CLEANING:
+            if timing.due(now, self._clean_until):
+                self.state = MeasurementScheduler.MEASURING
+        elif state == MeasurementScheduler.SLEEPING:
+            if timing.due(now, timing.add_s(self._next_sample, -self.warmup_s)):
+                uart.write(b"\xFF")  # low pulse enables the UART interface in sleep
+                self.state = MeasurementScheduler.WAKING
+        elif state == MeasurementScheduler.WAKING:
+            # One loop tick after the wake pulse, well inside the 100 ms window.
+            self._start_seq(_WAKE_SEQ, MeasurementScheduler.MEASURING,
+                            MeasurementScheduler.SLEEPING, now)
+        return None
+
+    def next_due(self, now=None):
+        """
+        Tick at which tick() next has something to do.
+        """
+        if now is None:
+            now = timing.ticks_ms()
+        state = self.state
+        if busy() or state == MeasurementScheduler.WAKING:
+            return timing.add_s(now, RESPONSE_POLL_S)
+        if state == MeasurementScheduler.MEASURING:
+            # Cap the cleaning countdown so the deadline stays within tick range
+            clean_due = timing.add_s(self._last_tick, max(0.0, min(self._clean_left_s, 3600.0)))
+            sample_due = self._next_sample
+            if self._warm_until is not None:
+                sample_due = timing.latest(sample_due, self._warm_until)
+            return timing.earliest(clean_due, sample_due)
+        if state == MeasurementScheduler.CLEANING:
+            return self._clean_until
+        if state == MeasurementScheduler.SLEEPING:
+            return timing.add_s(self._next_sample, -self.warmup_s)
+        return timing.add_s(now, RESPONSE_POLL_S)
+
+def read_pm():
+    # Blocking variant of request_pm()/poll_pm().
+    send_cmd(0x03)
+    m = measurement.decode(parse_miso(read_frame(CMD_TIMEOUT_S), expect_cmd=0x03))
+    return m.pm1, m.pm25, m.pm4, m.pm10
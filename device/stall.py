@@ -0,0 +1,167 @@
+# stall.py
+import array
+import struct
+
+try:
+    import microcontroller
+    _nvm = microcontroller.nvm
+except (ImportError, AttributeError):
+    microcontroller = None
+    _nvm = None
+
+try:
+    from watchdog import WatchDogMode
+except ImportError:
+    WatchDogMode = None
+
+# Last stall, kept in NVM across the reset it causes: magic, stage index
+# (0xFF = unknown), reason, duration in ms. Bytes 0-8 hold the WiFi AP
+# hint (see networking).
+STALL_NVM_OFFSET = 16
+STALL_NVM_MAGIC = 0x5B
+_RECORD = "<BBBI"
+STALL_NVM_LEN = struct.calcsize(_RECORD)
+_UNKNOWN_STAGE = 0xFF
+
+# Every stage that ends within budget feeds the watchdog, so this must be
+# longer than the largest single stage budget plus the untimed code around
+# it, not the sum of stages that may run back to back
+DEFAULT_WATCHDOG_TIMEOUT_S = 45.0
+# How often the feeding task runs
+FEED_EVERY_S = 5.0
+
+
+class StallDetector:
+    """
+    Per-stage time budgets on top of the hardware watchdog.
+
+    Stages are the diagnostics.LatencyStats stages: its stop() calls
+    exit() here, which feeds microcontroller.watchdog (RESET mode) after
+    each stage that kept to its budget; feed() does the same from its own
+    task for idle stretches. Nothing is fed once a stage has overrun. So a
+    stage that hangs (never gets to exit()) or finishes over budget resets
+    the device within timeout_s instead of leaving it frozen.
+
+    An overrun is written to NVM with its stage and duration and reported
+    after the reset (as_dict(); reset() clears it once delivered). A hang
+    can't be attributed: RESET mode leaves no chance to record it, and
+    RAISE mode can't interrupt a hung C call, so it shows up as a watchdog
+    reset of unknown stage.
+    """
+    OVERRUN = 1
+    WATCHDOG = 2
+    _REASONS = {OVERRUN: "overrun", WATCHDOG: "watchdog"}
+
+    def __init__(self, stages, budgets_s, timeout_s=DEFAULT_WATCHDOG_TIMEOUT_S, debug=True):
+        self.stages = tuple(stages)
+        self.timeout_s = float(timeout_s)
+        self.debug = debug
+        self.budget_ms = array.array("i", bytes(4 * len(self.stages)))  # 0 = no budget
+        for name, budget in budgets_s.items():
+            self.budget_ms[self.stages.index(name)] = int(budget * 1000)
+        self.overrun = -1       # first stage over budget since boot
+        self._wdt = None
+        self.last = self._load()
+        if self.last is not None:
+            self._log("Last reset: %s" % self._describe(self.last))
+
+    def _log(self, msg):
+        if self.debug:
+            print(msg)
+
+    def _describe(self, rec):
+        stage, reason, ms = rec
+        name = self.stages[stage] if stage < len(self.stages) else "unknown stage"
+        if reason == StallDetector.OVERRUN:
+            return "%s overran its budget (%d ms)" % (name, ms)
+        return "watchdog reset in %s" % name
+
+    def _load(self):
+        if _nvm is None:
+            return None
+        try:
+            raw = bytes(_nvm[STALL_NVM_OFFSET:STALL_NVM_OFFSET + STALL_NVM_LEN])
+            magic, stage, reason, ms = struct.unpack(_RECORD, raw)
+        except Exception:
+            return None
+        if magic == STALL_NVM_MAGIC and reason in StallDetector._REASONS:
+            return stage, reason, ms
+        # No overrun on record, but the watchdog fired: something hung.
+        try:
+            if microcontroller.cpu.reset_reason == microcontroller.ResetReason.WATCHDOG:
+                return _UNKNOWN_STAGE, StallDetector.WATCHDOG, 0
+        except AttributeError:
+            pass
+        return None
+
+    def _save(self, stage, reason, ms):
+        if _nvm is None:
+            return
+        try:
+            _nvm[STALL_NVM_OFFSET:STALL_NVM_OFFSET + STALL_NVM_LEN] = struct.pack(
+                _RECORD, STALL_NVM_MAGIC, stage, reason, min(ms, 0xFFFFFFFF))
+        except Exception as e:
+            self._log(f"Could not save stall record: {e}")
+
+    def start(self):
+        """
+        Arms the hardware watchdog (if the port has one). Returns True if
+        it is running.
+        """
+        if microcontroller is None or WatchDogMode is None or self.timeout_s <= 0:
+            return False
+        try:
+            wdt = microcontroller.watchdog
+            wdt.timeout = self.timeout_s
+            wdt.mode = WatchDogMode.RESET
+            wdt.feed()
+        except Exception as e:
+            self._log(f"Watchdog unavailable: {e}")
+            return False
+        self._wdt = wdt
+        self._log("Watchdog armed (%ds)" % self.timeout_s)
+        return True
+
+    def exit(self, stage, ms):
+        budget = self.budget_ms[stage]
+        if budget and ms > budget and self.overrun < 0:
+            self.overrun = stage
+            self._log("Stall: %s took %d ms (budget %d ms); letting the watchdog reset"
+                      % (self.stages[stage], ms, budget))
+            self._save(stage, StallDetector.OVERRUN, ms)
+        self.feed()
+
+    def feed(self):
+        """
+        Feeds the watchdog unless a stage overran. Returns True if fed.
+        """
+        if self._wdt is None or self.overrun >= 0:
+            return False
+        self._wdt.feed()
+        return True
+
+    def as_dict(self):
+        """
+        The stall behind the last reset, or None.
+        """
+        if self.last is None:
+            return None
+        stage, reason, ms = self.last
+        return {
+            "stage": self.stages[stage] if stage < len(self.stages) else None,
+            "reason": StallDetector._REASONS[reason],
+            "ms": ms,
+        }
+
+    def reset(self):
+        """
+        Forgets the reported stall (and clears it from NVM).
+        """
+        if self.last is None:
+            return
+        self.last = None
+        if _nvm is not None and self.overrun < 0:
+            try:
+                _nvm[STALL_NVM_OFFSET] = 0
+            except Exception:
+                pass
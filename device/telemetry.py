@@ -1,31 +1,91 @@
-import time
 import json
 import os
+import array
+import struct
+
+import timing
+from retry import RetryPolicy
+from http_client import STEP_EVERY_S
 
 
 try:
     import adafruit_hashlib
+    _new_sha256 = adafruit_hashlib.sha256
     def _sha256(data: bytes) -> bytes:
-        h = adafruit_hashlib.sha256()
+        h = _new_sha256()
         h.update(data)
         return h.digest()
 except ImportError:
     raise RuntimeError("No SHA256 available. Install adafruit_hashlib (adafruit_hashlib.mpy in /lib).")
 
 
-# Only allow server-approved fields (unknown fields rejected server-side)
-ALLOWED_FIELDS = {
-    "pm25_ugm3",
-    "aqi_us",
-    "co2_ppm",
-    "voc_ppm",
-    "voc_index",
-    "temp_c",
-    "rh_pct",
+# Only allow server-approved fields (unknown fields rejected server-side).
+# (key, decimals) in the fixed order they are serialized; 0 decimals = integer.
+FIELDS = (
+    ("pm1_ugm3", 1),
+    ("pm25_ugm3", 1),
+    ("pm4_ugm3", 1),
+    ("pm10_ugm3", 1),
+    ("nc05_pcm3", 1),
+    ("nc1_pcm3", 1),
+    ("nc25_pcm3", 1),
+    ("nc4_pcm3", 1),
+    ("nc10_pcm3", 1),
+    ("tps_um", 2),
+    ("aqi_us", 0),
+    ("co2_ppm", 0),
+    ("voc_ppm", 3),
+    ("voc_index", 0),
+    ("temp_c", 2),
+    ("rh_pct", 1),
+)
+FIELD_KEYS = tuple(k for k, _ in FIELDS)
+ALLOWED_FIELDS = set(FIELD_KEYS)
+_FIELD_IDS = {k: i for i, k in enumerate(FIELD_KEYS)}
+
+def metric_id(key):
+    """
+    Fixed ID (index into FIELDS) for a metric name. Resolve once and pass
+    the ID to update_metric() on hot paths.
+    """
+    mid = _FIELD_IDS.get(key)
+    if mid is None:
+        raise ValueError("Metric key not allowed: %s" % key)
+    return mid
+
+# Change needed before a metric is sent again: (absolute, relative to the
+# last sent value); the larger of the two applies. (0, 0) sends every reading.
+DEFAULT_DEADBANDS = {
+    "pm1_ugm3": (0.5, 0.05),
+    "pm25_ugm3": (0.5, 0.05),
+    "pm4_ugm3": (0.5, 0.05),
+    "pm10_ugm3": (0.5, 0.05),
+    "nc05_pcm3": (1.0, 0.05),
+    "nc1_pcm3": (1.0, 0.05),
+    "nc25_pcm3": (1.0, 0.05),
+    "nc4_pcm3": (1.0, 0.05),
+    "nc10_pcm3": (1.0, 0.05),
+    "tps_um": (0.05, 0.0),
+    "aqi_us": (1, 0.0),
+    "co2_ppm": (10, 0.02),
+    "voc_ppm": (0.005, 0.05),
+    "voc_index": (1, 0.0),
+    "temp_c": (0.1, 0.0),
+    "rh_pct": (0.5, 0.0),
 }
 
 DEFAULT_STALE_S = 300.0  # 5 minutes
+DEFAULT_HEARTBEAT_S = 600.0  # re-send an unchanged metric at least this often
 DEFAULT_POST_EVERY_S = 60.0
+DEFAULT_RING_CAPACITY = 240  # rows; 4 hours at one row per minute
+DEFAULT_BATCH_MAX = 8        # rows per batch request
+DEFAULT_DRAIN_EVERY_S = 2.0  # pause between requests while draining a backlog
+# Rows older than this are dropped unsent; row ages must stay well inside
+# the tick range (see timing).
+MAX_ROW_AGE_S = 2 * 24 * 60 * 60
+BODY_BUF_SIZE = 4096
+
+NAN = float("nan")
 
 def load_device_credentials():
     """
@@ -41,133 +101,673 @@ def load_device_credentials():
 
     return device_id, device_secret
 
+_HEX_DIGITS = b"0123456789abcdef"
+
+def _hexlify_into(b, out):
+    # CP-safe hex without binascii; writes 2 * len(b) ASCII bytes into out
+    i = 0
+    for x in b:
+        out[i] = _HEX_DIGITS[x >> 4]
+        out[i + 1] = _HEX_DIGITS[x & 0x0F]
+        i += 2
+    return i
+
 def _hexlify(b: bytes) -> str:
-    # CP-safe hex without binascii
-    return "".join("{:02x}".format(x) for x in b)
+    out = bytearray(2 * len(b))
+    _hexlify_into(b, out)
+    return out.decode()
+
+class HmacSigner:
+    """
+    HMAC-SHA256 per RFC 2104, keyed with the hex SHA-256 of the device secret.
+    Key derivation and both pads are computed once. If the hash object
+    supports copy(), the pads are also absorbed once and each sign() only
+    hashes the body and the inner digest.
+    """
+    BLOCK_SIZE = 64
+
+    def __init__(self, secret_str):
+        key = _hexlify(_sha256(secret_str)).encode("utf-8")
+        if len(key) > HmacSigner.BLOCK_SIZE:
+            key = _sha256(key)
+
+        i_key_pad = bytearray(b"\x36" * HmacSigner.BLOCK_SIZE)
+        o_key_pad = bytearray(b"\x5c" * HmacSigner.BLOCK_SIZE)
+        for i, b in enumerate(key):
+            i_key_pad[i] = b ^ 0x36
+            o_key_pad[i] = b ^ 0x5C
+        self._i_key_pad = bytes(i_key_pad)
+        self._o_key_pad = bytes(o_key_pad)
+
+        self._inner = None
+        self._outer = None
+        try:
+            inner = _new_sha256()
+            inner.update(self._i_key_pad)
+            outer = _new_sha256()
+            outer.update(self._o_key_pad)
+            inner.copy()
+            self._inner = inner
+            self._outer = outer
+        except Exception:
+            pass  # no copy(): re-absorb the pads on every sign()
+
+        self._hex = bytearray(2 * 32)
+
+    def _begin(self, state, pad):
+        if state is not None:
+            return state.copy()
+        h = _new_sha256()
+        h.update(pad)
+        return h
+
+    def sign(self, body_bytes):
+        inner = self._begin(self._inner, self._i_key_pad)
+        inner.update(body_bytes)
+        outer = self._begin(self._outer, self._o_key_pad)
+        outer.update(inner.digest())
+        _hexlify_into(outer.digest(), self._hex)
+        return self._hex.decode()
 
 def _hmac_sha256_hex(secret_str, body_bytes):
-    # HMAC-SHA256 per RFC 2104
-    key = _hexlify(_sha256(secret_str)).encode("utf-8")
-    block_size = 64
+    # One-shot signing; long-lived callers should keep an HmacSigner.
+    return HmacSigner(secret_str).sign(body_bytes)
 
-    print(f"key {key} size {len(key)}")
-    if len(key) > block_size:
-        key = _sha256(key)
-    if len(key) < block_size:
-        key = key + b"\x00" * (block_size - len(key))
+_POW10 = (1, 10, 100, 1000, 10000)
+# Largest magnitude JsonBodyWriter.number() writes (7 integer digits, as
+# row_max assumes); bigger values, e.g. a bad sensor read, are clamped.
+NUMBER_MAX = 9999999
 
-    o_key_pad = bytes((b ^ 0x5C) for b in key)
-    i_key_pad = bytes((b ^ 0x36) for b in key)
+class JsonBodyWriter:
+    """
+    Builds JSON ingest bodies in a reusable bytearray, in FIELDS order,
+    formatting numbers by hand so steady-state posts don't allocate strings.
+    body() returns a memoryview that stays valid until the next reset().
+    """
+    CONTENT_TYPE = "application/json"
+
+    def __init__(self, size=BODY_BUF_SIZE):
+        self.buf = bytearray(size)
+        self._mv = memoryview(self.buf)
+        self.n = 0
+        self._first = True
+        self._keys = tuple(('"%s":' % k).encode("utf-8") for k in FIELD_KEYS)
+        self._agg_keys = tuple(
+            tuple(('"%s_%s":' % (k, suffix)).encode("utf-8") for suffix in ("min", "max", "n"))
+            for k in FIELD_KEYS
+        )
+        # Upper bound for one aggregated row object: per metric four keys,
+        # each with a sign, 7 integer digits, a point, the decimals and a
+        # comma; plus the age field and braces.
+        self.row_max = sum(4 * (len(k) + 14 + d) for k, (_, d) in zip(self._keys, FIELDS)) + 24
+
+    def reset(self):
+        self.n = 0
+
+    def room(self):
+        return len(self.buf) - self.n
+
+    def body(self):
+        return self._mv[:self.n]
+
+    def put(self, data):
+        n = self.n
+        if n + len(data) > len(self.buf):
+            raise ValueError("JSON body buffer full")
+        self.buf[n:n + len(data)] = data
+        self.n = n + len(data)
+
+    def put_byte(self, b):
+        if self.n >= len(self.buf):
+            raise ValueError("JSON body buffer full")
+        self.buf[self.n] = b
+        self.n += 1
+
+    def open_object(self):
+        self.put_byte(0x7B)  # {
+        self._first = True
+
+    def close_object(self):
+        self.put_byte(0x7D)  # }
+
+    def _key(self, key):
+        if not self._first:
+            self.put_byte(0x2C)  # ,
+        self._first = False
+        self.put(key)
+
+    def number(self, value, decimals):
+        """
+        Appends value with the given decimals, clamped to +/-NUMBER_MAX.
+        NaN (not a JSON number) and a full buffer raise ValueError.
+        """
+        if value != value:
+            raise ValueError("NaN is not a JSON number")
+        buf = self.buf
+        n = self.n
+        # Sign, 7 integer digits, point, decimals
+        if len(buf) - n < 9 + decimals:
+            raise ValueError("JSON body buffer full")
+        if value > NUMBER_MAX:
+            value = NUMBER_MAX
+        elif value < -NUMBER_MAX:
+            value = -NUMBER_MAX
+        if value < 0:
+            buf[n] = 0x2D  # -
+            n += 1
+            value = -value
+        scale = _POW10[decimals]
+        scaled = int(value * scale + 0.5)
+        ip = scaled // scale
+
+        start = n
+        while True:
+            buf[n] = 0x30 + ip % 10
+            n += 1
+            ip //= 10
+            if not ip:
+                break
+        i, j = start, n - 1
+        while i < j:
+            buf[i], buf[j] = buf[j], buf[i]
+            i += 1
+            j -= 1
+
+        if decimals:
+            fp = scaled % scale
+            buf[n] = 0x2E  # .
+            n += 1
+            for i in range(n + decimals - 1, n - 1, -1):
+                buf[i] = 0x30 + fp % 10
+                fp //= 10
+            n += decimals
+        self.n = n
+
+    def field(self, idx, value):
+        """
+        Appends FIELDS[idx] = value to the open object. Non-finite values
+        (NaN marks an absent metric) are skipped.
+        Returns True if the field was written.
+        """
+        if value - value != 0:  # NaN or +/-inf
+            return False
+        self._key(self._keys[idx])
+        self.number(value, FIELDS[idx][1])
+        return True
+
+    def row(self, ring, i, now=None, clock=None, aggregates=True):
+        """
+        Appends ring row i as an object. With now, the row carries its age
+        in whole seconds as "age_s"; with a clock, its UTC epoch time as
+        "ts" instead. Aggregated rows add <key>_min/_max/_n fields unless
+        aggregates is False, leaving the mean under the plain key.
+        """
+        self.open_object()
+        if clock is not None:
+            self._key(b'"ts":')
+            self.number(clock.unix(ring.ts(i)), 0)
+        elif now is not None:
+            self._key(b'"age_s":')
+            self.number(timing.diff_s(now, ring.ts(i)), 0)
+        values = ring.values
+        at = ring.base(i)
+        stride = ring.stride
+        aggregates = aggregates and stride == SampleRing.AGGREGATE_STRIDE
+        for idx in range(len(FIELDS)):
+            if self.field(idx, values[at]) and aggregates:
+                keys = self._agg_keys[idx]
+                decimals = FIELDS[idx][1]
+                self._key(keys[0])
+                self.number(values[at + 1], decimals)
+                self._key(keys[1])
+                self.number(values[at + 2], decimals)
+                self._key(keys[2])
+                self.number(values[at + 3], 0)
+            at += stride
+        self.close_object()
+
+    def encode(self, ring, limit, now, batch, clock=None):
+        """
+        Serializes the oldest ring rows. Without batch, row 0 alone as a
+        plain object with only the existing keys (the plain endpoint rejects
+        unknown fields, so an aggregated row sends just its means); with batch, {"batch": [row, ...]} with as many rows as
+        fit, up to limit, stamped by clock (a synced clock.ClockService) or
+        else by age. Returns the number of rows written.
+        """
+        self.reset()
+        if not batch:
+            self.row(ring, 0, aggregates=False)
+            return 1
+        self.put(b'{"batch":[')
+        rows = 0
+        limit = min(ring.count, limit)
+        while rows < limit and self.room() > self.row_max + 2:
+            if rows:
+                self.put_byte(0x2C)  # ,
+            self.row(ring, rows, now, clock)
+            rows += 1
+        self.put(b"]}")
+        return rows
+
+
+BINARY_VERSION = 1
+BINARY_FLAG_AGES = 0x01
+BINARY_FLAG_AGGREGATES = 0x02
+BINARY_FLAG_TIMESTAMPS = 0x04
+
+class BinaryBodyWriter:
+    """
+    Compact ingest encoding, little-endian:
+      header: u8 version, u8 flags, u16 row count
+      row:    [u32 age_s if flags & BINARY_FLAG_AGES, or u32 UTC epoch
+              seconds if flags & BINARY_FLAG_TIMESTAMPS] u32 present mask,
+              then per set bit, lowest metric ID first, one f32 value or,
+              with BINARY_FLAG_AGGREGATES, f32 mean, f32 min, f32 max, u16 n
+    A metric's ID is its index in FIELDS.
+    """
+    CONTENT_TYPE = "application/x-aqm-telemetry-v1"
+
+    def __init__(self, size=BODY_BUF_SIZE):
+        self.buf = bytearray(size)
+        self._mv = memoryview(self.buf)
+        self.n = 0
+        self.row_max = 8 + 14 * len(FIELDS)
+
+    def reset(self):
+        self.n = 0
+
+    def body(self):
+        return self._mv[:self.n]
+
+    def row(self, ring, i, now=None, clock=None):
+        buf = self.buf
+        n = self.n
+        if clock is not None:
+            struct.pack_into("<I", buf, n, clock.unix(ring.ts(i)))
+            n += 4
+        elif now is not None:
+            struct.pack_into("<I", buf, n, max(0, int(timing.diff_s(now, ring.ts(i)))))
+            n += 4
+        mask_at = n
+        n += 4
+        mask = 0
+        values = ring.values
+        at = ring.base(i)
+        stride = ring.stride
+        for idx in range(len(FIELDS)):
+            v = values[at]
+            if v - v == 0:  # NaN = absent
+                if stride == SampleRing.AGGREGATE_STRIDE:
+                    struct.pack_into("<fffH", buf, n, v, values[at + 1], values[at + 2], int(values[at + 3]))
+                    n += 14
+                else:
+                    struct.pack_into("<f", buf, n, v)
+                    n += 4
+                mask |= 1 << idx
+            at += stride
+        struct.pack_into("<I", buf, mask_at, mask)
+        self.n = n
+
+    def encode(self, ring, limit, now, batch, clock=None):
+        """
+        Same contract as JsonBodyWriter.encode(); a non-batch body is a
+        one-row record without ages.
+        """
+        self.n = 4
+        rows = 0
+        if not batch:
+            clock = None
+        limit = min(ring.count, limit) if batch else 1
+        while rows < limit and len(self.buf) - self.n >= self.row_max:
+            self.row(ring, rows, now if batch else None, clock)
+            rows += 1
+        flags = 0
+        if clock is not None:
+            flags = BINARY_FLAG_TIMESTAMPS
+        elif batch:
+            flags = BINARY_FLAG_AGES
+        if ring.stride == SampleRing.AGGREGATE_STRIDE:
+            flags |= BINARY_FLAG_AGGREGATES
+        struct.pack_into("<BBH", self.buf, 0, BINARY_VERSION, flags, rows)
+        return rows
+
+
+class SampleRing:
+    """
+    Fixed-capacity, array-backed ring of telemetry rows.
+    A row is a timing tick (ms) plus `stride` floats per
+    FIELDS entry: the value (NaN = not in this row) and, for aggregated
+    rows, the window's min, max and sample count.
+    When full, the oldest row is overwritten. Row 0 is the oldest.
+    Rows are also numbered in append order: row i is number first_seq + i.
+    """
+    AGGREGATE_STRIDE = 4
+
+    def __init__(self, capacity=DEFAULT_RING_CAPACITY, aggregate=False):
+        self.capacity = int(capacity)
+        self.stride = SampleRing.AGGREGATE_STRIDE if aggregate else 1
+        self.width = len(FIELDS) * self.stride
+        # Zero-filled from raw bytes; both typecodes are 4 bytes wide.
+        self._ts = array.array("i", bytes(4 * self.capacity))
+        self.values = array.array("f", bytes(4 * self.capacity * self.width))
+        self._head = 0
+        self.count = 0
+        self.dropped = 0
+        self.first_seq = 0
+
+    def _slot(self, i):
+        return (self._head + i) % self.capacity
+
+    def base(self, i):
+        return self._slot(i) * self.width
+
+    def ts(self, i):
+        return self._ts[self._slot(i)]
+
+    def append(self, ts):
+        """
+        Starts a new newest row with every value absent; returns its base
+        offset into `values`.
+        """
+        if self.count == self.capacity:
+            self._head = (self._head + 1) % self.capacity
+            self.count -= 1
+            self.first_seq += 1
+            self.dropped += 1
+        slot = self._slot(self.count)
+        self.count += 1
+        self._ts[slot] = int(ts)
+        base = slot * self.width
+        values = self.values
+        for idx in range(base, base + self.width):
+            values[idx] = NAN
+        return base
+
+    def pop_newest(self):
+        if self.count:
+            self.count -= 1
+
+    def drop_oldest(self, n):
+        n = min(n, self.count)
+        self._head = (self._head + n) % self.capacity
+        self.count -= n
+        self.first_seq += n
+
+    def drop_before(self, seq):
+        """
+        Drops the rows numbered below seq that are still in the ring.
+        """
+        if seq > self.first_seq:
+            self.drop_oldest(seq - self.first_seq)
+
+    def drop_older_than(self, now, max_age_s):
+        n = 0
+        while n < self.count and timing.diff_s(now, self.ts(n)) > max_age_s:
+            n += 1
+        if n:
+            self.dropped += n
+            self.drop_oldest(n)
+        return n
 
-    inner = _sha256(i_key_pad + body_bytes)
-    mac = _sha256(o_key_pad + inner)
 
-    # hex encoding without binascii dependency
-    return "".join("{:02x}".format(b) for b in mac)
+def _float_array(n, fill=0.0):
+    a = array.array("f", bytes(4 * n))
+    if fill:
+        for i in range(n):
+            a[i] = fill
+    return a
+
 
 class MetricStore:
     """
-    Stores latest metric values with timestamps and last-sent timestamps.
+    Stores latest metric values with timestamps and last-sent timestamps,
+    plus a running min/max/sum/count window that each capture() closes.
+    capture() skips metrics that stayed within their deadband since they
+    were last sent, until heartbeat_s has passed.
+    State lives in parallel arrays indexed by metric ID (see metric_id());
+    timestamps are timing ticks, NaN marks "never updated" / "never sent"
+    and `unsent` flags readings no capture has taken yet. Every capture
+    checks those ages, so none is left long enough for its tick to wrap.
     """
-    def __init__(self):
-        # key -> {"value": v, "ts": t, "sent_ts": t or None}
-        self._m = {}
+    def __init__(self, deadbands=None, heartbeat_s=DEFAULT_HEARTBEAT_S):
+        n = len(FIELDS)
+        self.value = _float_array(n, NAN)
+        self.ts = array.array("i", bytes(4 * n))
+        self.unsent = bytearray(n)
+        self.sent_value = _float_array(n, NAN)
+        self.sent_at = array.array("i", bytes(4 * n))
+        self.lo = _float_array(n)
+        self.hi = _float_array(n)
+        self.total = _float_array(n)
+        self.count = array.array("i", bytes(4 * n))
+
+        if deadbands is None:
+            deadbands = DEFAULT_DEADBANDS
+        self.db_abs = _float_array(n)
+        self.db_rel = _float_array(n)
+        for key, (band_abs, band_rel) in deadbands.items():
+            mid = metric_id(key)
+            self.db_abs[mid] = band_abs
+            self.db_rel[mid] = band_rel
+        self.heartbeat_s = float(heartbeat_s)
 
     def update(self, key, value, ts=None):
-        if key not in ALLOWED_FIELDS:
-            raise ValueError("Metric key not allowed: %s" % key)
+        """
+        key is a metric ID, or a name (resolved on every call).
+        """
+        mid = key if isinstance(key, int) else metric_id(key)
         if ts is None:
-            ts = time.monotonic()
-        rec = self._m.get(key)
-        if rec is None:
-            self._m[key] = {"value": value, "ts": ts, "sent_ts": None}
+            ts = timing.ticks_ms()
+        self.value[mid] = value
+        self.ts[mid] = ts
+        self.unsent[mid] = 1
+        if self.count[mid]:
+            if value < self.lo[mid]:
+                self.lo[mid] = value
+            if value > self.hi[mid]:
+                self.hi[mid] = value
+            self.total[mid] += value
+            self.count[mid] += 1
         else:
-            rec["value"] = value
-            rec["ts"] = ts
+            self.lo[mid] = self.hi[mid] = self.total[mid] = value
+            self.count[mid] = 1
+
+    def _fresh(self, mid, now, stale_s):
+        if not self.unsent[mid]:
+            return False
+        if timing.diff_s(now, self.ts[mid]) > stale_s:
+            # Gone stale unsent: drop it, and send the next reading in full
+            self.unsent[mid] = 0
+            self.sent_value[mid] = NAN
+            return False
+        return True
 
     def build_payload(self, now=None, stale_s=DEFAULT_STALE_S):
         """
         Returns (payload_dict, keys_included).
         Includes only metrics that:
           - are not stale (now - ts <= stale_s)
-          - have ts > sent_ts (i.e., not reported before)
+          - were updated since last reported
         """
         if now is None:
-            now = time.monotonic()
+            now = timing.ticks_ms()
 
         payload = {}
         included = []
 
-        for k, rec in self._m.items():
-            ts = rec["ts"]
-            sent_ts = rec["sent_ts"]
-
-            if (now - ts) > stale_s:
-                continue
-            if sent_ts is not None and ts <= sent_ts:
+        for mid, (k, decimals) in enumerate(FIELDS):
+            if not self._fresh(mid, now, stale_s):
                 continue
-
-            payload[k] = rec["value"]
+            value = self.value[mid]
+            payload[k] = int(value) if decimals == 0 else value
             included.append(k)
 
         return payload, included
 
+    def _within_deadband(self, mid, lo, hi):
+        sent_value = self.sent_value[mid]
+        if sent_value != sent_value:
+            return False
+        threshold = max(self.db_abs[mid], self.db_rel[mid] * abs(sent_value))
+        return abs(lo - sent_value) < threshold and abs(hi - sent_value) < threshold
+
+    def capture(self, ring, now=None, stale_s=DEFAULT_STALE_S):
+        """
+        Appends one row to ring holding the metrics build_payload() would
+        select, minus those still inside their deadband, and marks them
+        sent; from here on the ring owns delivery. An aggregating ring gets
+        the window mean/min/max/count instead of the last value, and the
+        deadband test covers the whole window so peaks are never dropped.
+        Returns the number of metrics captured (0 = no row appended).
+        """
+        if now is None:
+            now = timing.ticks_ms()
+
+        base = ring.append(now)
+        values = ring.values
+        stride = ring.stride
+        aggregate = stride == SampleRing.AGGREGATE_STRIDE
+        count = 0
+        at = base
+        for mid in range(len(FIELDS)):
+            n = self.count[mid]
+            self.count[mid] = 0  # every capture closes the window
+            sent_value = self.sent_value[mid]
+            if sent_value == sent_value and timing.diff_s(now, self.sent_at[mid]) >= self.heartbeat_s:
+                self.sent_value[mid] = NAN  # heartbeat due: next reading goes out
+            if self._fresh(mid, now, stale_s):
+                if aggregate and n:
+                    value = self.total[mid] / n
+                    lo = self.lo[mid]
+                    hi = self.hi[mid]
+                else:
+                    value = lo = hi = self.value[mid]
+                if not self._within_deadband(mid, lo, hi):
+                    values[at] = value
+                    if aggregate:
+                        values[at + 1] = lo
+                        values[at + 2] = hi
+                        values[at + 3] = n if n else 1
+                    self.unsent[mid] = 0
+                    self.sent_value[mid] = value
+                    self.sent_at[mid] = now
+                    count += 1
+            at += stride
+        if not count:
+            ring.pop_newest()
+        return count
+
     def mark_sent(self, keys, now=None):
         """
-        Mark included keys as sent at their current reading timestamp.
+        Mark included keys' current readings as sent.
         """
         for k in keys:
-            rec = self._m.get(k)
-            if rec is not None:
-                rec["sent_ts"] = rec["ts"]
+            self.unsent[metric_id(k)] = 0
 
 
 class IngestClient:
-    def __init__(self, requests_session, ingest_url, device_id, device_secret):
-        self.requests = requests_session
+    """
+    Signs and posts ingest bodies through a shared http_client.HttpClient.
+    start() begins a POST; poll() returns its result once the client has
+    finished it, so the main loop only waits on the network while a
+    connection is set up (see http_client).
+    """
+    def __init__(self, http, ingest_url, device_id, device_secret, signer=None, batch_url=None,
+                 content_type="application/json", timeout=6.0):
+        self.http = http
         self.url = ingest_url
+        self.batch_url = batch_url or ingest_url
         self.device_id = device_id
         self.device_secret = device_secret
+        self.signer = signer if signer is not None else HmacSigner(device_secret)
+        self.timeout = float(timeout)
+        self._headers = {
+            "Content-Type": content_type,
+            "X-Device-Id": device_id,
+            "X-Signature": "",
+        }
+        self._inflight = None   # HttpClient running our request
+
+    def busy(self):
+        return self._inflight is not None
+
+    def start(self, body, batch=False, now=None):
+        """
+        Begins posting an already-serialized body (bytes or memoryview) with
+        an HMAC signature over exactly those bytes; body must stay untouched
+        until poll() returns a result. Batch bodies go to batch_url.
+        Returns False if the HTTP client is busy with another request.
+        """
+        http = self.http
+        if http is None or http.state != http.IDLE:
+            return False
+        headers = self._headers
+        headers["X-Signature"] = self.signer.sign(body)
+        url = self.batch_url if batch else self.url
+        print(f"Posting telemetry at {url}")
+        http.start(self, "POST", url, body=body, headers=headers, timeout=self.timeout, now=now)
+        self._inflight = http
+        return True
+
+    def poll(self):
+        """
+        Returns None while the POST is in flight, then
+        (ok_bool, server_ts_or_None, status_code).
+        """
+        http = self._inflight
+        if http is None:
+            return False, None, -1
+        if http.owner is not self:
+            # The client was reset underneath us (e.g. WiFi dropped)
+            self._inflight = None
+            return False, None, -1
+        if not http.finished(self):
+            return None
+        self._inflight = None
+
+        if http.state == http.FAILED:
+            print(f"Telemetry exception {http.error}")
+            http.release()
+            return False, None, -1
+
+        status = http.status
+        # Expect {"ok": true, "ts": ...}
+        server_ts = None
+        ok = False
+        try:
+            j = http.json()
+            ok = bool(j.get("ok", False))
+            server_ts = j.get("ts")
+        except Exception:
+            ok = (200 <= status < 300)
+        http.release()
+        print(f"Telemetry status code {status}")
+        return ok and (200 <= status < 300), server_ts, status
+
+    def post_body(self, body, batch=False):
+        """
+        Blocking variant of start()/poll().
+        Returns (ok_bool, server_ts_or_None, status_code)
+        """
+        if not self.start(body, batch=batch):
+            return False, None, -1
+        while True:
+            self.http.step()
+            result = self.poll()
+            if result is not None:
+                return result
 
     def post_metrics(self, payload):
         """
-        Sends payload with HMAC signature over raw body bytes.
+        Sends payload with HMAC signature over raw body bytes (blocking).
         Returns (ok_bool, server_ts_or_None, status_code)
         """
         if not payload:
             return True, None, 0
 
-        # Canonicalize JSON to avoid accidental whitespace differences
         # CircuitPython json.dumps may not support sort_keys/separators.
         # We just sign exactly what we send.
-        body = json.dumps(payload).encode("utf-8")
-        sig = _hmac_sha256_hex(self.device_secret, body)
-
-        headers = {
-            "Content-Type": "application/json",
-            "X-Device-Id": self.device_id,
-            "X-Signature": sig,
-        }
-
-        try:
-            print(f"Posting telemetry at {self.url}")
-            r = self.requests.post(self.url, data=body, headers=headers, timeout=6)
-            status = r.status_code
-            # Expect {"ok": true, "ts": ...}
-            server_ts = None
-            ok = False
-            try:
-                j = r.json()
-                ok = bool(j.get("ok", False))
-                server_ts = j.get("ts")
-            except Exception:
-                ok = (200 <= status < 300)
-            r.close()
-            print(f"Telemetry status code {status}")
-            return ok and (200 <= status < 300), server_ts, status
-        except Exception as e:
-            print(f"Telemetry exception {e}")
-            return False, None, -1
+        return self.post_body(json.dumps(payload).encode("utf-8"))
 
 
 class TelemetryManager:
@@ -175,49 +775,157 @@ class TelemetryManager:
     Owns MetricStore + ingest scheduling.
     Call:
       - update_metric(...) whenever a sensor updates
-      - tick(...) frequently; it posts at most once per post_every_s
+      - tick(...) frequently; once per post_every_s it captures fresh metrics
+        into the offline ring, and whenever a session is available it
+        uploads the ring: the newest row alone, or the backlog in batches.
+    Batches need a server endpoint for them (batch_url). Without one only
+    the newest row is sent, and only while fresher than stale_s: the plain
+    endpoint stamps rows on arrival, so a backlog would be stored as
+    current data.
     """
-    def __init__(self, ingest_url, device_id, device_secret, post_every_s=DEFAULT_POST_EVERY_S, stale_s=DEFAULT_STALE_S):
-        self.store = MetricStore()
+    def __init__(self, ingest_url, device_id, device_secret, post_every_s=DEFAULT_POST_EVERY_S, stale_s=DEFAULT_STALE_S,
+                 batch_url=None, ring_capacity=DEFAULT_RING_CAPACITY, batch_max=DEFAULT_BATCH_MAX,
+                 drain_every_s=DEFAULT_DRAIN_EVERY_S, encoding="json", deadbands=None,
+                 heartbeat_s=DEFAULT_HEARTBEAT_S, aggregate=False, clock=None, wall_clock_ts=False):
+        self.store = MetricStore(deadbands=deadbands, heartbeat_s=heartbeat_s)
+        self.ring = SampleRing(ring_capacity, aggregate=aggregate)
         self.ingest_url = ingest_url
+        self.batch_url = batch_url
         self.device_id = device_id
         self.device_secret = device_secret
+        self.signer = HmacSigner(device_secret)
+        if encoding == "binary":
+            self.writer = BinaryBodyWriter()
+        elif encoding == "json":
+            self.writer = JsonBodyWriter()
+        else:
+            raise ValueError("Unknown telemetry encoding: %s" % encoding)
         self.post_every_s = float(post_every_s)
         self.stale_s = float(stale_s)
-        self._next_post = 0.0
+        self.batch_max = int(batch_max)
+        self.drain_every_s = float(drain_every_s)
+        self._next_post = None   # ticks; None = now
+        self._next_send = None
+        self._inflight_rows = 0
+        self._inflight_end = 0  # ring row number after the last row in flight
+        self._started_at = 0
+        # Failed uploads back off from one post interval up to ten
+        self.retry = RetryPolicy("Ingest", base_s=self.post_every_s, max_s=10 * self.post_every_s)
+        # clock.ClockService fed with server "ts" values; with wall_clock_ts,
+        # batch rows carry its UTC times instead of ages while it is synced.
+        self.clock = clock
+        self.wall_clock_ts = bool(wall_clock_ts)
+        self._client = IngestClient(
+            http=None,
+            ingest_url=ingest_url,
+            device_id=device_id,
+            device_secret=device_secret,
+            signer=self.signer,
+            batch_url=batch_url,
+            content_type=self.writer.CONTENT_TYPE,
+        )
 
     def update_metric(self, key, value, ts=None):
         self.store.update(key, value, ts=ts)
 
-    def tick(self, requests_session, now=None):
+    def tick(self, http, now=None):
         """
-        If due, posts all non-stale, not-yet-sent metrics.
-        Only marks as sent on successful POST.
+        Captures metrics when due and, given an HttpClient (None while
+        offline), starts uploading pending rows; an upload in flight is
+        finished on later ticks. Rows leave the ring only after a
+        successful POST.
+        Returns None unless an upload finished this tick, else whether it
+        succeeded.
         """
         if now is None:
-            now = time.monotonic()
-
-        if now < self._next_post:
-            return False
-
-        self._next_post = now + self.post_every_s
-
-        payload, keys = self.store.build_payload(now=now, stale_s=self.stale_s)
-        if not payload:
-            return False
-
-        client = IngestClient(
-            requests_session=requests_session,
-            ingest_url=self.ingest_url,
-            device_id=self.device_id,
-            device_secret=self.device_secret,
-        )
-        ok, server_ts, status = client.post_metrics(payload)
-
+            now = timing.ticks_ms()
+
+        ring = self.ring
+        client = self._client
+        if self._next_post is None or timing.due(now, self._next_post):
+            self._next_post = timing.add_s(now, self.post_every_s)
+            if self._next_send is not None and timing.due(now, self._next_send):
+                self._next_send = None   # passed; don't let it age into a wrap
+            self.retry.expire(now)
+            if not client.busy():
+                ring.drop_older_than(now, MAX_ROW_AGE_S)
+            self.store.capture(ring, now=now, stale_s=self.stale_s)
+
+        if client.busy():
+            result = client.poll()
+            if result is None:
+                return None
+            return self._finish(result, now)
+
+        if http is None or not ring.count or not self._send_due(now) or not self.retry.ready(now):
+            return None
+        if http.state != http.IDLE:
+            return None   # healthcheck in flight; try again next tick
+
+        # A lone, just-captured row goes out without ages; the server
+        # timestamps it on arrival. Anything older is sent as a batch.
+        if self.batch_url:
+            batch = ring.count > 1 or timing.diff_s(now, ring.ts(0)) >= self.post_every_s
+        else:
+            # No batch endpoint: rows can't carry their age, so the backlog
+            # is dropped and only a fresh newest row goes.
+            ring.drop_older_than(now, self.stale_s)
+            if ring.count > 1:
+                ring.dropped += ring.count - 1
+                ring.drop_oldest(ring.count - 1)
+            if not ring.count:
+                return None
+            batch = False
+        client.http = http
+        clock = self.clock
+        if not (self.wall_clock_ts and clock is not None and clock.synced(now)):
+            clock = None
+        rows = self.writer.encode(ring, self.batch_max, now, batch, clock)
+        if client.start(self.writer.body(), batch=batch, now=now):
+            self._inflight_rows = rows
+            self._inflight_end = ring.first_seq + rows
+            self._started_at = now
+        return None
+
+    def next_due(self, now=None, online=True):
+        """
+        Tick at which tick() next has something to do. Offline, only
+        captures are due.
+        """
+        if now is None:
+            now = timing.ticks_ms()
+        step = timing.add_s(now, STEP_EVERY_S)
+        if self._client.busy():
+            return step
+        due = now if self._next_post is None else self._next_post
+        if online and self.ring.count:
+            # At least one step out: tick() may have found the client busy.
+            send = timing.latest(self.retry.next_attempt_at(now), step)
+            if self._next_send is not None:
+                send = timing.latest(send, self._next_send)
+            due = timing.earliest(due, send)
+        return due
+
+    def _send_due(self, now):
+        return self._next_send is None or timing.due(now, self._next_send)
+
+    def _finish(self, result, now):
+        ok, server_ts, status = result
+        ring = self.ring
+        rows = self._inflight_rows
+        self._inflight_rows = 0
         if ok:
-            self.store.mark_sent(keys)
-            print("Ingest OK status=%s ts=%s payload_keys=%s" % (status, server_ts, keys))
+            if self.clock is not None and server_ts is not None:
+                self.clock.observe(server_ts, self._started_at, now)
+            self.retry.success()
+            # Rows captured meanwhile were appended behind the ones we sent,
+            # and may have evicted some of those from a full ring.
+            ring.drop_before(self._inflight_end)
+            # Keep draining a backlog quickly; otherwise wait for the next capture.
+            self._next_send = timing.add_s(now, self.drain_every_s) if ring.count else None
+            print("Ingest OK status=%s ts=%s rows=%d backlog=%d" % (status, server_ts, rows, ring.count))
         else:
-            print("Ingest FAIL status=%s payload_keys=%s" % (status, keys))
+            delay = self.retry.failure(now)
+            print("Ingest FAIL status=%s rows=%d backlog=%d retry=%ds" % (status, rows, ring.count, delay))
 
         return ok
@@ -0,0 +1,66 @@
+# timing.py
+import time
+
+# Millisecond ticks: a small int that wraps every 2**29 ms (~6.2 days), so
+# it never allocates and never loses precision, unlike time.monotonic()
+# whose float drops to ~0.1 s resolution after a few days of uptime.
+# Compare and offset ticks only through the helpers below; they are valid
+# for differences up to TICKS_HALFPERIOD (~3.1 days), so any deadline a
+# caller may leave unchecked for longer has to be expired or reset first.
+TICKS_PERIOD = 1 << 29
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+MAX_SPAN_S = TICKS_HALFPERIOD // 1000
+
+try:
+    from supervisor import ticks_ms
+except ImportError:
+    # Host Python (tools/, tests)
+    def ticks_ms():
+        return int(time.monotonic() * 1000) & TICKS_MAX
+
+
+def ticks_add(ticks, delta_ms):
+    return (ticks + delta_ms) & TICKS_MAX
+
+
+def ticks_diff(t1, t2):
+    """
+    Signed t1 - t2 in ms, correct across a wrap.
+    """
+    diff = (t1 - t2) & TICKS_MAX
+    return ((diff + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+
+def add_s(ticks, seconds):
+    return (ticks + int(seconds * 1000)) & TICKS_MAX
+
+
+def diff_s(t1, t2):
+    """
+    Signed t1 - t2 in seconds (float).
+    """
+    return ticks_diff(t1, t2) / 1000
+
+
+def due(now, deadline):
+    """
+    True once now has reached deadline.
+    """
+    return ticks_diff(now, deadline) >= 0
+
+
+def earliest(t1, t2):
+    return t1 if ticks_diff(t1, t2) <= 0 else t2
+
+
+def latest(t1, t2):
+    return t1 if ticks_diff(t1, t2) >= 0 else t2
+
+
+def monotonic_at(ticks):
+    """
+    time.monotonic() value corresponding to a nearby tick (for APIs such
+    as alarm.time.TimeAlarm that want one).
+    """
+    return time.monotonic() + diff_s(ticks, ticks_ms())
@@ -0,0 +1,10 @@
+"""
+Benchmarks for device hot paths, run under CPython with the simulator's
+fake modules. Reports ops/sec and heap bytes per call, and fails when a
+case regresses past tools/bench/baseline.json.
+
+    python -m tools.bench              # run all, compare with the baseline
+    python -m tools.bench 'sps30.*'    # a subset
+    python -m tools.bench --update     # store results as the new baseline
+    python -m tools.bench --no-speed   # heap checks only (other hosts / CI)
+"""
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import sys
+
+from . import runner
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(prog="python -m tools.bench", description="Benchmark device hot paths under CPython.")
+    ap.add_argument("patterns", nargs="*", help="case name globs (default: all), e.g. 'sps30.*'")
+    ap.add_argument("--list", action="store_true", help="list cases and exit")
+    ap.add_argument("--update", action="store_true", help="store these results as the new baseline")
+    ap.add_argument("--no-speed", action="store_true",
+                    help="skip timing and check heap use only (for hosts the baseline wasn't made on)")
+    ap.add_argument("--speed-tolerance", type=float, default=0.25, help="allowed speed score drop (default 0.25 = 25%%)")
+    ap.add_argument("--alloc-tolerance", type=float, default=0.10, help="allowed heap bytes/call growth (default 0.10)")
+    ap.add_argument("--min-time", type=float, default=runner.DEFAULT_MIN_TIME_S, help="seconds of timing per case")
+    ap.add_argument("--repeats", type=int, default=runner.DEFAULT_REPEATS)
+    args = ap.parse_args()
+
+    names = runner.select(args.patterns)
+    if args.list:
+        print("\n".join(names))
+        return 0
+    if not names:
+        print("No case matches %s" % " ".join(args.patterns), file=sys.stderr)
+        return 2
+
+    speed = not args.no_speed
+    results = runner.run(names, args.min_time, args.repeats, speed=speed)
+    baseline = runner.load_baseline()
+    cases = baseline.get("cases", {})
+
+    print("%-28s %12s %8s %9s %7s" % ("case", "ops/s", "vs base", "alloc B", "kept B"))
+    for r in results:
+        base = cases.get(r.name)
+        rel = "new"
+        if base and speed and base.get("score"):
+            rel = "%+.0f%%" % (100 * (r.score / base["score"] - 1))
+        elif base:
+            rel = "-"
+        ops = "%.0f" % r.ops_s if speed else "-"
+        print("%-28s %12s %8s %9d %7d" % (r.name, ops, rel, r.alloc_b, r.kept_b))
+
+    if args.update:
+        runner.save_baseline(results)
+        print("Baseline written to %s" % runner.BASELINE_PATH)
+        return 0
+
+    if speed and baseline.get("host") and baseline["host"] != runner.host_info():
+        print("Note: baseline was made on %s; timings may not compare" % baseline["host"], file=sys.stderr)
+    problems = runner.compare(results, baseline, args.speed_tolerance, args.alloc_tolerance, speed=speed)
+    for p in problems:
+        print("REGRESSION %s" % p, file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+Benchmark cases: device hot paths, each set up once and returned as a
+zero-argument callable. Setups run with the simulator's fakes installed,
+so device modules import as they would on the board.
+"""
+from __future__ import annotations
+
+import itertools
+from typing import Callable
+
+CASES: dict[str, Callable[[], Callable[[], object]]] = {}
+
+SECRET = "bench-device-secret"
+# A typical full reading set, in telemetry.FIELDS order
+READING = (
+    9.3, 11.6, 12.7, 13.9, 69.5, 79.9, 80.7, 80.8, 80.9, 0.55,
+    48, 889, 0.094, 100, 22.73, 43.1,
+)
+
+
+def case(name: str):
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+def _filled_store():
+    import telemetry
+    import timing
+    store = telemetry.MetricStore()
+    now = timing.ticks_ms()
+    for mid, value in enumerate(READING):
+        store.update(mid, value, now)
+    return store, now
+
+
+# ---- telemetry ----
+
+@case("telemetry.hmac_oneshot")
+def _hmac_oneshot():
+    import json
+    import telemetry
+    store, now = _filled_store()
+    body = json.dumps(store.build_payload(now)[0]).encode("utf-8")
+    return lambda: telemetry._hmac_sha256_hex(SECRET, body)
+
+
+@case("telemetry.hmac_signer")
+def _hmac_signer():
+    import json
+    import telemetry
+    store, now = _filled_store()
+    body = json.dumps(store.build_payload(now)[0]).encode("utf-8")
+    signer = telemetry.HmacSigner(SECRET)
+    return lambda: signer.sign(body)
+
+
+@case("telemetry.json_dumps")
+def _json_dumps():
+    import json
+    store, now = _filled_store()
+
+    def run():
+        payload, _ = store.build_payload(now)
+        return json.dumps(payload).encode("utf-8")
+    return run
+
+
+@case("telemetry.json_writer")
+def _json_writer():
+    import telemetry
+    store, now = _filled_store()
+    ring = telemetry.SampleRing(4)
+    store.capture(ring, now)
+    writer = telemetry.JsonBodyWriter()
+    return lambda: writer.encode(ring, 1, now, False)
+
+
+@case("metrics.update")
+def _metrics_update():
+    # One call = one reading of every metric
+    import telemetry
+    import timing
+    store = telemetry.MetricStore()
+    now = timing.ticks_ms()
+    pairs = tuple(enumerate(READING))
+
+    def run():
+        for mid, value in pairs:
+            store.update(mid, value, now)
+    return run
+
+
+@case("metrics.build_payload")
+def _metrics_build_payload():
+    store, now = _filled_store()
+    return lambda: store.build_payload(now)
+
+
+# ---- SPS30 SHDLC ----
+
+def _measurement_frame(values=READING[:10]):
+    import struct
+    import sps30_uart
+    data = struct.pack(">10f", *values)
+    payload = bytes([0x00, 0x03, 0x00, len(data)]) + data
+    return payload + bytes([sps30_uart.checksum(payload)])
+
+
+@case("sps30.stuff")
+def _sps30_stuff():
+    import sps30_uart
+    raw = _measurement_frame()
+    return lambda: sps30_uart.stuff_bytes(raw)
+
+
+class FakeUart:
+    """Just what FrameDecoder reads: one whole frame per fill() (it fits)."""
+    __slots__ = ("frame", "in_waiting")
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.in_waiting = 0
+
+    def fill(self):
+        self.in_waiting = len(self.frame)
+
+    def readinto(self, buf):
+        n = self.in_waiting
+        buf[:n] = self.frame
+        self.in_waiting = 0
+        return n
+
+
+@case("sps30.decode_frame")
+def _sps30_decode_frame():
+    # A measurement reply as it arrives on the wire, delimited and stuffed;
+    # these mass concentrations encode 0x7E, 0x7D, 0x11 and 0x13, so each
+    # escape is decoded
+    import sps30_uart
+    delim = bytes([sps30_uart.START_STOP])
+    raw = _measurement_frame((15.875, 15.8125, 9.0625, 9.1875) + READING[4:10])
+    uart = FakeUart(delim + sps30_uart.stuff_bytes(raw) + delim)
+    decoder = sps30_uart.FrameDecoder(uart)
+
+    def run():
+        uart.fill()
+        return decoder.poll()
+    return run
+
+
+@case("sps30.parse_miso")
+def _sps30_parse_miso():
+    import sps30_uart
+    raw = _measurement_frame()
+    return lambda: sps30_uart.parse_miso(raw, 0x03)
+
+
+# ---- utils ----
+
+@case("utils.aqi_us_from_pm25")
+def _aqi():
+    import utils
+    values = itertools.cycle((3.2, 11.6, 18.0, 40.1, 70.0, 160.0, 300.0, 420.0))
+    aqi = utils.aqi_us_from_pm25
+    return lambda: aqi(next(values))
+
+
+@case("utils.classify")
+def _classify():
+    # What one dashboard update classifies
+    import utils
+    return lambda: (
+        utils.get_classification_from_aqi(48),
+        utils.get_classification_from_co2(889),
+        utils.get_classification_from_voc_index(100),
+    )
+
+
+@case("utils.compensate_color")
+def _compensate_color():
+    import utils
+    return lambda: utils.compensate_color(0xFF8C00)
+
+
+# ---- display ----
+
+class FakeLabel:
+    """Just the attributes update_dashboard() sets."""
+    __slots__ = ("text", "color")
+
+    def __init__(self):
+        self.text = ""
+        self.color = 0xFFFFFF
+
+
+@case("display.update_dashboard")
+def _update_dashboard():
+    # Alternates two readings so every label actually changes
+    import display
+    _, labels, _, _ = display.make_dashboard()
+    fake = {name: FakeLabel() for name in labels}
+    readings = itertools.cycle((
+        dict(pm25=11.6, aqi=48, co2_ppm=889, temp_c=22.73, rh_pct=43.1, tvoc=0.094, voc_index=100, pm1=9.3, pm10=13.9),
+        dict(pm25=36.0, aqi=102, co2_ppm=1210, temp_c=23.05, rh_pct=41.8, tvoc=0.31, voc_index=160, pm1=28.8, pm10=43.2),
+    ))
+    return lambda: display.update_dashboard(fake, **next(readings))
@@ -0,0 +1,176 @@
+"""
+Measures cases (ops/sec, heap bytes per call) and compares them with a
+stored baseline.
+"""
+from __future__ import annotations
+
+import fnmatch
+import gc
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable
+
+from tools.sim import Simulation
+
+from .cases import CASES
+
+BASELINE_PATH = Path(__file__).with_name("baseline.json")
+
+DEFAULT_MIN_TIME_S = 1.0
+DEFAULT_REPEATS = 9
+ALLOC_SAMPLES = 25
+# Allocation results are near-deterministic; allow this much slack in
+# bytes on top of the relative tolerance (CPython's small-object noise).
+ALLOC_SLACK_B = 32
+
+
+@dataclass
+class Result:
+    name: str
+    ops_s: float
+    score: float        # ops/sec relative to the reference loop
+    alloc_b: int        # peak heap growth during one call
+    kept_b: int         # heap still held after one call (leaks, caches)
+
+
+def _timed(fn: Callable[[], object], n: int) -> float:
+    loops = range(n)
+    t0 = time.perf_counter()
+    for _ in loops:
+        fn()
+    return time.perf_counter() - t0
+
+
+def _reference() -> int:
+    # Plain interpreter work: loops, int arithmetic, attribute-free calls
+    total = 0
+    for i in range(200):
+        total += (i * 7) % 13
+    return total
+
+
+def _loops_for(fn: Callable[[], object], target_s: float) -> int:
+    n = 1
+    while True:
+        t = _timed(fn, n)
+        if t >= target_s:
+            return n
+        n = n * 10 if t < target_s / 50 else n * 2
+
+
+def measure_speed(fn: Callable[[], object], min_time_s: float = DEFAULT_MIN_TIME_S,
+                  repeats: int = DEFAULT_REPEATS) -> tuple[float, float]:
+    """
+    (ops/sec, score). The score is ops/sec relative to a reference loop
+    timed right next to each repeat, so host speed and load changes
+    largely cancel out; baselines are compared on it.
+    """
+    slice_s = min_time_s / (2 * repeats)
+    n = _loops_for(fn, slice_s)
+    n_ref = _loops_for(_reference, slice_s)
+    best = float("inf")
+    ratios = []
+    for _ in range(repeats):
+        t_ref = _timed(_reference, n_ref)
+        t = _timed(fn, n)
+        best = min(best, t)
+        ratios.append((n / t) / (n_ref / t_ref))
+    return n / best, statistics.median(ratios)
+
+
+def measure_alloc(fn: Callable[[], object], samples: int = ALLOC_SAMPLES) -> tuple[int, int]:
+    """
+    Median (peak, kept) heap bytes per call. tracemalloc sees bytes, not
+    allocation counts, so the peak stands in for "allocations": it is
+    what a call needs free on the board's heap.
+    """
+    fn()  # warm caches and lazily built state
+    gc.collect()
+    peaks = []
+    kept = []
+    tracemalloc.start()
+    try:
+        for _ in range(samples):
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            fn()
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - start)
+            kept.append(current - start)
+    finally:
+        tracemalloc.stop()
+    return int(statistics.median(peaks)), max(0, int(statistics.median(kept)))
+
+
+def select(patterns: list[str] | None) -> list[str]:
+    if not patterns:
+        return list(CASES)
+    return [name for name in CASES if any(fnmatch.fnmatch(name, p) for p in patterns)]
+
+
+def run(names: list[str], min_time_s: float = DEFAULT_MIN_TIME_S,
+        repeats: int = DEFAULT_REPEATS, speed: bool = True) -> list[Result]:
+    results = []
+    with Simulation().installed():
+        for name in names:
+            fn = CASES[name]()
+            ops_s, score = measure_speed(fn, min_time_s, repeats) if speed else (0.0, 0.0)
+            alloc_b, kept_b = measure_alloc(fn)
+            results.append(Result(name, ops_s, score, alloc_b, kept_b))
+    return results
+
+
+def host_info() -> dict[str, str]:
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "processor": platform.processor() or platform.machine(),
+    }
+
+
+def load_baseline(path: Path = BASELINE_PATH) -> dict:
+    if not path.exists():
+        return {"host": {}, "cases": {}}
+    return json.loads(path.read_text())
+
+
+def save_baseline(results: list[Result], path: Path = BASELINE_PATH, merge: bool = True) -> None:
+    baseline = load_baseline(path) if merge else {"cases": {}}
+    baseline["host"] = host_info()
+    for r in results:
+        entry = asdict(r)
+        del entry["name"]
+        entry["ops_s"] = round(r.ops_s, 1)
+        entry["score"] = round(r.score, 4)
+        baseline["cases"][r.name] = entry
+    baseline["cases"] = dict(sorted(baseline["cases"].items()))
+    path.write_text(json.dumps(baseline, indent=2) + "\n")
+
+
+def compare(results: list[Result], baseline: dict, speed_tolerance: float,
+            alloc_tolerance: float, speed: bool = True) -> list[str]:
+    """
+    Regressions against baseline, as messages: a speed score more than
+    speed_tolerance below it, or heap bytes per call more than
+    alloc_tolerance (plus ALLOC_SLACK_B) above it.
+    """
+    problems = []
+    cases = baseline.get("cases", {})
+    for r in results:
+        base = cases.get(r.name)
+        if base is None:
+            continue
+        if speed and base.get("score") and r.score < base["score"] * (1 - speed_tolerance):
+            problems.append("%s: speed score %.3f, baseline %.3f (-%.0f%%)"
+                            % (r.name, r.score, base["score"], 100 * (1 - r.score / base["score"])))
+        for key in ("alloc_b", "kept_b"):
+            limit = base.get(key, 0) * (1 + alloc_tolerance) + ALLOC_SLACK_B
+            if getattr(r, key) > limit:
+                problems.append("%s: %s %d B/call, baseline %d" % (r.name, key, getattr(r, key), base.get(key, 0)))
+    return problems
@@ -0,0 +1,14 @@
+"""
+Host-side simulator for device/: runs code.py unmodified under CPython
+against fake CircuitPython modules, simulated sensors and a virtual clock.
+
+    python -m tools.sim --duration 6h
+    python -m tools.sim --check
+"""
+from .clock import DeviceReset, SimulationEnd, VirtualClock
+from .harness import SimConfig, SimResult, Simulation
+
+__all__ = [
+    "DeviceReset", "SimulationEnd", "VirtualClock",
+    "SimConfig", "SimResult", "Simulation",
+]
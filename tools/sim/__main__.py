@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import sys
+
+from . import checks, replay
+from .harness import SimConfig, SimResult, Simulation
+
+
+def parse_duration(text: str) -> float:
+    # "90", "90s", "15m", "6h", "2d"
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def parse_window(text: str) -> tuple[float, float]:
+    # "START+LENGTH", e.g. "30m+5m"
+    start, _, length = text.partition("+")
+    begin = parse_duration(start)
+    return begin, begin + parse_duration(length)
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(prog="python -m tools.sim", description="Run device/code.py on the host in virtual time.")
+    ap.add_argument("--duration", type=parse_duration, default=3600.0, help="virtual time to run (e.g. 90s, 15m, 6h)")
+    ap.add_argument("--device-id", default="sim-1")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--speed", type=float, default=None, help="pace virtual time at N x real time (default: as fast as possible)")
+    ap.add_argument("--cpu-scale", type=float, default=0.0, help="also charge host CPU time x N as device time")
+    ap.add_argument("--no-sps30", action="store_true", help="leave the SPS30 unplugged")
+    ap.add_argument("--wifi-outage", type=parse_window, action="append", default=[], metavar="START+LEN")
+    ap.add_argument("--server-outage", type=parse_window, action="append", default=[], metavar="START+LEN")
+    ap.add_argument("--fail-rate", type=float, default=0.0, help="fraction of server connects that time out")
+    ap.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="override a settings.toml value")
+    ap.add_argument("--verbose", action="store_true", help="show the device's print() output")
+    ap.add_argument("--trace-out", metavar="FILE", help="have the device record a field trace to FILE")
+    ap.add_argument("--replay", metavar="FILE", help="replay a field trace instead of simulating inputs")
+    ap.add_argument("--segment", type=int, default=-1, help="boot within the trace to replay (default: last)")
+    ap.add_argument("--check", action="store_true", help="run the scenario checks (tools/sim/checks.py) and exit")
+    args = ap.parse_args()
+
+    if args.check:
+        return report_checks(checks.run())
+
+    settings = {}
+    for item in args.set:
+        key, _, value = item.partition("=")
+        settings[key] = value
+
+    config = SimConfig(
+        duration_s=args.duration,
+        device_id=args.device_id,
+        settings=settings,
+        seed=args.seed,
+        cpu_scale=args.cpu_scale,
+        speed=args.speed,
+        server_fail_rate=args.fail_rate,
+        server_outages=args.server_outage,
+        wifi_outages=args.wifi_outage,
+        sps30_present=not args.no_sps30,
+        quiet=not args.verbose,
+        trace_out=args.trace_out,
+    )
+    if args.replay:
+        return report_replay(replay.replay(replay.Trace.load(args.replay, args.segment), config))
+    return report(Simulation(config).run())
+
+
+def report(result: SimResult) -> int:
+
+    print("virtual: %.0f s  real: %.2f s  (x%.0f)" % (result.virtual_s, result.real_s, result.speedup))
+    print("light sleep: %.0f s  display updates: %d" % (result.light_sleep_s, result.display_updates))
+    for path, n in sorted(result.requests.items()):
+        print("requests %-28s %5d  %8d bytes" % (path, n, result.bytes_in.get(path, 0)))
+    for at, reason in result.resets:
+        print("reset at %.0f s: %s" % (at, reason))
+    stages = result.stage_stats()
+    if stages:
+        print("%-8s %7s %9s %9s" % ("stage", "n", "avg ms", "max ms"))
+        for name, s in stages.items():
+            print("%-8s %7d %9.1f %9d" % (name, s["n"], s["avg_ms"], s["max_ms"]))
+    if result.error is not None:
+        print("device code crashed: %r" % (result.error,), file=sys.stderr)
+        return 1
+    return 0
+
+
+def report_checks(results: dict[str, list[str]]) -> int:
+    failed = 0
+    for name, problems in results.items():
+        print("%-32s %s" % (name, "FAIL" if problems else "ok"))
+        for p in problems:
+            print("    %s" % p)
+        failed += bool(problems)
+    return 1 if failed else 0
+
+
+def report_replay(result: replay.ReplayResult) -> int:
+    sim = result.sim
+    print("replayed %.0f s of trace in %.2f s" % (result.trace.duration_s, sim.real_s))
+    for name, (used, total) in result.consumed.items():
+        print("%-16s %6d of %6d used" % (name, used, total))
+    for recorded, actual in result.path_mismatches[:10]:
+        print("request order differs: trace %s, replay %s" % (recorded, actual))
+    print("%-8s %15s %15s %15s" % ("stage", "n field/replay", "avg ms", "max ms"))
+    for name in sorted(set(result.field_stages) | set(result.replay_stages)):
+        f = result.field_stages.get(name, {"n": 0, "avg_ms": 0, "max_ms": 0})
+        r = result.replay_stages.get(name, {"n": 0, "avg_ms": 0, "max_ms": 0})
+        print("%-8s %7d/%-7d %7.1f/%-7.1f %7d/%-7d"
+              % (name, f["n"], r["n"], f["avg_ms"], r["avg_ms"], f["max_ms"], r["max_ms"]))
+    if sim.error is not None:
+        print("device code crashed: %r" % (sim.error,), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
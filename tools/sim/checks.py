@@ -0,0 +1,68 @@
+"""
+Scenario checks: short simulations asserting behaviour of the device code
+as a whole, e.g. that battery builds actually light-sleep. Each check
+returns a list of problems (empty = pass).
+
+    python -m tools.sim --check
+"""
+from __future__ import annotations
+
+from typing import Callable
+
+from .harness import SimConfig, SimResult, Simulation
+
+CHECKS: dict[str, Callable[[], list[str]]] = {}
+
+
+def check(name: str):
+    def register(fn):
+        CHECKS[name] = fn
+        return fn
+    return register
+
+
+def _crashed(result: SimResult) -> list[str]:
+    problems = []
+    if result.error is not None:
+        problems.append("device code crashed: %r" % (result.error,))
+    for at, reason in result.resets:
+        problems.append("reset at %.0f s: %s" % (at, reason))
+    return problems
+
+
+def _heap_bounded(result: SimResult) -> list[str]:
+    # About one deadline entry per task (see scheduler.DeadlineScheduler)
+    sched = result.device_globals.get("sched")
+    if sched is not None and len(sched._heap) > sched.tasks:
+        return ["%d deadline entries for %d tasks" % (len(sched._heap), sched.tasks)]
+    return []
+
+
+@check("light_sleep.default_config")
+def _light_sleep_default() -> list[str]:
+    # The default config is a battery build with a display
+    result = Simulation(SimConfig(duration_s=20 * 60)).run()
+    problems = _crashed(result)
+    if result.light_sleep_s <= 0:
+        problems.append("no light sleep in %.0f s" % result.virtual_s)
+    return problems + _heap_bounded(result)
+
+
+@check("scheduler.heap_bounded")
+def _scheduler_heap() -> list[str]:
+    # A mains-powered build: light sleep off, deadlines must not pile up
+    result = Simulation(SimConfig(duration_s=20 * 60, device_id="murali-1")).run()
+    return _crashed(result) + _heap_bounded(result)
+
+
+@check("display.minute_rollover")
+def _display_minute_rollover() -> list[str]:
+    # The clock label's next-minute deadline once landed on "now" ~70 min
+    # in, and the display task redrew without yielding; the harness reports
+    # that as a livelock. Includes a WiFi outage, as field runs see.
+    result = Simulation(SimConfig(duration_s=3 * 3600, wifi_outages=[(1200.0, 1800.0)])).run()
+    return _crashed(result)
+
+
+def run(names: list[str] | None = None) -> dict[str, list[str]]:
+    return {name: CHECKS[name]() for name in (names or CHECKS)}
@@ -0,0 +1,131 @@
+"""
+Virtual time for the simulator.
+
+Everything the device code can observe (time.monotonic(), ticks_ms(), the
+RTC, asyncio's loop clock) reads one VirtualClock. It only moves when the
+device waits: asyncio sleeps, time.sleep(), light sleep, busy-polling a
+fake peripheral. With cpu_scale > 0, host CPU time spent running device
+code is added too (scaled up to approximate the slower board).
+"""
+from __future__ import annotations
+
+import asyncio
+import selectors
+import time
+from typing import Callable
+
+TICKS_PERIOD = 1 << 29
+# Start ticks_ms() about a minute before it wraps, so every run crosses a
+# wrap early on.
+DEFAULT_TICKS_START = TICKS_PERIOD - 65_536
+# Event loop passes without virtual time moving before the run is taken to
+# be spinning (a task that keeps finding its deadline already due)
+MAX_IDLE_PASSES = 100_000
+
+_real_sleep = time.sleep
+_perf_counter = time.perf_counter
+
+
+class SimulationEnd(BaseException):
+    """Raised once virtual time reaches the end of the run.
+
+    A BaseException so the device code's `except Exception` handlers let
+    it through.
+    """
+
+
+class DeviceReset(BaseException):
+    """The simulated board reset (watchdog or microcontroller.reset())."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class VirtualClock:
+    def __init__(self, cpu_scale: float = 0.0, speed: float | None = None,
+                 ticks_start: int = DEFAULT_TICKS_START):
+        self.cpu_scale = cpu_scale
+        self.speed = speed
+        self.ticks_start = ticks_start
+        self.end: float | None = None
+        # Called with the new time after every advance (e.g. the watchdog)
+        self.watchers: list[Callable[[float], None]] = []
+        self._t = 0.0
+        self._real_mark = _perf_counter()
+        self._ended = False
+
+    def now(self) -> float:
+        """Seconds since the simulation started."""
+        t = self._t
+        if self.cpu_scale:
+            t += (_perf_counter() - self._real_mark) * self.cpu_scale
+        return t
+
+    def advance(self, dt: float) -> None:
+        dt = max(0.0, dt)
+        t = self.now() + dt
+        self._t = t
+        self._real_mark = _perf_counter()
+        if self.speed and dt:
+            _real_sleep(dt / self.speed)
+        for watcher in self.watchers:
+            watcher(t)
+        if self.end is not None and t >= self.end and not self._ended:
+            self._ended = True
+            raise SimulationEnd()
+
+    def advance_to(self, t: float) -> None:
+        self.advance(t - self.now())
+
+    def sleep(self, seconds: float) -> None:
+        self.advance(seconds)
+
+    def ticks_ms(self) -> int:
+        return (self.ticks_start + int(self.now() * 1000)) % TICKS_PERIOD
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    # Never blocks: a wait for timers is turned into a clock advance.
+    def __init__(self, clock: VirtualClock):
+        super().__init__()
+        self._clock = clock
+        self._last = None
+        self._passes = 0
+
+    def select(self, timeout=None):
+        now = self._clock.now()
+        if now != self._last:
+            self._last = now
+            self._passes = 0
+        self._passes += 1
+        if self._passes > MAX_IDLE_PASSES:
+            raise RuntimeError("Simulation livelocked: tasks run but virtual time doesn't move")
+        ready = super().select(0)
+        if ready:
+            return ready
+        if timeout is None:
+            raise RuntimeError("Simulation deadlocked: no task is waiting on a timer")
+        if timeout > 0:
+            self._clock.advance(timeout)
+        return []
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock: VirtualClock):
+        super().__init__(_VirtualSelector(clock))
+        self._vclock = clock
+
+    def time(self) -> float:
+        return self._vclock.now()
+
+
+class VirtualEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
+    """Makes asyncio.run() in code.py use a VirtualEventLoop."""
+
+    def __init__(self, clock: VirtualClock):
+        super().__init__()
+        self._clock = clock
+
+    def new_event_loop(self) -> VirtualEventLoop:
+        return VirtualEventLoop(self._clock)
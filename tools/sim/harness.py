@@ -0,0 +1,285 @@
+"""
+Runs device/code.py unmodified under CPython against the fake modules,
+in virtual time.
+"""
+from __future__ import annotations
+
+import asyncio
+import calendar
+import contextlib
+import gc
+import io
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from . import hw, network, sensors
+from .clock import DeviceReset, SimulationEnd, VirtualClock, VirtualEventLoopPolicy
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+DEVICE_DIR = REPO_ROOT / "device"
+
+# 2026-01-01T00:00:00Z
+DEFAULT_START_UNIX = 1767225600
+# CircuitPython boots with the RTC at 2000-01-01
+RTC_EPOCH = 946684800
+
+DEFAULT_SETTINGS = {
+    "DEVICE_ID": "sim-1",
+    "DEVICE_SECRET": "sim-secret",
+    "CIRCUITPY_WIFI_SSID": "sim-ap",
+    "CIRCUITPY_WIFI_PASSWORD": "sim-password",
+    "API_INGEST_URL": "http://ingest.sim/api/ingest",
+    "API_HEALTHCHECK_URL": "http://ingest.sim/api/health",
+    "API_DIAGNOSTICS_URL": "http://ingest.sim/api/diagnostics",
+    "TIMEZONE_OFFSET": "+00:00",
+}
+
+# Virtual time taken by operations the fakes can't otherwise account for
+DEFAULT_COSTS = {
+    "label_text_s": 0.002,      # re-rendering one label
+}
+
+# Modules the fakes provide; removed again after a run
+FAKE_MODULES = (
+    "board", "busio", "digitalio", "pwmio", "analogio", "microcontroller", "watchdog",
+    "supervisor", "alarm", "rtc", "neopixel", "displayio", "fourwire", "terminalio",
+    "adafruit_display_text", "adafruit_display_text.label", "adafruit_ili9341",
+    "adafruit_hashlib", "adafruit_sht4x", "adafruit_sgp40", "adafruit_scd4x",
+    "wifi", "socketpool", "ssl", "adafruit_ntp",
+)
+
+
+@dataclass
+class SimConfig:
+    duration_s: float = 3600.0
+    device_id: str = "sim-1"
+    settings: dict[str, str] = field(default_factory=dict)
+    seed: int = 1
+    cpu_scale: float = 0.0
+    speed: float | None = None
+    start_unix: int = DEFAULT_START_UNIX
+    ticks_start: int | None = None
+    heap_free: int = 2_000_000
+    server_latency_s: float = 0.15
+    server_fail_rate: float = 0.0
+    server_outages: list[tuple[float, float]] = field(default_factory=list)
+    wifi_outages: list[tuple[float, float]] = field(default_factory=list)
+    sps30_present: bool = True
+    reboot: bool = True         # restart code.py after a reset, until duration_s
+    quiet: bool = True          # swallow the device's print() output
+    costs: dict[str, float] = field(default_factory=dict)
+    trace_out: str | None = None  # have the device record a field trace here
+
+
+@dataclass
+class SimResult:
+    virtual_s: float
+    real_s: float
+    resets: list[tuple[float, str]]
+    requests: dict[str, int]
+    bytes_in: dict[str, int]
+    light_sleep_s: float
+    display_updates: int
+    error: BaseException | None
+    device_globals: dict[str, Any]
+    output: str
+
+    @property
+    def speedup(self) -> float:
+        return self.virtual_s / self.real_s if self.real_s else float("inf")
+
+    def stage_stats(self) -> dict[str, Any]:
+        latency = self.device_globals.get("latency")
+        return latency.as_dict() if latency is not None else {}
+
+
+class Simulation:
+    """
+    One simulated device. run() executes device/code.py (rebooting it on
+    watchdog/software resets) until config.duration_s of virtual time.
+    """
+
+    def __init__(self, config: SimConfig | None = None):
+        self.config = config = config or SimConfig()
+        ticks = config.ticks_start
+        self.clock = VirtualClock(cpu_scale=config.cpu_scale, speed=config.speed,
+                                  **({} if ticks is None else {"ticks_start": ticks}))
+        self.rng = random.Random(config.seed)
+        self.costs = dict(DEFAULT_COSTS, **config.costs)
+        self.env = sensors.Environment(self.clock, self.rng)
+        self.sps30 = sensors.SPS30(self.clock, self.env)
+        self.sps30.present = config.sps30_present
+        self.radio = network.Radio(self)
+        self.radio.outages = list(config.wifi_outages)
+        self.server = network.Server(self, latency_s=config.server_latency_s,
+                                     fail_rate=config.server_fail_rate)
+        self.server.outages = list(config.server_outages)
+        self.nvm = bytearray(8192)
+        self.watchdog = hw.Watchdog(self)
+        self.reset_reason = hw.ResetReason.POWER_ON
+        self.resets: list[tuple[float, str]] = []
+        self.light_sleep_s = 0.0
+        self.display_updates = 0
+        self._rtc_base = float(RTC_EPOCH)      # RTC reading at virtual time 0
+        self.clock.watchers.append(self.watchdog.check)
+
+    # ---- time ----
+
+    def unix(self) -> float:
+        """True UTC time (what the server and NTP report)."""
+        return self.config.start_unix + self.clock.now()
+
+    def rtc_time(self) -> float:
+        """What time.time() returns on the device (the RTC)."""
+        return self._rtc_base + self.clock.now()
+
+    def set_rtc(self, st: time.struct_time) -> None:
+        self._rtc_base = calendar.timegm(st) - self.clock.now()
+
+    def light_sleep(self, *alarms) -> Any:
+        start = self.clock.now()
+        wake = min(a.monotonic_time for a in alarms if getattr(a, "monotonic_time", None) is not None)
+        self.clock.advance_to(wake)
+        self.light_sleep_s += self.clock.now() - start
+        return alarms[0]
+
+    def reset(self) -> None:
+        raise DeviceReset("SOFTWARE")
+
+    # ---- running ----
+
+    def _modules(self) -> dict[str, Any]:
+        mods = hw.modules(self)
+        mods.update(network.modules(self))
+        mods.update(sensors.modules(self))
+        return mods
+
+    def _install(self) -> dict[str, Any]:
+        saved = {
+            "modules": {name: sys.modules.get(name) for name in FAKE_MODULES},
+            "path": list(sys.path),
+            "environ": dict(os.environ),
+            "time": {name: getattr(time, name) for name in ("monotonic", "time", "sleep", "localtime")},
+            "gc": {name: getattr(gc, name, None) for name in ("mem_free", "mem_alloc")},
+            "policy": asyncio.get_event_loop_policy(),
+            "cwd": os.getcwd(),
+        }
+        sys.modules.update(self._modules())
+        sys.path[:0] = [str(DEVICE_DIR), str(DEVICE_DIR / "lib")]
+
+        os.environ.update(DEFAULT_SETTINGS)
+        os.environ["DEVICE_ID"] = self.config.device_id
+        os.environ.update(self.config.settings)
+        if self.config.trace_out:
+            os.environ["TRACE_FILE"] = str(Path(self.config.trace_out).resolve())
+
+        clock = self.clock
+        time.monotonic = clock.now
+        time.sleep = clock.sleep
+        time.time = self.rtc_time
+        time.localtime = lambda secs=None: time.gmtime(int(self.rtc_time() if secs is None else secs))
+        gc.mem_free = lambda: self.config.heap_free
+        gc.mem_alloc = lambda: 8_000_000 - self.config.heap_free
+        asyncio.set_event_loop_policy(VirtualEventLoopPolicy(clock))
+        os.chdir(DEVICE_DIR)
+        return saved
+
+    def _uninstall(self, saved: dict[str, Any]) -> None:
+        for name, mod in saved["modules"].items():
+            if mod is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = mod
+        self._forget_device_modules()
+        sys.path[:] = saved["path"]
+        os.environ.clear()
+        os.environ.update(saved["environ"])
+        for name, fn in saved["time"].items():
+            setattr(time, name, fn)
+        for name, fn in saved["gc"].items():
+            if fn is None:
+                if hasattr(gc, name):
+                    delattr(gc, name)
+            else:
+                setattr(gc, name, fn)
+        asyncio.set_event_loop_policy(saved["policy"])
+        os.chdir(saved["cwd"])
+
+    @staticmethod
+    def _forget_device_modules() -> None:
+        # Like a reboot: device modules are re-imported on the next boot
+        for name, mod in list(sys.modules.items()):
+            path = getattr(mod, "__file__", None) or ""
+            if path.startswith(str(DEVICE_DIR)):
+                del sys.modules[name]
+
+    def _boot(self, g: dict[str, Any]) -> None:
+        # Fresh module objects carry this boot's reset reason
+        sys.modules.update(self._modules())
+        self._forget_device_modules()
+        self.sps30.reset_port()
+        self.sps30.measuring = False
+        self.sps30.asleep = False
+        self.radio.disconnect()
+        self.watchdog.deinit()
+        self._rtc_base = float(RTC_EPOCH) - self.clock.now()
+        path = DEVICE_DIR / "code.py"
+        exec(compile(path.read_text(), str(path), "exec"), g)
+
+    @contextlib.contextmanager
+    def installed(self):
+        """
+        The fakes, virtual time and device/ on sys.path, without running
+        code.py; for importing single device modules (e.g. benchmarks).
+        """
+        saved = self._install()
+        try:
+            yield self
+        finally:
+            self._uninstall(saved)
+
+    def run(self) -> SimResult:
+        config = self.config
+        self.clock.end = config.duration_s
+        random.seed(config.seed)
+        saved = self._install()
+        out = io.StringIO()
+        g: dict[str, Any] = {}
+        error: BaseException | None = None
+        real_start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(out) if config.quiet else contextlib.nullcontext():
+                while True:
+                    g = {"__name__": "__main__", "__file__": str(DEVICE_DIR / "code.py")}
+                    try:
+                        self._boot(g)
+                        break           # code.py returned
+                    except DeviceReset as reset:
+                        self.resets.append((self.clock.now(), reset.reason))
+                        self.reset_reason = reset.reason
+                        if not config.reboot:
+                            break
+                    except SimulationEnd:
+                        break
+        except Exception as exc:  # crashed device code: report, don't hide
+            error = exc
+        finally:
+            real_s = time.perf_counter() - real_start
+            self._uninstall(saved)
+        return SimResult(
+            virtual_s=self.clock.now(),
+            real_s=real_s,
+            resets=self.resets,
+            requests=dict(self.server.requests),
+            bytes_in=dict(self.server.bytes_in),
+            light_sleep_s=self.light_sleep_s,
+            display_updates=self.display_updates,
+            error=error,
+            device_globals=g,
+            output=out.getvalue(),
+        )
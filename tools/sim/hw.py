@@ -0,0 +1,308 @@
+"""
+Fake CircuitPython core modules (board, busio, microcontroller, displayio,
+...) for running device/ on the host.
+"""
+from __future__ import annotations
+
+import hashlib
+import time
+import types
+
+from .clock import DeviceReset
+from .sensors import UART
+
+# Pins of every board device/ knows about; values are just names.
+PINS = (
+    "TX", "RX", "SCL", "SDA", "NEOPIXEL", "NEOPIXEL_POWER", "BATTERY", "VBUS_SENSE",
+    "D5", "D6", "D7", "D35", "D36", "D37",
+    "I2C_SCL", "I2C_SDA", "LCD_SCK", "LCD_MOSI", "LCD_MISO", "LCD_CS", "LCD_DC", "LCD_RST", "LCD_BL",
+)
+
+
+class Pin:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self) -> str:
+        return "board.%s" % self.name
+
+
+class _Bus:
+    def __init__(self, *a, **kw):
+        pass
+
+    def try_lock(self) -> bool:
+        return True
+
+    def unlock(self) -> None:
+        pass
+
+    def deinit(self) -> None:
+        pass
+
+
+class DigitalInOut:
+    def __init__(self, pin):
+        self.pin = pin
+        self.direction = None
+        self.pull = None
+        self.value = False
+
+    def switch_to_output(self, value=False, **_kw) -> None:
+        self.value = value
+
+    def switch_to_input(self, pull=None) -> None:
+        self.pull = pull
+
+    def deinit(self) -> None:
+        pass
+
+
+class _Attrs:
+    """Accepts any constructor kwargs as attributes."""
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+
+class Group(list):
+    def __init__(self, *, x: int = 0, y: int = 0, scale: int = 1):
+        super().__init__()
+        self.x = x
+        self.y = y
+        self.scale = scale
+        self.hidden = False
+
+
+class Bitmap:
+    def __init__(self, width: int, height: int, value_count: int):
+        self.width = width
+        self.height = height
+        self._px = bytearray(width * height)
+
+    def __setitem__(self, xy, value) -> None:
+        x, y = xy
+        self._px[y * self.width + x] = value
+
+    def __getitem__(self, xy) -> int:
+        x, y = xy
+        return self._px[y * self.width + x]
+
+    def fill(self, value: int) -> None:
+        self._px[:] = bytes([value]) * len(self._px)
+
+
+class Palette(list):
+    def __init__(self, color_count: int):
+        super().__init__([0] * color_count)
+
+    def make_transparent(self, index: int) -> None:
+        pass
+
+
+class TileGrid(_Attrs):
+    def __init__(self, bitmap, **kwargs):
+        super().__init__(**kwargs)
+        self.bitmap = bitmap
+        self.hidden = False
+
+
+class Label:
+    """adafruit_display_text.label.Label; text changes cost virtual time."""
+
+    def __init__(self, sim, font=None, *, text: str = "", color: int = 0xFFFFFF, **kwargs):
+        self._sim = sim
+        self._text = text
+        self.color = color
+        self.hidden = False
+        self.anchor_point = (0, 0)
+        self.anchored_position = (0, 0)
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    @text.setter
+    def text(self, value: str) -> None:
+        if value != self._text:
+            self._sim.clock.advance(self._sim.costs["label_text_s"])
+            self._sim.display_updates += 1
+        self._text = value
+
+
+class Display:
+    def __init__(self, *a, width: int = 240, height: int = 320, rotation: int = 0, **kwargs):
+        if rotation in (90, 270):
+            width, height = height, width
+        self.width = width
+        self.height = height
+        self.rotation = rotation
+        self.root_group = None
+        self.auto_refresh = True
+
+    def refresh(self, *a, **kw) -> bool:
+        return True
+
+
+class Watchdog:
+    """microcontroller.watchdog; resets the simulated board when starved."""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.timeout = 0.0
+        self.mode = None
+        self._fed_at: float | None = None
+
+    def feed(self) -> None:
+        if not self.timeout:
+            raise ValueError("watchdog timeout not set")
+        self._fed_at = self.sim.clock.now()
+
+    def deinit(self) -> None:
+        self._fed_at = None
+        self.mode = None
+
+    def check(self, now: float) -> None:
+        if self.mode is not None and self._fed_at is not None and now - self._fed_at > self.timeout:
+            self._fed_at = None
+            raise DeviceReset("WATCHDOG")
+
+
+class _Hash:
+    """adafruit_hashlib hashes, which (unlike hashlib) also accept str."""
+
+    def __init__(self, name: str, data=b""):
+        self._h = hashlib.new(name)
+        self.update(data)
+
+    def update(self, data) -> None:
+        self._h.update(data.encode("utf-8") if isinstance(data, str) else data)
+
+    def digest(self) -> bytes:
+        return self._h.digest()
+
+    def hexdigest(self) -> str:
+        return self._h.hexdigest()
+
+    def copy(self) -> "_Hash":
+        other = _Hash.__new__(_Hash)
+        other._h = self._h.copy()
+        return other
+
+
+class ResetReason:
+    POWER_ON = "POWER_ON"
+    SOFTWARE = "SOFTWARE"
+    WATCHDOG = "WATCHDOG"
+    RESET_PIN = "RESET_PIN"
+    UNKNOWN = "UNKNOWN"
+
+
+class RTC:
+    def __init__(self, sim):
+        self._sim = sim
+
+    @property
+    def datetime(self) -> time.struct_time:
+        return time.gmtime(int(self._sim.rtc_time()))
+
+    @datetime.setter
+    def datetime(self, value) -> None:
+        self._sim.set_rtc(time.struct_time(tuple(value)[:9]))
+
+
+def modules(sim) -> dict[str, types.ModuleType]:
+    mods: dict[str, types.ModuleType] = {}
+
+    def module(name: str, **attrs) -> types.ModuleType:
+        m = types.ModuleType(name)
+        for key, value in attrs.items():
+            setattr(m, key, value)
+        mods[name] = m
+        return m
+
+    board = module("board", DISPLAY=None, board_id="sim")
+    for name in PINS:
+        setattr(board, name, Pin(name))
+    board.I2C = _Bus
+    board.SPI = _Bus
+    board.STEMMA_I2C = _Bus
+
+    module(
+        "busio",
+        UART=lambda tx=None, rx=None, **kw: UART(sim.clock, sim.sps30 if (tx, rx) == (board.TX, board.RX) else None, **kw),
+        I2C=_Bus,
+        SPI=_Bus,
+    )
+    module(
+        "digitalio",
+        DigitalInOut=DigitalInOut,
+        Direction=types.SimpleNamespace(INPUT="INPUT", OUTPUT="OUTPUT"),
+        Pull=types.SimpleNamespace(UP="UP", DOWN="DOWN"),
+        DriveMode=types.SimpleNamespace(PUSH_PULL="PUSH_PULL", OPEN_DRAIN="OPEN_DRAIN"),
+    )
+    module("pwmio", PWMOut=_Attrs)
+    module("analogio", AnalogIn=lambda pin: types.SimpleNamespace(value=42000, reference_voltage=3.3))
+
+    module(
+        "microcontroller",
+        nvm=sim.nvm,
+        watchdog=sim.watchdog,
+        ResetReason=ResetReason,
+        cpu=types.SimpleNamespace(reset_reason=sim.reset_reason, temperature=35.0, frequency=240_000_000),
+        reset=sim.reset,
+    )
+    module(
+        "watchdog",
+        WatchDogMode=types.SimpleNamespace(RAISE="RAISE", RESET="RESET"),
+        WatchDogTimeout=type("WatchDogTimeout", (Exception,), {}),
+    )
+    module(
+        "supervisor",
+        ticks_ms=sim.clock.ticks_ms,
+        runtime=types.SimpleNamespace(usb_connected=False, serial_connected=True),
+    )
+
+    alarm_time = types.SimpleNamespace(TimeAlarm=lambda *, monotonic_time=None, epoch_time=None: _Attrs(
+        monotonic_time=monotonic_time, epoch_time=epoch_time))
+    module(
+        "alarm",
+        time=alarm_time,
+        light_sleep_until_alarms=sim.light_sleep,
+        sleep_memory=bytearray(4096),
+    )
+    module("rtc", RTC=lambda: RTC(sim))
+
+    module(
+        "neopixel",
+        NeoPixel=lambda pin, n, **kw: [(0, 0, 0)] * n,
+        GRB="GRB",
+        RGB="RGB",
+    )
+
+    module(
+        "displayio",
+        Group=Group,
+        Bitmap=Bitmap,
+        Palette=Palette,
+        TileGrid=TileGrid,
+        release_displays=lambda: None,
+    )
+    module("fourwire", FourWire=_Attrs)
+    module("terminalio", FONT=object())
+    label = module("adafruit_display_text.label", Label=lambda font=None, **kw: Label(sim, font, **kw))
+    module("adafruit_display_text", label=label)
+    module("adafruit_ili9341", ILI9341=Display)
+
+    module(
+        "adafruit_hashlib",
+        new=_Hash,
+        sha256=lambda data=b"": _Hash("sha256", data),
+        sha1=lambda data=b"": _Hash("sha1", data),
+        md5=lambda data=b"": _Hash("md5", data),
+    )
+    return mods
@@ -0,0 +1,239 @@
+"""
+Simulated network: the WiFi radio, a socketpool whose sockets talk to an
+in-process ingest server, TLS and NTP.
+"""
+from __future__ import annotations
+
+import json
+import time
+import types
+
+EAGAIN = 11
+ETIMEDOUT = 110
+
+
+class Server:
+    """
+    Stands in for the ingest API. Every request is answered with
+    {"ok": true, "ts": <unix>} after latency_s, unless the server is down
+    (fail_rate, or an outage window), in which case connects time out;
+    an open connection is reset by the next request sent during an outage.
+    Records what it received per path.
+    """
+
+    def __init__(self, sim, latency_s: float = 0.15, connect_s: float = 0.05,
+                 tls_handshake_s: float = 0.6, fail_rate: float = 0.0):
+        self.sim = sim
+        self.latency_s = latency_s
+        self.connect_s = connect_s
+        self.tls_handshake_s = tls_handshake_s
+        self.fail_rate = fail_rate
+        self.outages: list[tuple[float, float]] = []
+        self.requests: dict[str, int] = {}
+        self.bytes_in: dict[str, int] = {}
+        self.bodies: dict[str, list[bytes]] = {}
+        self.keep_bodies = True
+        self.connects = 0
+
+    def in_outage(self) -> bool:
+        now = self.sim.clock.now()
+        return any(start <= now < end for start, end in self.outages)
+
+    def up(self) -> bool:
+        if self.in_outage():
+            return False
+        return not (self.fail_rate and self.sim.rng.random() < self.fail_rate)
+
+    def handle(self, method: str, path: str, headers: dict[str, str], body: bytes) -> bytes:
+        self.requests[path] = self.requests.get(path, 0) + 1
+        self.bytes_in[path] = self.bytes_in.get(path, 0) + len(body)
+        if self.keep_bodies and method == "POST":
+            self.bodies.setdefault(path, []).append(body)
+        payload = json.dumps({"ok": True, "ts": int(self.sim.unix())}).encode()
+        return (b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                b"Content-Length: %d\r\n\r\n" % len(payload)) + payload
+
+
+class Socket:
+    def __init__(self, sim):
+        self.sim = sim
+        self.tls = False
+        self.timeout: float | None = None
+        self._connected = False
+        self._req = bytearray()
+        self._resp = b""
+        self._resp_at = 0.0
+
+    def settimeout(self, value: float | None) -> None:
+        self.timeout = value
+
+    def setblocking(self, flag: bool) -> None:
+        self.timeout = None if flag else 0
+
+    def connect(self, addr) -> None:
+        sim = self.sim
+        server = sim.server
+        if not sim.radio.connected or not server.up():
+            sim.clock.advance(self.timeout or 1.0)
+            raise OSError(ETIMEDOUT, "ETIMEDOUT")
+        server.connects += 1
+        sim.clock.advance(server.connect_s + (server.tls_handshake_s if self.tls else 0.0))
+        self._connected = True
+
+    def _check_link(self) -> None:
+        if not self._connected or not self.sim.radio.connected:
+            raise OSError(104, "ECONNRESET")
+
+    def send(self, data) -> int:
+        self._check_link()
+        if not self._req and self.sim.server.in_outage():
+            raise OSError(104, "ECONNRESET")
+        self._req += bytes(data)
+        self._maybe_respond()
+        return len(data)
+
+    def _maybe_respond(self) -> None:
+        head_end = self._req.find(b"\r\n\r\n")
+        if head_end < 0:
+            return
+        lines = bytes(self._req[:head_end]).decode().split("\r\n")
+        method, path, _ = lines[0].split(" ", 2)
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", "0"))
+        if len(self._req) < head_end + 4 + length:
+            return
+        body = bytes(self._req[head_end + 4:head_end + 4 + length])
+        del self._req[:head_end + 4 + length]
+        server = self.sim.server
+        self._resp += server.handle(method, path, headers, body)
+        self._resp_at = self.sim.clock.now() + server.latency_s
+
+    def recv_into(self, buf, nbytes: int = 0) -> int:
+        self._check_link()
+        if not self._resp or self.sim.clock.now() < self._resp_at:
+            if self.timeout:
+                self.sim.clock.advance(min(self.timeout, max(0.0, self._resp_at - self.sim.clock.now())))
+            raise OSError(EAGAIN, "EAGAIN")
+        n = min(len(buf), nbytes or len(buf), len(self._resp))
+        buf[:n] = self._resp[:n]
+        self._resp = self._resp[n:]
+        return n
+
+    def close(self) -> None:
+        self._connected = False
+
+
+class SocketPool:
+    AF_INET = 2
+    SOCK_STREAM = 1
+    SOCK_DGRAM = 2
+
+    def __init__(self, sim, radio=None):
+        self.sim = sim
+
+    def getaddrinfo(self, host, port, *_a):
+        if not self.sim.radio.connected:
+            raise OSError(-2, "Name or service not known")
+        return [(self.AF_INET, self.SOCK_STREAM, 0, "", ("10.0.0.1", port))]
+
+    def socket(self, family=AF_INET, type=SOCK_STREAM, proto=0):
+        return Socket(self.sim)
+
+
+class SSLContext:
+    def __init__(self, sim):
+        self.sim = sim
+
+    def wrap_socket(self, sock: Socket, server_side: bool = False, server_hostname: str | None = None):
+        sock.tls = True
+        return sock
+
+    def load_verify_locations(self, *a, **kw) -> None:
+        pass
+
+
+class APInfo:
+    def __init__(self, ssid: str):
+        self.ssid = ssid
+        self.bssid = b"\x02\x00\x00\x00\x00\x01"
+        self.channel = 6
+        self.rssi = -58
+
+
+class Radio:
+    """wifi.radio. Joins the configured SSID unless inside an outage window."""
+    FAST_JOIN_S = 0.8          # known channel + BSSID
+    SCAN_JOIN_S = 3.0
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.outages: list[tuple[float, float]] = []
+        self.enabled = True
+        self.hostname = "aqm-sim"
+        self.ipv4_address = None
+        self.connects = 0
+        self._joined: APInfo | None = None
+
+    def _in_outage(self) -> bool:
+        now = self.sim.clock.now()
+        return any(start <= now < end for start, end in self.outages)
+
+    @property
+    def connected(self) -> bool:
+        if self._joined is not None and (self._in_outage() or not self.enabled):
+            self._joined = None
+            self.ipv4_address = None
+        return self._joined is not None
+
+    @property
+    def ap_info(self) -> APInfo | None:
+        return self._joined if self.connected else None
+
+    def connect(self, ssid, password=None, *, channel=0, bssid=None, timeout=None) -> None:
+        self.connects += 1
+        if self._in_outage() or not self.enabled:
+            # A targeted join waits out its timeout; a scan fails once it's done
+            self.sim.clock.advance((timeout or 8.0) if bssid else min(timeout or 8.0, self.SCAN_JOIN_S))
+            raise ConnectionError("No network with that ssid")
+        self.sim.clock.advance(self.FAST_JOIN_S if bssid else self.SCAN_JOIN_S)
+        self._joined = APInfo(ssid)
+        if self.ipv4_address is None:
+            self.ipv4_address = "10.0.0.42"
+
+    def disconnect(self) -> None:
+        self._joined = None
+
+    def set_ipv4_address(self, *, ipv4, netmask, gateway, ipv4_dns=None) -> None:
+        self.ipv4_address = str(ipv4)
+
+    def set_ipv4_address_to_dhcp(self) -> None:
+        self.ipv4_address = None
+
+
+class NTP:
+    def __init__(self, sim, pool, server: str = "", tz_offset: float = 0, **_kw):
+        self.sim = sim
+        self.tz_offset = tz_offset
+
+    @property
+    def datetime(self) -> time.struct_time:
+        if not self.sim.radio.connected:
+            raise OSError(ETIMEDOUT, "ETIMEDOUT")
+        self.sim.clock.advance(self.sim.server.latency_s)
+        return time.gmtime(int(self.sim.unix() + self.tz_offset * 3600))
+
+
+def modules(sim) -> dict[str, types.ModuleType]:
+    wifi = types.ModuleType("wifi")
+    wifi.radio = sim.radio
+    socketpool = types.ModuleType("socketpool")
+    socketpool.SocketPool = lambda radio: SocketPool(sim, radio)
+    ssl = types.ModuleType("ssl")
+    ssl.create_default_context = lambda: SSLContext(sim)
+    ssl.SSLContext = SSLContext
+    ntp = types.ModuleType("adafruit_ntp")
+    ntp.NTP = lambda pool, *a, **kw: NTP(sim, pool, *a, **kw)
+    return {m.__name__: m for m in (wifi, socketpool, ssl, ntp)}
@@ -0,0 +1,391 @@
+"""
+Replays a field trace (device/fieldtrace.py) through the unmodified
+device code: the SPS30 UART returns the recorded bytes at their recorded
+times, the I2C sensors return the recorded readings, and WiFi, HTTP and
+NTP give the recorded results. The replayed device records its own trace,
+so stage timings can be compared with the field's.
+"""
+from __future__ import annotations
+
+import importlib
+import sys
+import tempfile
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from . import network
+from .harness import DEVICE_DIR, SimConfig, SimResult, Simulation
+
+
+def _fieldtrace():
+    # The trace format lives with the recorder on the device side
+    sys.path.insert(0, str(DEVICE_DIR))
+    try:
+        return importlib.import_module("fieldtrace")
+    finally:
+        sys.path.remove(str(DEVICE_DIR))
+
+
+ft = _fieldtrace()
+SENSOR_NAMES = {ft.SHT4X: "sht4x", ft.SGP40: "sgp40", ft.SCD40: "scd40"}
+
+
+@dataclass
+class Trace:
+    """One boot (segment) of a trace file, decoded. Times are seconds from boot."""
+    uart: list[tuple[float, bytes]] = field(default_factory=list)
+    # sensor -> [(t, values, seconds the read took)]
+    readings: dict[int, list[tuple[float, tuple[float, ...], float]]] = field(default_factory=dict)
+    http: list[tuple[float, int, str, bytes]] = field(default_factory=list)
+    wifi: list[tuple[float, int, str]] = field(default_factory=list)
+    ntp: list[tuple[float, int]] = field(default_factory=list)
+    stages: list[tuple[float, int, int]] = field(default_factory=list)
+    # stage -> [count, total ms, max ms], from the STAGES summaries
+    stage_totals: dict[int, list[int]] = field(default_factory=dict)
+    notes: list[tuple[float, str]] = field(default_factory=list)
+    duration_s: float = 0.0
+
+    @classmethod
+    def from_records(cls, records) -> "Trace":
+        trace = cls()
+        last_stage_ms = 0
+        for kind, t_ms, payload in records:
+            t = t_ms / 1000
+            if kind == ft.UART:
+                trace.uart.append((t, payload))
+            elif kind == ft.READING:
+                # code.py times the read (a STAGE record) right before logging it
+                sensor, values = ft.decode_reading(payload)
+                trace.readings.setdefault(sensor, []).append((t, values, last_stage_ms / 1000))
+            elif kind == ft.HTTP:
+                status, path, body = ft.decode_http(payload)
+                trace.http.append((t, status, path, body))
+            elif kind == ft.WIFI:
+                event, error = ft.decode_wifi(payload)
+                trace.wifi.append((t, event, error))
+            elif kind == ft.NTP:
+                trace.ntp.append((t, ft.decode_ntp(payload)))
+            elif kind == ft.STAGE:
+                stage, ms = ft.decode_stage(payload)
+                trace.stages.append((t, stage, ms))
+                last_stage_ms = ms
+            elif kind == ft.STAGES:
+                for stage, count, total, top in ft.decode_stages(payload):
+                    s = trace.stage_totals.setdefault(stage, [0, 0, 0])
+                    s[0] += count
+                    s[1] += total
+                    s[2] = max(s[2], top)
+            elif kind == ft.NOTE:
+                trace.notes.append((t, payload.decode("utf-8", "replace")))
+            trace.duration_s = t
+        return trace
+
+    @classmethod
+    def load(cls, path: str | Path, segment: int = -1) -> "Trace":
+        segments = ft.segments(Path(path).read_bytes())
+        if not segments:
+            raise ValueError("%s holds no trace" % path)
+        return cls.from_records(segments[segment][1])
+
+
+def stage_summary(totals: dict[int, list[int]], names: tuple[str, ...]) -> dict[str, dict[str, float]]:
+    out: dict[str, dict[str, float]] = {}
+    for stage, (count, total, top) in sorted(totals.items()):
+        name = names[stage] if stage < len(names) else str(stage)
+        out[name] = {"n": count, "total_ms": total, "max_ms": top, "avg_ms": total / count}
+    return out
+
+
+# ---------- replayed devices ----------
+
+class ReplaySPS30:
+    """
+    Stands in for sensors.SPS30 behind the fake UART: the recorded bytes
+    become readable at the time the field device read them; commands
+    written are counted and otherwise ignored.
+    """
+
+    def __init__(self, clock, chunks: list[tuple[float, bytes]]):
+        self.clock = clock
+        self._pending = deque(chunks)
+        self._avail = bytearray()
+        self.total = sum(len(c) for _, c in chunks)
+        self.delivered = 0
+        self.commands = 0
+        self.present = True
+        self.measuring = False
+        self.asleep = False
+
+    def reset_port(self) -> None:
+        pass
+
+    def write(self, data: bytes) -> None:
+        self.commands += 1
+
+    def readable(self) -> int:
+        now = self.clock.now()
+        while self._pending and self._pending[0][0] <= now:
+            self._avail += self._pending.popleft()[1]
+        return len(self._avail)
+
+    def read(self, n: int) -> bytes:
+        n = min(n, self.readable())
+        data = bytes(self._avail[:n])
+        del self._avail[:n]
+        self.delivered += n
+        return data
+
+    def discard(self) -> None:
+        # The trace only holds bytes the field device kept, so there is
+        # nothing to throw away.
+        pass
+
+
+class _Readings:
+    # Each new reading takes as long as it did in the field
+    def __init__(self, clock, items: list[tuple[float, tuple[float, ...], float]]):
+        self.clock = clock
+        self.items = deque(items)
+        self.total = len(items)
+        self.used = 0
+        self.current: tuple[float, ...] | None = None
+
+    def next(self) -> tuple[float, ...]:
+        if self.items:
+            _, self.current, cost_s = self.items.popleft()
+            self.used += 1
+            self.clock.advance(cost_s)
+        if self.current is None:
+            raise OSError(5, "EIO: no recorded reading")
+        return self.current
+
+    def ready(self, now: float) -> bool:
+        return bool(self.items) and self.items[0][0] <= now
+
+
+class ReplaySHT4x:
+    def __init__(self, readings: _Readings):
+        self._r = readings
+
+    @property
+    def temperature(self) -> float:
+        return self._r.next()[0]
+
+    @property
+    def relative_humidity(self) -> float:
+        return (self._r.current or self._r.next())[1]
+
+    @property
+    def measurements(self) -> tuple[float, float]:
+        t, rh = self._r.next()
+        return t, rh
+
+
+class ReplaySGP40:
+    def __init__(self, readings: _Readings):
+        self._r = readings
+
+    def measure_index(self, temperature: float = 25.0, relative_humidity: float = 50.0) -> int:
+        return int(self._r.next()[0])
+
+
+class ReplaySCD4X:
+    def __init__(self, readings: _Readings, clock):
+        self._r = readings
+        self._clock = clock
+
+    def start_periodic_measurement(self) -> None:
+        pass
+
+    def stop_periodic_measurement(self) -> None:
+        pass
+
+    @property
+    def data_ready(self) -> bool:
+        return self._r.ready(self._clock.now())
+
+    @property
+    def CO2(self) -> int:
+        return int(self._r.next()[0])
+
+    @property
+    def temperature(self) -> float:
+        return (self._r.current or self._r.next())[1]
+
+    @property
+    def relative_humidity(self) -> float:
+        return (self._r.current or self._r.next())[2]
+
+
+class ReplayServer(network.Server):
+    """
+    Answers requests, in order, with the recorded results. A recorded
+    client timeout gets no response, so the client times out again; any
+    other recorded failure (refused, reset, unreachable) is replayed as a
+    reset of any open socket and a failed connect. Once the trace runs
+    out, answers like network.Server.
+    """
+    CLIENT_TIMEOUT = "timeout"    # HttpClient's error for a missed deadline
+
+    def __init__(self, sim, results: list[tuple[float, int, str, bytes]], **kwargs):
+        super().__init__(sim, **kwargs)
+        self._results = deque(results)
+        self.total = len(results)
+        self.used = 0
+        self.mismatches: list[tuple[str, str]] = []
+
+    def _failure_next(self) -> bool:
+        results = self._results
+        return bool(results) and results[0][1] < 0 and results[0][3] != self.CLIENT_TIMEOUT.encode()
+
+    def in_outage(self) -> bool:
+        # Checked as a request starts: resets a kept-alive socket, so the
+        # client reconnects into up()
+        return self._failure_next()
+
+    def up(self) -> bool:
+        if self._failure_next():
+            self._results.popleft()
+            self.used += 1
+            return False
+        return super().up()
+
+    def handle(self, method: str, path: str, headers: dict[str, str], body: bytes) -> bytes:
+        if not self._results:
+            return super().handle(method, path, headers, body)
+        self.requests[path] = self.requests.get(path, 0) + 1
+        self.bytes_in[path] = self.bytes_in.get(path, 0) + len(body)
+        _, status, recorded_path, payload = self._results.popleft()
+        self.used += 1
+        if recorded_path != path:
+            self.mismatches.append((recorded_path, path))
+        if status < 0:
+            return b""
+        return (b"HTTP/1.1 %d Replayed\r\nContent-Type: application/json\r\n"
+                b"Content-Length: %d\r\n\r\n" % (status, len(payload))) + payload
+
+
+class ReplayRadio(network.Radio):
+    """Connect attempts return the recorded outcomes; recorded link losses drop the link."""
+
+    def __init__(self, sim, events: list[tuple[float, int, str]]):
+        super().__init__(sim)
+        self._attempts = deque(e for e in events if e[1] != ft.WIFI_LOST)
+        self._drops = deque(t for t, event, _ in events if event == ft.WIFI_LOST)
+        self._joined_at = 0.0
+
+    @property
+    def connected(self) -> bool:
+        now = self.sim.clock.now()
+        while self._drops and self._drops[0] <= self._joined_at:
+            self._drops.popleft()   # lost before this join; already happened
+        if self._joined is not None and self._drops and self._drops[0] <= now:
+            self._drops.popleft()
+            self._joined = None
+            self.ipv4_address = None
+        return self._joined is not None
+
+    def connect(self, ssid, password=None, *, channel=0, bssid=None, timeout=None) -> None:
+        self.connects += 1
+        # One record covers a whole connect attempt: the fast join to the
+        # remembered AP and, if that fails, the scan. So a fast join only
+        # consumes a success.
+        if self._attempts and self._attempts[0][1] == ft.WIFI_FAILED:
+            error = self._attempts[0][2] or "No network with that ssid"
+            if bssid:
+                self.sim.clock.advance(timeout or 8.0)
+            else:
+                self.sim.clock.advance(self.SCAN_JOIN_S)
+                self._attempts.popleft()
+            raise ConnectionError(error)
+        if self._attempts:
+            self._attempts.popleft()
+        self.sim.clock.advance(self.FAST_JOIN_S if bssid else self.SCAN_JOIN_S)
+        self._joined = network.APInfo(ssid)
+        self._joined_at = self.sim.clock.now()
+        if self.ipv4_address is None:
+            self.ipv4_address = "10.0.0.42"
+
+
+class ReplayNTP(network.NTP):
+    def __init__(self, sim, pool, times: deque, **kwargs):
+        super().__init__(sim, pool, **kwargs)
+        self._times = times
+
+    @property
+    def datetime(self):
+        if not self.sim.radio.connected:
+            raise OSError(network.ETIMEDOUT, "ETIMEDOUT")
+        self.sim.clock.advance(self.sim.server.latency_s)
+        if self._times:
+            return time.gmtime(self._times.popleft()[1])
+        return time.gmtime(int(self.sim.unix()))
+
+
+# ---------- driver ----------
+
+@dataclass
+class ReplayResult:
+    sim: SimResult
+    trace: Trace
+    replayed: Trace
+    field_stages: dict[str, dict[str, float]]
+    replay_stages: dict[str, dict[str, float]]
+    consumed: dict[str, tuple[int, int]]     # input -> (used, recorded)
+    path_mismatches: list[tuple[str, str]]
+
+
+class ReplaySimulation(Simulation):
+    def __init__(self, trace: Trace, config: SimConfig | None = None):
+        config = config or SimConfig()
+        config.duration_s = trace.duration_s + 5.0
+        config.reboot = False
+        if trace.ntp:
+            t, unix = trace.ntp[0]
+            config.start_unix = int(unix - t)
+        super().__init__(config)
+        self.trace = trace
+        self.sps30 = ReplaySPS30(self.clock, trace.uart)
+        self.radio = ReplayRadio(self, trace.wifi)
+        self.server = ReplayServer(self, trace.http, latency_s=config.server_latency_s)
+        self._readings = {sensor: _Readings(self.clock, items) for sensor, items in trace.readings.items()}
+        for sensor in (ft.SHT4X, ft.SGP40, ft.SCD40):
+            self._readings.setdefault(sensor, _Readings(self.clock, []))
+        self._ntp_times = deque(trace.ntp)
+
+    def _modules(self) -> dict[str, Any]:
+        mods = super()._modules()
+        readings = self._readings
+        mods["adafruit_sht4x"].SHT4x = lambda i2c, *a, **kw: ReplaySHT4x(readings[ft.SHT4X])
+        mods["adafruit_sgp40"].SGP40 = lambda i2c, *a, **kw: ReplaySGP40(readings[ft.SGP40])
+        mods["adafruit_scd4x"].SCD4X = lambda i2c, *a, **kw: ReplaySCD4X(readings[ft.SCD40], self.clock)
+        mods["adafruit_ntp"].NTP = lambda pool, *a, **kw: ReplayNTP(self, pool, self._ntp_times, **kw)
+        return mods
+
+
+def replay(trace: Trace, config: SimConfig | None = None) -> ReplayResult:
+    config = config or SimConfig()
+    with tempfile.TemporaryDirectory() as tmp:
+        out = Path(tmp) / "replay.bin"
+        config.trace_out = str(out)
+        sim = ReplaySimulation(trace, config)
+        result = sim.run()
+        replayed = Trace.load(out) if out.exists() else Trace()
+    names = tuple(result.device_globals.get("STAGES", ()))
+    readings = {"%s readings" % SENSOR_NAMES[s]: (r.used, r.total) for s, r in sim._readings.items() if r.total}
+    return ReplayResult(
+        sim=result,
+        trace=trace,
+        replayed=replayed,
+        field_stages=stage_summary(trace.stage_totals, names),
+        replay_stages=stage_summary(replayed.stage_totals, names),
+        consumed={
+            "sps30 bytes": (sim.sps30.delivered, sim.sps30.total),
+            "http results": (sim.server.used, sim.server.total),
+            **readings,
+        },
+        path_mismatches=sim.server.mismatches,
+    )
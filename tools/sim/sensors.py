@@ -0,0 +1,340 @@
+"""
+Simulated sensors: an indoor-air environment model, an SPS30 speaking
+SHDLC over a fake UART, and stand-ins for the Adafruit SHT4x, SGP40 and
+SCD4x drivers.
+"""
+from __future__ import annotations
+
+import math
+import random
+import struct
+import types
+
+from .clock import VirtualClock
+
+START_STOP = 0x7E
+ESC = 0x7D
+STUFF = {0x7E: 0x5E, 0x7D: 0x5D, 0x11: 0x31, 0x13: 0x33}
+UNSTUFF = {v: k for k, v in STUFF.items()}
+
+DAY_S = 24 * 60 * 60
+
+
+class Environment:
+    """Slowly varying room conditions with a daily cycle and a little noise."""
+
+    def __init__(self, clock: VirtualClock, rng: random.Random):
+        self.clock = clock
+        self.rng = rng
+
+    def _daily(self, phase: float = 0.0) -> float:
+        return math.sin(2 * math.pi * (self.clock.now() / DAY_S + phase))
+
+    def temperature_c(self) -> float:
+        return 22.0 + 1.5 * self._daily() + self.rng.gauss(0, 0.05)
+
+    def humidity_pct(self) -> float:
+        return 45.0 - 5.0 * self._daily() + self.rng.gauss(0, 0.3)
+
+    def co2_ppm(self) -> int:
+        return int(650 + 250 * max(0.0, self._daily(0.25)) + self.rng.gauss(0, 10))
+
+    def voc_index(self) -> int:
+        return max(1, int(100 + 30 * self._daily(0.5) + self.rng.gauss(0, 5)))
+
+    def pm25(self) -> float:
+        return max(0.0, 8.0 + 5.0 * self._daily(0.1) + self.rng.gauss(0, 0.5))
+
+
+# ---------- SPS30 ----------
+
+def _checksum(payload: bytes) -> int:
+    return (~(sum(payload) & 0xFF)) & 0xFF
+
+
+def _frame(payload: bytes) -> bytes:
+    body = payload + bytes([_checksum(payload)])
+    out = bytearray([START_STOP])
+    for b in body:
+        if b in STUFF:
+            out += bytes([ESC, STUFF[b]])
+        else:
+            out.append(b)
+    out.append(START_STOP)
+    return bytes(out)
+
+
+class SPS30:
+    """
+    SHDLC side of an SPS30: decodes MOSI frames written to its UART and
+    queues MISO replies that become readable RESPONSE_S later.
+    """
+    RESPONSE_S = 0.02
+    BYTE_S = 10 / 115200       # 8N1 at 115200 baud
+
+    ERR_STATE = 0x43           # command not allowed in current state
+
+    def __init__(self, clock: VirtualClock, env: Environment):
+        self.clock = clock
+        self.env = env
+        self.measuring = False
+        self.asleep = False
+        self.present = True
+        self.commands = 0
+        self._rx = bytearray()     # host -> sensor, undecoded
+        self._tx: list[tuple[float, int]] = []   # (readable_at, byte)
+
+    def reset_port(self) -> None:
+        self._rx.clear()
+        self._tx.clear()
+
+    def write(self, data: bytes) -> None:
+        if not self.present:
+            return
+        self._rx += data
+        while True:
+            start = self._rx.find(START_STOP)
+            if start < 0:
+                self._rx.clear()
+                return
+            end = self._rx.find(START_STOP, start + 1)
+            if end < 0:
+                del self._rx[:start]
+                return
+            raw = bytes(self._rx[start + 1:end])
+            del self._rx[:end + 1]
+            if raw:
+                self._handle(self._unstuff(raw))
+
+    @staticmethod
+    def _unstuff(raw: bytes) -> bytes:
+        out = bytearray()
+        esc = False
+        for b in raw:
+            if esc:
+                out.append(UNSTUFF.get(b, b))
+                esc = False
+            elif b == ESC:
+                esc = True
+            else:
+                out.append(b)
+        return bytes(out)
+
+    def _reply(self, cmd: int, state: int = 0, data: bytes = b"") -> None:
+        t = self.clock.now() + self.RESPONSE_S
+        for i, b in enumerate(_frame(bytes([0x00, cmd, state, len(data)]) + data)):
+            self._tx.append((t + i * self.BYTE_S, b))
+
+    def _handle(self, frame: bytes) -> None:
+        if len(frame) < 4 or _checksum(frame[:-1]) != frame[-1]:
+            return
+        cmd = frame[1]
+        self.commands += 1
+        if self.asleep and cmd != 0x11:
+            return                  # UART is off while asleep
+        if cmd == 0x11:             # wake-up
+            if self.asleep:
+                self.asleep = False
+                self._reply(cmd)
+        elif cmd == 0x00:           # start measurement
+            if self.measuring:
+                self._reply(cmd, self.ERR_STATE)
+            else:
+                self.measuring = True
+                self._reply(cmd)
+        elif cmd == 0x01:           # stop measurement
+            if not self.measuring:
+                self._reply(cmd, self.ERR_STATE)
+            else:
+                self.measuring = False
+                self._reply(cmd)
+        elif cmd == 0x03:           # read measured values
+            if not self.measuring:
+                self._reply(cmd, self.ERR_STATE)
+            else:
+                self._reply(cmd, data=self._measurement())
+        elif cmd == 0x10:           # sleep
+            if self.measuring:
+                self._reply(cmd, self.ERR_STATE)
+            else:
+                self._reply(cmd)
+                self.asleep = True
+        elif cmd == 0xD3:           # device reset
+            self.measuring = False
+            self._reply(cmd)
+        else:                       # fan cleaning etc.
+            self._reply(cmd)
+
+    def _measurement(self) -> bytes:
+        pm25 = self.env.pm25()
+        pm1 = pm25 * 0.8
+        pm4 = pm25 * 1.1
+        pm10 = pm25 * 1.2
+        nc05 = pm25 * 6.0
+        nc1 = nc05 * 1.15
+        nc25 = nc1 * 1.01
+        nc4 = nc25 * 1.001
+        nc10 = nc4 * 1.0005
+        return struct.pack(">10f", pm1, pm25, pm4, pm10, nc05, nc1, nc25, nc4, nc10, 0.55)
+
+    def readable(self) -> int:
+        now = self.clock.now()
+        n = 0
+        for t, _ in self._tx:
+            if t > now:
+                break
+            n += 1
+        return n
+
+    def discard(self) -> None:
+        """UART.reset_input_buffer(): drop what has arrived so far."""
+        self.read(self.readable())
+
+    def read(self, n: int) -> bytes:
+        n = min(n, self.readable())
+        data = bytes(b for _, b in self._tx[:n])
+        del self._tx[:n]
+        return data
+
+
+class UART:
+    """busio.UART wired to a simulated device (or to nothing)."""
+    # Busy-polling an empty port costs this much virtual time per call
+    POLL_S = 0.0005
+
+    def __init__(self, clock: VirtualClock, device: SPS30 | None, baudrate: int = 9600,
+                 timeout: float = 1.0, **_kw):
+        self.clock = clock
+        self.device = device
+        self.baudrate = baudrate
+        self.timeout = timeout
+
+    @property
+    def in_waiting(self) -> int:
+        n = self.device.readable() if self.device is not None else 0
+        if not n:
+            self.clock.advance(self.POLL_S)
+        return n
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.clock.advance(len(data) * SPS30.BYTE_S)
+        if self.device is not None:
+            self.device.write(data)
+        return len(data)
+
+    def readinto(self, buf) -> int:
+        if self.device is None:
+            return 0
+        data = self.device.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def read(self, nbytes: int | None = None) -> bytes | None:
+        if self.device is None:
+            return None
+        return self.device.read(nbytes or 4096) or None
+
+    def reset_input_buffer(self) -> None:
+        if self.device is not None:
+            self.device.discard()
+
+    def deinit(self) -> None:
+        pass
+
+
+# ---------- I2C sensor drivers ----------
+
+class _I2CSensor:
+    # Virtual time one read takes (measurement + bus transfer)
+    READ_S = 0.0
+
+    def __init__(self, sim, i2c=None, *_a, **_kw):
+        self._sim = sim
+
+    def _read(self) -> None:
+        self._sim.clock.advance(self.READ_S)
+
+
+class SHT4x(_I2CSensor):
+    READ_S = 0.0083             # high-precision, no heater
+
+    @property
+    def temperature(self) -> float:
+        self._read()
+        return self._sim.env.temperature_c()
+
+    @property
+    def relative_humidity(self) -> float:
+        self._read()
+        return self._sim.env.humidity_pct()
+
+    @property
+    def measurements(self) -> tuple[float, float]:
+        self._read()
+        return self._sim.env.temperature_c(), self._sim.env.humidity_pct()
+
+
+class SGP40(_I2CSensor):
+    READ_S = 0.03
+
+    def measure_index(self, temperature: float = 25.0, relative_humidity: float = 50.0) -> int:
+        self._read()
+        return self._sim.env.voc_index()
+
+
+class SCD4X(_I2CSensor):
+    READ_S = 0.001
+    PERIOD_S = 5.0
+
+    def __init__(self, sim, i2c=None, *a, **kw):
+        super().__init__(sim, i2c, *a, **kw)
+        self._started_at: float | None = None
+        self._last_read = -1
+
+    def start_periodic_measurement(self) -> None:
+        self._read()
+        self._started_at = self._sim.clock.now()
+
+    def stop_periodic_measurement(self) -> None:
+        self._started_at = None
+
+    def _sample_no(self) -> int:
+        if self._started_at is None:
+            return -1
+        return int((self._sim.clock.now() - self._started_at) // self.PERIOD_S)
+
+    @property
+    def data_ready(self) -> bool:
+        self._read()
+        return self._sample_no() > self._last_read
+
+    def _consume(self) -> None:
+        self._read()
+        self._last_read = self._sample_no()
+
+    @property
+    def CO2(self) -> int:
+        self._consume()
+        return self._sim.env.co2_ppm()
+
+    @property
+    def temperature(self) -> float:
+        self._consume()
+        return self._sim.env.temperature_c() + 0.8
+
+    @property
+    def relative_humidity(self) -> float:
+        self._consume()
+        return self._sim.env.humidity_pct() - 2.0
+
+
+def modules(sim) -> dict[str, types.ModuleType]:
+    """The Adafruit sensor driver modules, bound to sim."""
+    sht = types.ModuleType("adafruit_sht4x")
+    sht.SHT4x = lambda i2c, *a, **kw: SHT4x(sim, i2c)
+    sgp = types.ModuleType("adafruit_sgp40")
+    sgp.SGP40 = lambda i2c, *a, **kw: SGP40(sim, i2c)
+    scd = types.ModuleType("adafruit_scd4x")
+    scd.SCD4X = lambda i2c, *a, **kw: SCD4X(sim, i2c)
+    return {m.__name__: m for m in (sht, sgp, scd)}